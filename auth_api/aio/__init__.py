@@ -0,0 +1,8 @@
+"""
+ASGI mode: the /api/v1 contract of the Flask app served on asyncio.
+
+Requests go through asyncpg and redis.asyncio pools. Business rules, keys, Lua
+scripts, token minting and the in-memory caches are shared with the Flask app;
+background threads (key reload, revocation resync, cache invalidation) keep
+using the blocking clients and never run on the event loop.
+"""
@@ -0,0 +1,169 @@
+import logging
+import time
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Mount, Route
+from werkzeug.exceptions import HTTPException
+
+import default_config
+import hashing
+import jobs
+import jwt_keys
+import metrics
+import revocation
+import token_store
+import tokens
+import user_cache
+from aio import auth, db, rate_limit
+from aio import token_store as async_token_store
+from aio import v1
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+def load_settings() -> dict:
+    """The same settings the flask app gets in app.config."""
+    settings = config.dict()
+    settings.update(
+        (name, value)
+        for name, value in vars(default_config.DefaultConfig).items()
+        if name.isupper()
+    )
+    return settings
+
+
+async def get_jwks(request: Request):
+    keyring = jwt_keys.current()
+    headers = {
+        "ETag": f'"{keyring.jwks_etag}"',
+        "Cache-Control": f"public, max-age={request.app.state.settings['JWKS_MAX_AGE']}",
+    }
+    if request.headers.get("If-None-Match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    return Response(keyring.jwks, media_type="application/json", headers=headers)
+
+
+async def get_metrics(_request: Request):
+    data, content_type = metrics.render()
+    return Response(data, headers={"Content-Type": content_type})
+
+
+class MetricsMiddleware:
+    """Request latency by endpoint and status, named like the flask endpoints."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            endpoint = scope.get("endpoint")
+            name = endpoint and (
+                f"{endpoint.__module__.rsplit('.', 1)[-1]}.{endpoint.__name__}"
+            )
+            metrics.observe_request(name, scope["method"], status, started)
+
+
+async def handle_http_exception(_request: Request, e: HTTPException):
+    # exceptions of the shared code are werkzeug ones
+    response = e.get_response()
+    return Response(
+        response.get_data(),
+        status_code=response.status_code,
+        headers=dict(response.headers),
+    )
+
+
+async def handle_jwt_error(_request: Request, e: auth.JWTAuthError):
+    return JSONResponse({"msg": e.msg}, status_code=e.status_code)
+
+
+def create_app() -> Starlette:
+    settings = load_settings()
+    logging.basicConfig(level=settings["LOG_LEVEL"])
+
+    def startup():
+        jwt_keys.init(settings["JWT_ALGORITHM"])
+        jobs.run_periodically(
+            "reload-jwt-keys", settings["KEYRING_REFRESH_INTERVAL"], jwt_keys.reload
+        )
+        tokens.init(
+            settings["JWT_ACCESS_TOKEN_EXPIRES"], settings["JWT_REFRESH_TOKEN_EXPIRES"]
+        )
+        hashing.init(
+            settings["PASSWORD_HASH_WORKERS"],
+            settings["PASSWORD_HASH_QUEUE_SIZE"],
+            (
+                settings["ARGON2_TIME_COST"],
+                settings["ARGON2_MEMORY_COST"],
+                settings["ARGON2_PARALLELISM"],
+            ),
+        )
+
+        # blocking client, only for the pub/sub and resync threads
+        token_store.init(
+            settings["REDIS_SOCKET"], settings["JWT_REFRESH_TOKEN_EXPIRES"]
+        )
+        user_cache.init(
+            token_store.client, settings["USER_CACHE_SIZE"], settings["USER_CACHE_TTL"]
+        )
+        revocation.init(
+            token_store.client,
+            settings["JWT_ACCESS_TOKEN_EXPIRES"],
+            settings["REVOCATION_BLOOM_CAPACITY"],
+            settings["REVOCATION_BLOOM_ERROR_RATE"],
+            settings["REVOCATION_RESYNC_INTERVAL"],
+        )
+
+        db.init(
+            settings["POSTGRES_URI"],
+            settings["ASYNC_POSTGRES_POOL_SIZE"],
+            settings["ASYNC_POSTGRES_MAX_OVERFLOW"],
+            settings["ASYNC_POSTGRES_POOL_TIMEOUT"],
+        )
+        async_token_store.init(
+            settings["REDIS_SOCKET"],
+            settings["JWT_REFRESH_TOKEN_EXPIRES"],
+            settings["ASYNC_REDIS_MAX_CONNECTIONS"],
+            settings["ASYNC_REDIS_POOL_TIMEOUT"],
+        )
+        rate_limit.init(settings["RATE_LIMITS"])
+        auth.init(settings["JWT_DECODE_ALGORITHMS"])
+
+    async def shutdown():
+        await db.engine.dispose()
+        await async_token_store.close()
+
+    app = Starlette(
+        debug=settings["DEBUG"],
+        routes=[
+            Mount("/api/v1", routes=v1.routes),
+            Route("/.well-known/jwks.json", get_jwks, methods=["GET"]),
+            Route("/metrics", get_metrics, methods=["GET"]),
+        ],
+        middleware=[Middleware(MetricsMiddleware)],
+        exception_handlers={
+            HTTPException: handle_http_exception,
+            auth.JWTAuthError: handle_jwt_error,
+        },
+        on_startup=[startup],
+        on_shutdown=[shutdown],
+    )
+    app.state.settings = settings
+    return app
@@ -0,0 +1,238 @@
+import logging
+import uuid
+from typing import Optional
+
+import jwt
+from jwt import ExpiredSignatureError, PyJWTError
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from werkzeug.exceptions import Forbidden
+
+import auth
+import hashing
+import jwt_keys
+import token_store
+import tokens
+from aio import db, revocation
+from aio import token_store as async_token_store
+from aio import user_cache
+from exceptions import (
+    AlreadyExistsError,
+    PasswordAuthenticationError,
+    ServiceBusyError,
+    TokenError,
+)
+from user_cache import UserSnapshot
+
+logger = logging.getLogger(__name__)
+
+decode_algorithms: list[str] = []
+
+
+class JWTAuthError(Exception):
+    """Rejected bearer token, answered the way flask_jwt_extended does."""
+
+    def __init__(self, status_code: int, msg: str):
+        super().__init__(msg)
+        self.status_code = status_code
+        self.msg = msg
+
+
+def init(algorithms: list[str]):
+    global decode_algorithms
+    decode_algorithms = algorithms
+
+
+async def decode(encoded_token: str) -> dict:
+    kid = jwt.get_unverified_header(encoded_token).get("kid")
+    if kid and kid not in jwt_keys.current().keys:
+        # reloads keys from the db, off the event loop
+        key = await run_in_threadpool(jwt_keys.verification_key, kid)
+    else:
+        key = jwt_keys.verification_key(kid)
+    return jwt.decode(encoded_token, key, algorithms=decode_algorithms)
+
+
+async def verify(request: Request, refresh=False) -> dict:
+    """Token payload of the request, verify_jwt_in_request() of the ASGI app."""
+    header = request.headers.get("Authorization")
+    if not header:
+        raise JWTAuthError(401, "Missing Authorization Header")
+    scheme, _, encoded_token = header.partition(" ")
+    if scheme != "Bearer" or not encoded_token or " " in encoded_token:
+        raise JWTAuthError(
+            422, "Bad Authorization header. Expected 'Authorization: Bearer <JWT>'"
+        )
+    try:
+        payload = await decode(encoded_token)
+    except ExpiredSignatureError:
+        raise JWTAuthError(401, "Token has expired")
+    except PyJWTError as e:
+        raise JWTAuthError(422, str(e))
+
+    if refresh and payload.get("type") != "refresh":
+        raise JWTAuthError(422, "Only refresh tokens are allowed")
+    if not refresh and payload.get("type") != "access":
+        raise JWTAuthError(422, "Only non-refresh tokens are allowed")
+
+    if refresh:
+        revoked = not await async_token_store.does_refresh_token_exist(
+            payload["sub"],
+            token_store.token_device_fields(payload),
+            payload["jti"],
+        )
+    else:
+        revoked = await revocation.is_revoked(payload)
+    if revoked:
+        raise JWTAuthError(401, "Token has been revoked")
+    return payload
+
+
+async def authenticate(request: Request, refresh=False) -> tuple[dict, UserSnapshot]:
+    """Token payload and user of the request, jwt_required() of the ASGI app."""
+    payload = await verify(request, refresh)
+    user = await user_cache.get(payload["sub"])
+    if user is None:
+        raise JWTAuthError(401, f"Error loading the user {payload['sub']}")
+    return payload, user
+
+
+async def authorize(request: Request, *roles: str) -> dict:
+    """
+    Payload of an access token having all of the roles, roles_required() of
+    the ASGI app: the user is not loaded.
+    """
+    payload = await verify(request)
+    if not set(roles).issubset(payload.get("roles", ())):
+        raise Forbidden(description="Not enough roles")
+    return payload
+
+
+async def create_user(email: str, password: str) -> uuid.UUID:
+    if await db.get_credentials(email) is not None:
+        raise AlreadyExistsError(f"User {email} already exists")
+
+    hashed_pass = await hashing.hash_password_async(password)
+    user_id = await db.create_user(email, hashed_pass)
+    await user_cache.invalidate(user_id)
+    return user_id
+
+
+async def authenticate_with_email(email: str, password: str) -> uuid.UUID:
+    credentials = await db.get_credentials(email)
+    if not credentials:
+        logger.debug(f"user with email {email} not found")
+        raise PasswordAuthenticationError
+    if not await hashing.verify_password_async(password, credentials.hashed_password):
+        logger.debug("password is not valid")
+        raise PasswordAuthenticationError
+    if hashing.needs_update(credentials.hashed_password):
+        await upgrade_password_hash(credentials.id, password)
+    return credentials.id
+
+
+async def upgrade_password_hash(user_id, password: str):
+    try:
+        hashed_password = await hashing.hash_password_async(password)
+    except ServiceBusyError:
+        return
+    await db.update_user(user_id, hashed_password=hashed_password)
+    logger.debug(f"password hash of {user_id} is upgraded")
+
+
+async def issue_tokens(user_id, user_agent: str, ip: str) -> tuple[str, str]:
+    device_id = token_store.user_agent_to_device_id(user_agent)
+    user = await user_cache.get(user_id)
+    pair = tokens.mint_pair(
+        user_id,
+        {
+            token_store.DEVICE_CLAIM: device_id,
+            **tokens.role_claims(user.roles, user.roles_version),
+        },
+    )
+    await async_token_store.replace_refresh_token(
+        pair.refresh_jti, str(user_id), token_store.device_fields(device_id)
+    )
+    await db.add_login(auth.login_record(user_id, user_agent, ip))
+    return pair.access_token, pair.refresh_token
+
+
+async def refresh_tokens(user: UserSnapshot, token_data: dict) -> tuple[str, str]:
+    auth.check_roles_version(user, token_data)
+    fields = token_store.token_device_fields(token_data)
+    pair = tokens.mint_pair(
+        user.id,
+        {
+            token_store.DEVICE_CLAIM: fields[0],
+            **tokens.role_claims(user.roles, user.roles_version),
+        },
+    )
+    rotated = await async_token_store.replace_refresh_token(
+        pair.refresh_jti, token_data["sub"], fields, token_data["jti"]
+    )
+    if not rotated:
+        logger.warning(f"refresh token reuse: {token_data['jti']=}, {user=}")
+        raise TokenError("invalid_grant", "Refresh token has already been used")
+    return pair.access_token, pair.refresh_token
+
+
+async def change_user(
+    user: UserSnapshot, token_data: dict, email: Optional[str], password: Optional[str]
+):
+    values = {}
+    if email:
+        values["email"] = email
+    if password:
+        values["hashed_password"] = await hashing.hash_password_async(password)
+    await db.update_user(user.id, **values)
+    await user_cache.invalidate(user.id)
+    if password:
+        await revocation.revoke_user_tokens(user.id)
+        await revocation.revoke_token(token_data)
+
+
+async def logout(user: UserSnapshot, token_data: dict, all_devices: bool):
+    if all_devices:
+        await async_token_store.remove_all_user_refresh_tokens(user.id)
+        await revocation.revoke_user_tokens(user.id)
+    else:
+        await async_token_store.remove_refresh_token(
+            user.id, token_store.token_device_fields(token_data)
+        )
+    await revocation.revoke_token(token_data)
+
+
+async def introspect_tokens(encoded_tokens: list[str]) -> list[dict]:
+    payloads = []
+    for encoded in encoded_tokens:
+        try:
+            payloads.append(await decode(encoded))
+        except PyJWTError as e:
+            logger.debug(f"introspected token is invalid: {e!r}")
+            payloads.append(None)
+
+    refresh_tokens = [
+        (p["sub"], token_store.token_device_fields(p), p["jti"])
+        for p in payloads
+        if p and p["type"] == "refresh"
+    ]
+    stored = iter(
+        await async_token_store.refresh_tokens_exist(refresh_tokens)
+        if refresh_tokens
+        else []
+    )
+    users = await user_cache.get_many(p["sub"] for p in payloads if p)
+
+    results = []
+    for payload in payloads:
+        if payload is None:
+            results.append({"active": False})
+            continue
+        if payload["type"] == "refresh":
+            active = next(stored)
+        else:
+            active = not await revocation.is_revoked(payload)
+        results.append(
+            auth.introspection_result(payload, active, users[payload["sub"]])
+        )
+    return results
@@ -0,0 +1,88 @@
+import uuid
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.engine import Row
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from sqlalchemy.orm import selectinload, sessionmaker
+
+import metrics
+from storage.db_models import LoginRecord, User
+from user_cache import UserSnapshot
+
+ASYNC_DRIVERS = {
+    "postgres": "postgresql+asyncpg",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+}
+
+engine: Optional[AsyncEngine] = None
+session: Optional[sessionmaker] = None
+
+
+def async_uri(uri: str) -> str:
+    scheme, _, rest = uri.partition("://")
+    return f"{ASYNC_DRIVERS.get(scheme, scheme)}://{rest}"
+
+
+def init(uri: str, pool_size: int, max_overflow: int, pool_timeout: float):
+    global engine, session
+    engine = create_async_engine(
+        async_uri(uri),
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+    )
+    metrics.instrument_engine(engine.sync_engine)
+    session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+async def get_credentials(email: str) -> Optional[Row]:
+    async with engine.connect() as connection:
+        result = await connection.execute(
+            select(User.id, User.hashed_password.label("hashed_password")).where(
+                User.email == email
+            )
+        )
+        return result.one_or_none()
+
+
+async def create_user(email: str, hashed_password: str) -> uuid.UUID:
+    user = User(email=email, hashed_password=hashed_password)
+    async with session() as s:
+        s.add(user)
+        await s.commit()
+    return user.id
+
+
+async def update_user(user_id, **values):
+    async with session() as s:
+        user = await s.get(User, user_id)
+        for name, value in values.items():
+            setattr(user, name, value)
+        await s.commit()
+
+
+async def load_snapshots(user_ids: list[str]) -> dict[str, Optional[UserSnapshot]]:
+    async with session() as s:
+        result = await s.execute(
+            select(User)
+            .options(selectinload(User.roles))
+            .where(User.id.in_([uuid.UUID(user_id) for user_id in user_ids]))
+        )
+        users = result.scalars().all()
+    snapshots = dict.fromkeys(user_ids)
+    for user in users:
+        snapshots[str(user.id)] = UserSnapshot.from_user(user)
+    return snapshots
+
+
+async def add_login(row: dict):
+    async with engine.begin() as connection:
+        await connection.execute(LoginRecord.__table__.insert(), [row])
+
+
+async def get_user_history(user_id, limit: int, **filters) -> list[LoginRecord]:
+    async with session() as s:
+        result = await s.execute(LoginRecord.history_query(user_id, limit, **filters))
+        return result.scalars().all()
@@ -0,0 +1,47 @@
+"""rate_limit over redis.asyncio: the same script and limits per route."""
+
+import asyncio
+import logging
+import time
+from typing import Optional
+
+import redis
+
+import rate_limit
+import token_store
+from aio import token_store as async_token_store
+from exceptions import StorageUnavailableError
+
+logger = logging.getLogger(__name__)
+
+limits: dict[str, dict[str, tuple[int, float]]] = {}
+script = None
+
+
+def init(route_limits: dict):
+    global limits, script
+    limits = route_limits
+    script = async_token_store.client.register_script(rate_limit.SCRIPT)
+
+
+async def check(route: str, **values: Optional[str]):
+    calls = rate_limit.script_arguments(limits, route, values, int(time.time() * 1000))
+    if not calls:
+        return
+    try:
+        with token_store.command("rate_limit", async_token_store.breaker):
+            retries = await asyncio.gather(
+                *(script(keys=keys, args=args) for keys, args in calls)
+            )
+            if any(retries):
+                await asyncio.gather(
+                    *(
+                        async_token_store.client.decr(counter)
+                        for counter in rate_limit.counted(calls, retries)
+                    )
+                )
+    except (redis.RedisError, StorageUnavailableError):
+        logger.warning(f"rate limit of {route} is not checked, redis is unavailable")
+        return
+    if any(retries):
+        rate_limit.reject(route, max(retries))
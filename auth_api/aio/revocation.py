@@ -0,0 +1,49 @@
+"""revocation with the redis round trips awaited, local state is shared."""
+
+import logging
+import time
+
+import redis
+
+import revocation
+from aio import token_store
+
+logger = logging.getLogger(__name__)
+
+
+async def is_revoked(jwt_payload: dict) -> bool:
+    revoked = revocation.check_locally(jwt_payload)
+    if revoked is not None:
+        return revoked
+    try:
+        return bool(
+            await token_store.client.exists(revocation.jti_key(jwt_payload["jti"]))
+        )
+    except redis.RedisError:
+        logger.exception("revocation check failed, treating token as revoked")
+        return True
+
+
+async def _store(key: str, value: int, ttl: int, message: str):
+    try:
+        await token_store.client.set(key, value, ex=ttl)
+        await token_store.client.publish(revocation.CHANNEL, message)
+    except redis.RedisError:
+        logger.exception(f"revocation is not stored or published: {message}")
+    revocation.apply(message)
+
+
+async def revoke_token(jwt_payload: dict):
+    jti = jwt_payload["jti"]
+    ttl = max(1, int(jwt_payload["exp"] - time.time()))
+    await _store(revocation.jti_key(jti), 1, ttl, f"jti {jti}")
+
+
+async def revoke_user_tokens(user_id):
+    revoked_at = int(time.time())
+    await _store(
+        revocation.user_key(user_id),
+        revoked_at,
+        revocation.access_token_ttl,
+        f"user {user_id} {revoked_at}",
+    )
@@ -0,0 +1,77 @@
+"""roles with the db round trips awaited, the rules are those of roles."""
+
+import logging
+import uuid
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from werkzeug.exceptions import NotFound
+
+from aio import db, user_cache
+from exceptions import AlreadyExistsError
+from storage.db_models import Role, User
+
+logger = logging.getLogger(__name__)
+
+
+async def list_roles() -> list[Role]:
+    async with db.session() as s:
+        result = await s.execute(select(Role).order_by(Role.name))
+        return result.scalars().all()
+
+
+async def _get_role(s: AsyncSession, name: str) -> Optional[Role]:
+    result = await s.execute(select(Role).where(Role.name == name))
+    return result.scalar_one_or_none()
+
+
+async def create_role(name: str, description: str = None) -> Role:
+    async with db.session() as s:
+        if await _get_role(s, name) is not None:
+            raise AlreadyExistsError(f"Role {name} already exists")
+        role = Role(name=name, description=description)
+        s.add(role)
+        await s.commit()
+    return role
+
+
+async def _user_and_role(s: AsyncSession, user_id: str, name: str) -> tuple[User, Role]:
+    try:
+        user = await s.get(User, uuid.UUID(user_id), options=[selectinload(User.roles)])
+    except ValueError:
+        user = None
+    if user is None:
+        raise NotFound(description=f"User {user_id} not found")
+    role = await _get_role(s, name)
+    if role is None:
+        raise NotFound(description=f"Role {name} not found")
+    return user, role
+
+
+async def _save_roles(s: AsyncSession, user: User):
+    user.roles_version = User.roles_version + 1
+    await s.commit()
+    await user_cache.invalidate(user.id)
+    logger.info(f"roles of {user.id} changed")
+
+
+async def grant_role(user_id: str, name: str) -> bool:
+    async with db.session() as s:
+        user, role = await _user_and_role(s, user_id, name)
+        if role in user.roles:
+            return False
+        user.roles.append(role)
+        await _save_roles(s, user)
+    return True
+
+
+async def revoke_role(user_id: str, name: str) -> bool:
+    async with db.session() as s:
+        user, role = await _user_and_role(s, user_id, name)
+        if role not in user.roles:
+            return False
+        user.roles.remove(role)
+        await _save_roles(s, user)
+    return True
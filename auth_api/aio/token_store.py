@@ -0,0 +1,134 @@
+"""
+token_store over redis.asyncio: the same keys and Lua scripts, one explicit
+connection pool per worker. Requests wait up to pool_timeout for a connection
+to a standalone redis; sentinel and cluster pools open them on demand.
+"""
+
+import logging
+from typing import Optional, Union
+
+import redis.asyncio
+from redis.asyncio.cluster import ClusterNode, RedisCluster
+from redis.asyncio.retry import Retry
+from redis.asyncio.sentinel import Sentinel
+
+import token_store
+from circuit_breaker import CircuitBreaker
+from config import config
+
+logger = logging.getLogger(__name__)
+
+client: Optional[Union[redis.asyncio.Redis, RedisCluster]] = None
+breaker: Optional[CircuitBreaker] = None
+refresh_token_ttl = None
+
+rotate_script = None
+revoke_device_script = None
+revoke_all_script = None
+
+
+def connect(
+    sockets: str, max_connections: int, pool_timeout: float
+) -> Union[redis.asyncio.Redis, RedisCluster]:
+    nodes = token_store.parse_nodes(sockets)
+    options = dict(
+        max_connections=max_connections,
+        decode_responses=True,
+        **token_store.connection_options(Retry),
+    )
+    if config.REDIS_MODE == "cluster":
+        startup_nodes = [ClusterNode(host, port) for host, port in nodes]
+        return RedisCluster(startup_nodes=startup_nodes, **options)
+    if config.REDIS_MODE == "sentinel":
+        sentinel = Sentinel(nodes, **options)
+        return sentinel.master_for(config.REDIS_SENTINEL_MASTER)
+    (host, port), *_ = nodes
+    pool = redis.asyncio.BlockingConnectionPool(
+        host=host, port=port, timeout=pool_timeout, **options
+    )
+    return redis.asyncio.Redis(connection_pool=pool)
+
+
+def init(sockets: str, rf_token_ttl: int, max_connections: int, pool_timeout: float):
+    global client, breaker, refresh_token_ttl
+    global rotate_script, revoke_device_script, revoke_all_script
+    client = connect(sockets, max_connections, pool_timeout)
+    breaker = token_store.new_breaker("redis-async")
+    refresh_token_ttl = rf_token_ttl
+    rotate_script = client.register_script(token_store.ROTATE_SCRIPT)
+    revoke_device_script = client.register_script(token_store.REVOKE_DEVICE_SCRIPT)
+    revoke_all_script = client.register_script(token_store.REVOKE_ALL_SCRIPT)
+
+
+async def close():
+    await client.close()
+    if not isinstance(client, RedisCluster):
+        await client.connection_pool.disconnect()
+
+
+async def does_refresh_token_exist(user_id, fields: list[str], token_id: str) -> bool:
+    keys = token_store.devices_keys(user_id)
+    with token_store.command("exists", breaker):
+        values = await client.hmget(keys[0], fields)
+        if len(keys) > 1 and not any(values):
+            values = await client.hmget(keys[1], fields)
+        matches = token_store.token_matches(values, token_id)
+        if matches is None:
+            matches = bool(await client.exists(token_store.token_key(token_id)))
+    return matches
+
+
+async def refresh_tokens_exist(tokens: list[tuple[str, list[str], str]]) -> list[bool]:
+    pipeline = client.pipeline(transaction=False)
+    for user_id, fields, _ in tokens:
+        pipeline.hmget(token_store.devices_key(user_id), fields)
+    with token_store.command("exists_many", breaker):
+        results = await pipeline.execute()
+    missing = [i for i, values in enumerate(results) if not any(values)]
+    if missing and not token_store.is_cluster():
+        pipeline = client.pipeline(transaction=False)
+        for i in missing:
+            user_id, fields, _ = tokens[i]
+            pipeline.hmget(token_store.legacy_devices_key(user_id), fields)
+        with token_store.command("exists_many", breaker):
+            for i, values in zip(missing, await pipeline.execute()):
+                results[i] = values
+    matches = [
+        token_store.token_matches(values, jti)
+        for values, (_, _, jti) in zip(results, tokens)
+    ]
+    legacy = [i for i, match in enumerate(matches) if match is None]
+    if legacy:
+        pipeline = client.pipeline(transaction=False)
+        for i in legacy:
+            pipeline.exists(token_store.token_key(tokens[i][2]))
+        with token_store.command("exists_many", breaker):
+            for i, exists in zip(legacy, await pipeline.execute()):
+                matches[i] = bool(exists)
+    return matches
+
+
+async def replace_refresh_token(
+    jti, user_id, fields: list[str], expected_jti=None
+) -> bool:
+    with token_store.command("rotate", breaker):
+        rotated = await rotate_script(
+            keys=token_store.devices_keys(user_id),
+            args=token_store.rotate_args(jti, fields, expected_jti, refresh_token_ttl),
+        )
+    logger.debug(f"replace token: {jti=}, {user_id=}, {fields=}, {rotated=}")
+    return bool(rotated)
+
+
+async def remove_refresh_token(user_id, fields: list[str]):
+    with token_store.command("revoke_device", breaker):
+        removed = await revoke_device_script(
+            keys=token_store.devices_keys(user_id), args=fields
+        )
+    logger.debug(f"removed token: {user_id=}, {fields=}, {removed=}")
+
+
+async def remove_all_user_refresh_tokens(user_id):
+    with token_store.command("revoke_all", breaker):
+        count = await revoke_all_script(keys=token_store.devices_keys(user_id))
+    logger.debug(f"removed {count} tokens of {user_id=}")
@@ -0,0 +1,34 @@
+"""user_cache with misses loaded through the async engine."""
+
+import logging
+from typing import Optional
+
+import redis
+
+import user_cache
+from aio import db, token_store
+from user_cache import UserSnapshot
+
+logger = logging.getLogger(__name__)
+
+
+async def get(user_id) -> Optional[UserSnapshot]:
+    return (await get_many([user_id]))[str(user_id)]
+
+
+async def get_many(user_ids) -> dict[str, Optional[UserSnapshot]]:
+    found, missing, generation = user_cache.lookup(user_ids)
+    if missing:
+        loaded = await db.load_snapshots(missing)
+        user_cache.store(loaded, generation)
+        found.update(loaded)
+    return found
+
+
+async def invalidate(user_id):
+    key = str(user_id)
+    user_cache.forget(key)
+    try:
+        await token_store.client.publish(user_cache.INVALIDATION_CHANNEL, key)
+    except redis.RedisError:
+        logger.exception(f"failed to publish user cache invalidation: {key}")
@@ -0,0 +1,228 @@
+import hmac
+import logging
+
+from starlette import responses
+from starlette.requests import Request
+from starlette.routing import Route
+from werkzeug.exceptions import BadRequest, Forbidden, NotFound
+
+import tokens
+from aio import auth, db, rate_limit, roles
+from api import responses as api_responses
+from api.models import (
+    IntrospectIn,
+    IntrospectionResult,
+    IntrospectOut,
+    LoginHistoryQuery,
+    RoleIn,
+    RoleOut,
+    RolesOut,
+    TokenGrantOut,
+    TokenInPassword,
+    UserIn,
+    UserInfoOut,
+    UserLoginRecordsOut,
+    UserPatchIn,
+)
+from exceptions import AuthenticationError
+from permissions import ADMIN_ROLE
+from utils import parse_obj_raise
+
+logger = logging.getLogger(__name__)
+
+
+class JSONResponse(responses.JSONResponse):
+    """Response models rendered like in the flask app, see api.responses."""
+
+    def __init__(self, content, status_code: int = 200, exclude_none: bool = False):
+        self.exclude_none = exclude_none
+        super().__init__(content, status_code)
+
+    def render(self, content) -> bytes:
+        return api_responses.render(content, self.exclude_none)
+
+
+async def read_json(request: Request):
+    # None for a missing or broken body, like request.get_json() in flask
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+async def create_user(request: Request):
+    user_data = parse_obj_raise(UserIn, await read_json(request))
+    await rate_limit.check("register", ip=request.client.host)
+    logger.info(f"user with email: {user_data.email}")
+    user_id = await auth.create_user(
+        user_data.email, user_data.password.get_secret_value()
+    )
+    location = f"{request.url_for('create_user')}/{user_id}"
+    return responses.PlainTextResponse("Created", 201, headers={"Location": location})
+
+
+async def get_user_info(request: Request):
+    _, user = await auth.authenticate(request)
+    if str(user.id) != request.path_params["user_id"]:
+        raise Forbidden
+    return JSONResponse(
+        UserInfoOut.construct(
+            id=str(user.id),
+            email=user.email,
+            registered_at=user.registered_at,
+            active=user.active,
+            roles=list(user.roles),
+        )
+    )
+
+
+async def change_user_info(request: Request):
+    token_data, user = await auth.authenticate(request)
+    if str(user.id) != request.path_params["user_id"]:
+        raise Forbidden
+
+    patch_data = parse_obj_raise(UserPatchIn, await read_json(request))
+    password = patch_data.new_password_1
+    await auth.change_user(
+        user,
+        token_data,
+        patch_data.email,
+        password.get_secret_value() if password else None,
+    )
+    return responses.PlainTextResponse("OK")
+
+
+async def get_login_history(request: Request):
+    _, user = await auth.authenticate(request)
+    if str(user.id) != request.path_params["user_id"]:
+        raise Forbidden
+
+    query = parse_obj_raise(LoginHistoryQuery, dict(request.query_params))
+    records = await db.get_user_history(
+        user.id,
+        query.limit + 1,
+        after=query.cursor,
+        since=query.since,
+        until=query.until,
+    )
+    next_cursor = None
+    if len(records) > query.limit:
+        records = records[: query.limit]
+        next_cursor = records[-1].to_cursor().encode()
+    login_records = [record.to_api_model() for record in records]
+    return JSONResponse(
+        UserLoginRecordsOut.construct(logins=login_records, next_cursor=next_cursor)
+    )
+
+
+async def create_token_pair(request: Request):
+    token_data = parse_obj_raise(TokenInPassword, await read_json(request))
+    await rate_limit.check("token", ip=request.client.host, email=token_data.email)
+    user_id = await auth.authenticate_with_email(
+        token_data.email, token_data.password.get_secret_value()
+    )
+    access_token, refresh_token = await auth.issue_tokens(
+        user_id,
+        request.headers.get("User-Agent", ""),
+        request.client.host,
+    )
+    return JSONResponse(
+        TokenGrantOut.construct(
+            access_token=access_token,
+            refresh_token=refresh_token,
+            expires=tokens.access_expires,
+        )
+    )
+
+
+async def update_token_pair(request: Request):
+    token_data, user = await auth.authenticate(request, refresh=True)
+    access_token, refresh_token = await auth.refresh_tokens(user, token_data)
+    return JSONResponse(
+        TokenGrantOut.construct(
+            access_token=access_token,
+            refresh_token=refresh_token,
+            expires=tokens.access_expires,
+        )
+    )
+
+
+async def revoke_refresh_token(request: Request):
+    token_data, user = await auth.authenticate(request)
+    await auth.logout(
+        user,
+        token_data,
+        all_devices=request.query_params.get("all") == "true",
+    )
+    return responses.PlainTextResponse("OK")
+
+
+async def introspect_tokens(request: Request):
+    settings = request.app.state.settings
+    secret = settings["INTROSPECTION_SECRET"]
+    if not secret:
+        raise NotFound
+    scheme, _, presented = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(
+        presented.encode(), secret.encode()
+    ):
+        raise AuthenticationError
+
+    data = parse_obj_raise(IntrospectIn, await read_json(request))
+    max_tokens = settings["INTROSPECTION_MAX_TOKENS"]
+    if len(data.tokens) > max_tokens:
+        raise BadRequest(description=f"At most {max_tokens} tokens per request")
+    results = await auth.introspect_tokens(data.tokens)
+    return JSONResponse(
+        IntrospectOut.construct(
+            results=[IntrospectionResult.construct(**result) for result in results]
+        ),
+        exclude_none=True,
+    )
+
+
+async def list_roles(request: Request):
+    await auth.authorize(request, ADMIN_ROLE)
+    return JSONResponse(
+        RolesOut.construct(
+            roles=[
+                RoleOut.construct(name=role.name, description=role.description)
+                for role in await roles.list_roles()
+            ]
+        )
+    )
+
+
+async def create_role(request: Request):
+    await auth.authorize(request, ADMIN_ROLE)
+    role_data = parse_obj_raise(RoleIn, await read_json(request))
+    await roles.create_role(role_data.name, role_data.description)
+    return responses.PlainTextResponse("Created", 201)
+
+
+async def grant_role(request: Request):
+    await auth.authorize(request, ADMIN_ROLE)
+    await roles.grant_role(request.path_params["user_id"], request.path_params["role"])
+    return responses.PlainTextResponse("OK")
+
+
+async def revoke_role(request: Request):
+    await auth.authorize(request, ADMIN_ROLE)
+    await roles.revoke_role(request.path_params["user_id"], request.path_params["role"])
+    return responses.PlainTextResponse("OK")
+
+
+routes = [
+    Route("/user", create_user, methods=["POST"]),
+    Route("/user/{user_id}", get_user_info, methods=["GET"]),
+    Route("/user/{user_id}", change_user_info, methods=["PATCH"]),
+    Route("/user/{user_id}/login_history", get_login_history, methods=["GET"]),
+    Route("/token", create_token_pair, methods=["POST"]),
+    Route("/refresh_token", update_token_pair, methods=["POST"]),
+    Route("/refresh_token", revoke_refresh_token, methods=["DELETE"]),
+    Route("/introspect", introspect_tokens, methods=["POST"]),
+    Route("/roles", list_roles, methods=["GET"]),
+    Route("/roles", create_role, methods=["POST"]),
+    Route("/user/{user_id}/roles/{role}", grant_role, methods=["PUT"]),
+    Route("/user/{user_id}/roles/{role}", revoke_role, methods=["DELETE"]),
+]
@@ -0,0 +1,24 @@
+from flask import Blueprint, make_response
+
+import metrics
+
+routes = Blueprint("metrics", __name__)
+
+
+@routes.route("/metrics", methods=["GET"])
+def get_metrics():
+    """get_metrics
+    ---
+    get:
+      description: get_metrics
+      summary: Prometheus metrics of all workers
+      responses:
+        200:
+          description: Metrics in the Prometheus text format
+      tags:
+        - metrics
+    """
+    data, content_type = metrics.render()
+    resp = make_response(data)
+    resp.headers["Content-Type"] = content_type
+    return resp
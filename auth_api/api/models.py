@@ -1,7 +1,7 @@
+import base64
 import datetime
 from typing import Optional
 
-from flask import current_app
 from pydantic import BaseModel, EmailStr, Field, SecretStr, root_validator, validator
 
 
@@ -44,6 +44,23 @@ class UserInfoOut(BaseModel):
     roles: list
 
 
+class RoleIn(BaseModel):
+    name: str = Field(min_length=1, max_length=80, regex=r"^[\w.-]+$")
+    description: Optional[str] = Field(max_length=255)
+
+
+class RoleOut(BaseModel):
+    name: str
+    description: Optional[str]
+
+    class Config:
+        orm_mode = True
+
+
+class RolesOut(BaseModel):
+    roles: list[RoleOut]
+
+
 class UserLoginRecord(BaseModel):
     user_agent: str
     platform: Optional[str]
@@ -54,6 +71,37 @@ class UserLoginRecord(BaseModel):
 
 class UserLoginRecordsOut(BaseModel):
     logins: list[UserLoginRecord]
+    next_cursor: Optional[str]
+
+
+class LoginHistoryCursor(BaseModel):
+    """Position after the last returned record, opaque for clients."""
+
+    timestamp: datetime.datetime
+    id: int
+
+    def encode(self) -> str:
+        return base64.urlsafe_b64encode(self.json().encode()).decode()
+
+    @classmethod
+    def decode(cls, value: str) -> "LoginHistoryCursor":
+        return cls.parse_raw(base64.urlsafe_b64decode(value.encode()))
+
+
+class LoginHistoryQuery(BaseModel):
+    limit: int = Field(default=20, ge=1, le=100)
+    cursor: Optional[LoginHistoryCursor]
+    since: Optional[datetime.datetime]
+    until: Optional[datetime.datetime]
+
+    @validator("cursor", pre=True)
+    def decode_cursor(cls, v):
+        if isinstance(v, str):
+            try:
+                return LoginHistoryCursor.decode(v)
+            except ValueError:
+                raise ValueError("invalid cursor")
+        return v
 
 
 class TokenInPassword(BaseModel):
@@ -69,6 +117,25 @@ class TokenGrantOut(BaseModel):
     access_token: str
     refresh_token: str
     token_type: str = "bearer"
-    expires: int = Field(
-        default_factory=lambda: current_app.config["JWT_ACCESS_TOKEN_EXPIRES"]
-    )
+    expires: int
+
+
+class IntrospectIn(BaseModel):
+    tokens: list[str] = Field(min_items=1)
+
+
+class IntrospectionResult(BaseModel):
+    """RFC 7662 response for one token, only active is set for inactive ones."""
+
+    active: bool
+    token_type: Optional[str]
+    sub: Optional[str]
+    username: Optional[str]
+    jti: Optional[str]
+    exp: Optional[int]
+    iat: Optional[int]
+    roles: Optional[list[str]]
+
+
+class IntrospectOut(BaseModel):
+    results: list[IntrospectionResult]
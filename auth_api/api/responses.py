@@ -0,0 +1,82 @@
+"""
+JSON responses of the API models.
+
+Handlers fill the response models with data the service produced itself, so
+the models are made with construct() and not validated again. orjson renders
+them straight to compact bytes, nested models included, without dict() copies.
+Bodies from COMPRESSION_MIN_SIZE bytes are compressed with br or gzip when the
+client accepts it.
+"""
+
+import datetime
+import gzip
+from typing import Union
+
+import brotli
+import orjson
+from flask import Response, current_app, request
+from pydantic import BaseModel
+from werkzeug.http import http_date
+
+ENCODINGS = ["br", "gzip"]
+
+
+def _default(value):
+    if isinstance(value, BaseModel):
+        return value.__dict__
+    if isinstance(value, datetime.datetime):
+        # same representation as flask.jsonify
+        return http_date(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _default_exclude_none(value):
+    if isinstance(value, BaseModel):
+        return {name: item for name, item in value.__dict__.items() if item is not None}
+    return _default(value)
+
+
+def render(content: Union[BaseModel, dict, list], exclude_none: bool = False) -> bytes:
+    return orjson.dumps(
+        content,
+        default=_default_exclude_none if exclude_none else _default,
+        # orjson would write ISO 8601 itself
+        option=orjson.OPT_PASSTHROUGH_DATETIME,
+    )
+
+
+def json_response(
+    content: Union[BaseModel, dict, list], status: int = 200, exclude_none: bool = False
+) -> Response:
+    return Response(
+        render(content, exclude_none), status=status, mimetype="application/json"
+    )
+
+
+def compress(body: bytes, encoding: str, level: int) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=level)
+    return gzip.compress(body, compresslevel=level)
+
+
+def compress_response(response: Response) -> Response:
+    """after_request hook: compress large JSON bodies the client accepts compressed."""
+    if (
+        response.direct_passthrough
+        or response.mimetype != "application/json"
+        or "Content-Encoding" in response.headers
+        # the ETag is of the uncompressed representation
+        or "ETag" in response.headers
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    if len(body) < current_app.config["COMPRESSION_MIN_SIZE"]:
+        return response
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if encoding is None:
+        return response
+    levels = current_app.config["COMPRESSION_LEVELS"]
+    response.set_data(compress(body, encoding, levels[encoding]))
+    response.headers["Content-Encoding"] = encoding
+    return response
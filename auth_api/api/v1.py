@@ -1,11 +1,24 @@
+import hmac
 import logging
 
-from flask import Blueprint, jsonify, make_response, request, url_for
+from flask import Blueprint, current_app, make_response, request, url_for
 from flask_jwt_extended import current_user, get_jwt, jwt_required
-from werkzeug.exceptions import Forbidden
+from werkzeug.exceptions import BadRequest, Forbidden, NotFound
 
 import auth
+import rate_limit
+import revocation
+import roles
+import tokens
+import user_cache
 from api.models import (
+    IntrospectIn,
+    IntrospectionResult,
+    IntrospectOut,
+    LoginHistoryQuery,
+    RoleIn,
+    RoleOut,
+    RolesOut,
     TokenGrantOut,
     TokenInPassword,
     UserIn,
@@ -13,8 +26,12 @@ from api.models import (
     UserLoginRecordsOut,
     UserPatchIn,
 )
+from api.responses import json_response
+from config import config
+from exceptions import AuthenticationError
+from permissions import ADMIN_ROLE, roles_required
 from storage import db
-from storage.db_models import LoginRecord
+from storage.db_models import LoginRecord, User
 from utils import parse_obj_raise
 
 logger = logging.getLogger(__name__)
@@ -49,11 +66,14 @@ def create_user():
               schema: UserInfoOut
         409:
           description: Conflict
+        429:
+          description: Too many requests
       tags:
         - user
     """
     logger.debug("registration")
     user_data = parse_obj_raise(UserIn, request.get_json())
+    rate_limit.check("register", ip=request.remote_addr)
     logger.info(f"user with email: {user_data.email}")
     user = auth.create_user(user_data.email, user_data.password.get_secret_value())
     resp = make_response("Created", 201)
@@ -95,13 +115,15 @@ def get_user_info(user_id):
 
     if str(current_user.id) != user_id:
         raise Forbidden
-    return UserInfoOut(
-        id=str(current_user.id),
-        email=current_user.email,
-        registered_at=current_user.registered_at,
-        active=current_user.active,
-        roles=[role.name for role in current_user.roles],
-    ).dict()
+    return json_response(
+        UserInfoOut.construct(
+            id=str(current_user.id),
+            email=current_user.email,
+            registered_at=current_user.registered_at,
+            active=current_user.active,
+            roles=list(current_user.roles),
+        )
+    )
 
 
 @routes.route("/user/<string:user_id>", methods=["PATCH"])
@@ -141,14 +163,20 @@ def change_user_info(user_id):
 
     patch_data = parse_obj_raise(UserPatchIn, request.get_json())
 
+    # current_user is a cached snapshot, changes go to the db row
+    user = User.get_by_id(current_user.id)
     if patch_data.email:
-        current_user.email = patch_data.email
+        user.email = patch_data.email
     if patch_data.new_password_1:
-        current_user.hashed_password = auth.hash_password(
+        user.hashed_password = auth.hash_password(
             patch_data.new_password_1.get_secret_value()
         )
-    db.session.add(current_user)
+    db.session.add(user)
     db.session.commit()
+    user_cache.invalidate(user.id)
+    if patch_data.new_password_1:
+        revocation.revoke_user_tokens(user.id)
+        revocation.revoke_token(get_jwt())
     return "OK", 200
 
 
@@ -168,10 +196,35 @@ def get_login_history(user_id):
         description: user_id
         schema:
           type: string
+      - name: limit
+        in: query
+        description: page size
+        schema:
+          type: integer
+          default: 20
+          minimum: 1
+          maximum: 100
+      - name: cursor
+        in: query
+        description: next_cursor from the previous page
+        schema:
+          type: string
+      - name: since
+        in: query
+        description: only logins at or after this time
+        schema:
+          type: string
+          format: date-time
+      - name: until
+        in: query
+        description: only logins before this time
+        schema:
+          type: string
+          format: date-time
 
       responses:
         200:
-          description: Return login history
+          description: Return login history, newest first
           content:
             application/json:
               schema: UserLoginRecordsOut
@@ -187,9 +240,22 @@ def get_login_history(user_id):
     if str(current_user.id) != user_id:
         raise Forbidden
 
-    records = db.session.query(LoginRecord).all()
+    query = parse_obj_raise(LoginHistoryQuery, request.args.to_dict())
+    records = LoginRecord.get_user_history(
+        current_user.id,
+        query.limit + 1,
+        after=query.cursor,
+        since=query.since,
+        until=query.until,
+    )
+    next_cursor = None
+    if len(records) > query.limit:
+        records = records[: query.limit]
+        next_cursor = records[-1].to_cursor().encode()
     login_records = [record.to_api_model() for record in records]
-    return UserLoginRecordsOut(logins=login_records).dict()
+    return json_response(
+        UserLoginRecordsOut.construct(logins=login_records, next_cursor=next_cursor)
+    )
 
 
 @routes.route("/token", methods=["POST"])
@@ -212,6 +278,8 @@ def create_token_pair():
               schema: TokenGrantOut
         400:
           description: Access error
+        429:
+          description: Too many requests
       tags:
         - token
     """
@@ -219,15 +287,20 @@ def create_token_pair():
 
     # получение токена
     token_data = parse_obj_raise(TokenInPassword, request.get_json())
+    rate_limit.check("token", ip=request.remote_addr, email=token_data.email)
 
     user = auth.authenticate_with_email(
         token_data.email, token_data.password.get_secret_value()
     )
     access_token, refresh_token = auth.issue_tokens(
-        user, request.user_agent, request.remote_addr
+        user, request.headers.get("User-Agent", ""), request.remote_addr
     )
-    return jsonify(
-        TokenGrantOut(access_token=access_token, refresh_token=refresh_token).dict()
+    return json_response(
+        TokenGrantOut.construct(
+            access_token=access_token,
+            refresh_token=refresh_token,
+            expires=tokens.access_expires,
+        )
     )
 
 
@@ -255,8 +328,12 @@ def update_token_pair():
     logger.debug("update token pair")
     token_data = get_jwt()
     access_token, refresh_token = auth.refresh_tokens(current_user, token_data)
-    return jsonify(
-        TokenGrantOut(access_token=access_token, refresh_token=refresh_token).dict()
+    return json_response(
+        TokenGrantOut.construct(
+            access_token=access_token,
+            refresh_token=refresh_token,
+            expires=tokens.access_expires,
+        )
     )
 
 
@@ -289,6 +366,195 @@ def revoke_refresh_token():
 
     if request.args.get("all") == "true":
         auth.logout_all_user_devices(current_user)
+        revocation.revoke_user_tokens(current_user.id)
     else:
-        auth.remove_device_token(current_user, request.user_agent)
+        auth.remove_device_token(current_user, get_jwt())
+    revocation.revoke_token(get_jwt())
+    return "OK", 200
+
+
+@routes.route("/roles", methods=["GET"])
+@roles_required(ADMIN_ROLE)
+def list_roles():
+    """list_roles
+    ---
+    get:
+      description: list_roles
+      summary: List roles
+      security:
+        - jwt_access: []
+      responses:
+        200:
+          description: Ok
+          content:
+            application/json:
+              schema: RolesOut
+        401:
+          description: Unauthorized
+        403:
+          description: Forbidden
+      tags:
+        - role
+    """
+    return json_response(
+        RolesOut.construct(
+            roles=[
+                RoleOut.construct(name=role.name, description=role.description)
+                for role in roles.list_roles()
+            ]
+        )
+    )
+
+
+@routes.route("/roles", methods=["POST"])
+@roles_required(ADMIN_ROLE)
+def create_role():
+    """create_role
+    ---
+    post:
+      description: create_role
+      summary: Create role
+      security:
+        - jwt_access: []
+      requestBody:
+        content:
+          application/json:
+            schema: RoleIn
+
+      responses:
+        201:
+          description: Created
+        401:
+          description: Unauthorized
+        403:
+          description: Forbidden
+        409:
+          description: Conflict
+      tags:
+        - role
+    """
+    role_data = parse_obj_raise(RoleIn, request.get_json())
+    roles.create_role(role_data.name, role_data.description)
+    return "Created", 201
+
+
+@routes.route("/user/<string:user_id>/roles/<string:role>", methods=["PUT"])
+@roles_required(ADMIN_ROLE)
+def grant_role(user_id, role):
+    """grant_role
+    ---
+    put:
+      description: grant_role
+      summary: Grant role to user, refresh tokens of the user stop working
+      security:
+        - jwt_access: []
+      parameters:
+      - name: user_id
+        in: path
+        schema:
+          type: string
+      - name: role
+        in: path
+        schema:
+          type: string
+
+      responses:
+        200:
+          description: OK
+        401:
+          description: Unauthorized
+        403:
+          description: Forbidden
+        404:
+          description: User or role not found
+      tags:
+        - role
+    """
+    roles.grant_role(user_id, role)
     return "OK", 200
+
+
+@routes.route("/user/<string:user_id>/roles/<string:role>", methods=["DELETE"])
+@roles_required(ADMIN_ROLE)
+def revoke_role(user_id, role):
+    """revoke_role
+    ---
+    delete:
+      description: revoke_role
+      summary: Revoke role of user, refresh tokens of the user stop working
+      security:
+        - jwt_access: []
+      parameters:
+      - name: user_id
+        in: path
+        schema:
+          type: string
+      - name: role
+        in: path
+        schema:
+          type: string
+
+      responses:
+        200:
+          description: OK
+        401:
+          description: Unauthorized
+        403:
+          description: Forbidden
+        404:
+          description: User or role not found
+      tags:
+        - role
+    """
+    roles.revoke_role(user_id, role)
+    return "OK", 200
+
+
+@routes.route("/introspect", methods=["POST"])
+def introspect_tokens():
+    """introspect_tokens
+    ---
+    post:
+      description: introspect_tokens
+      summary: Check a batch of access and refresh tokens
+      security:
+        - introspection_secret: []
+      requestBody:
+        content:
+          'application/json':
+            schema: IntrospectIn
+
+      responses:
+        200:
+          description: Token states in the order of the request
+          content:
+            application/json:
+              schema: IntrospectOut
+        400:
+          description: Too many tokens
+        401:
+          description: Unauthorized
+      tags:
+        - token
+    """
+    logger.debug("introspect tokens")
+
+    if not config.INTROSPECTION_SECRET:
+        raise NotFound
+    scheme, _, secret = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(
+        secret.encode(), config.INTROSPECTION_SECRET.encode()
+    ):
+        raise AuthenticationError
+
+    data = parse_obj_raise(IntrospectIn, request.get_json())
+    max_tokens = current_app.config["INTROSPECTION_MAX_TOKENS"]
+    if len(data.tokens) > max_tokens:
+        raise BadRequest(description=f"At most {max_tokens} tokens per request")
+    results = auth.introspect_tokens(data.tokens)
+    return json_response(
+        IntrospectOut.construct(
+            results=[IntrospectionResult.construct(**result) for result in results]
+        ),
+        exclude_none=True,
+    )
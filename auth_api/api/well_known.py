@@ -0,0 +1,29 @@
+from flask import Blueprint, current_app, make_response, request
+
+import jwt_keys
+
+routes = Blueprint("well_known", __name__, url_prefix="/.well-known")
+
+
+@routes.route("/jwks.json", methods=["GET"])
+def get_jwks():
+    """get_jwks
+    ---
+    get:
+      description: get_jwks
+      summary: Public keys for verifying issued tokens, RFC 7517
+      responses:
+        200:
+          description: JSON Web Key Set
+        304:
+          description: Not modified
+      tags:
+        - token
+    """
+    keyring = jwt_keys.current()
+    resp = make_response(keyring.jwks)
+    resp.mimetype = "application/json"
+    resp.set_etag(keyring.jwks_etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = current_app.config["JWKS_MAX_AGE"]
+    return resp.make_conditional(request)
@@ -1,15 +1,33 @@
 import logging
+import time
 
-from flask import Flask, jsonify
+import redis
+from flask import Flask, g, jsonify, request
 from flask_jwt_extended import JWTManager
 from flask_swagger_ui import get_swaggerui_blueprint
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 
+import api.metrics
+import api.responses
 import api.v1
+import api.well_known
 import default_config
+import hashing
+import jobs
+import jwt_keys
+import login_history
+import metrics
+import permissions
+import rate_limit
+import revocation
+import token_compactor
 import token_store
+import tokens
+import user_cache
 from config import config
-from storage import db
-from storage.db_models import User
+from exceptions import ServiceBusyError
+from storage import db, partitions
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +41,8 @@ def create_app():
     )
 
     app.register_blueprint(api.v1.routes)
+    app.register_blueprint(api.well_known.routes)
+    app.register_blueprint(api.metrics.routes)
 
     SWAGGER_URL = "/swagger"
     API_URL = "/static/swagger.json"
@@ -38,9 +58,33 @@ def create_app():
         return jsonify(get_api_spec().to_dict())
         # return send_file(, mimetype='application/json')
 
-    @app.before_first_request
-    def startup():
-        db.init_db()
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.before_request
+    def route_reads():
+        db.allow_replica_reads(
+            request.endpoint not in app.config["DB_PRIMARY_ENDPOINTS"]
+        )
+
+    @app.after_request
+    def observe_request(response):
+        if "request_started" in g:
+            metrics.observe_request(
+                request.endpoint,
+                request.method,
+                response.status_code,
+                g.request_started,
+            )
+        return response
+
+    app.after_request(api.responses.compress_response)
+
+    @app.errorhandler(PoolTimeoutError)
+    def pool_timeout_handler(_e):
+        # every connection of the worker is busy
+        return ServiceBusyError().get_response()
 
     @app.teardown_appcontext
     def after_request(response):
@@ -48,29 +92,132 @@ def create_app():
         return response
 
     jwt = JWTManager(app)
-    redis_host, redis_port = app.config["REDIS_SOCKET"].split(":")
-    token_store.init(redis_host, redis_port, app.config["JWT_REFRESH_TOKEN_EXPIRES"])
+    jwt_keys.init(app.config["JWT_ALGORITHM"])
+    jobs.run_periodically(
+        "reload-jwt-keys", app.config["KEYRING_REFRESH_INTERVAL"], jwt_keys.reload
+    )
+    tokens.init(
+        app.config["JWT_ACCESS_TOKEN_EXPIRES"], app.config["JWT_REFRESH_TOKEN_EXPIRES"]
+    )
+    token_store.init(
+        app.config["REDIS_SOCKET"], app.config["JWT_REFRESH_TOKEN_EXPIRES"]
+    )
+    rate_limit.init(token_store.client, app.config["RATE_LIMITS"])
+    hashing.init(
+        app.config["PASSWORD_HASH_WORKERS"],
+        app.config["PASSWORD_HASH_QUEUE_SIZE"],
+        (
+            app.config["ARGON2_TIME_COST"],
+            app.config["ARGON2_MEMORY_COST"],
+            app.config["ARGON2_PARALLELISM"],
+        ),
+    )
+    user_cache.init(
+        token_store.client, app.config["USER_CACHE_SIZE"], app.config["USER_CACHE_TTL"]
+    )
+    revocation.init(
+        token_store.client,
+        app.config["JWT_ACCESS_TOKEN_EXPIRES"],
+        app.config["REVOCATION_BLOOM_CAPACITY"],
+        app.config["REVOCATION_BLOOM_ERROR_RATE"],
+        app.config["REVOCATION_RESYNC_INTERVAL"],
+    )
+    if app.config["LOGIN_HISTORY_WRITE_BEHIND"]:
+        login_history.init(
+            app.config["LOGIN_HISTORY_QUEUE_SIZE"],
+            app.config["LOGIN_HISTORY_BATCH_SIZE"],
+            app.config["LOGIN_HISTORY_FLUSH_INTERVAL"],
+            app.config["LOGIN_HISTORY_PUT_TIMEOUT"],
+        )
+
+    jobs.run_periodically(
+        "pool-gauges",
+        app.config["METRICS_POOL_GAUGES_INTERVAL"],
+        lambda: metrics.set_pool_gauges(db.pool_stats(), token_store.pool_stats()),
+    )
+
+    if db.replicas:
+        jobs.in_background(db.check_replicas)
+        jobs.run_periodically(
+            "replica-lag", app.config["DB_REPLICA_CHECK_INTERVAL"], db.check_replicas
+        )
+
+    partitions_interval = app.config["LOGIN_HISTORY_PARTITION_MAINTENANCE_INTERVAL"]
+    if partitions_interval and partitions.is_supported():
+        jobs.run_periodically(
+            "login-history-partitions",
+            partitions_interval,
+            lambda: partitions.maintain(
+                app.config["LOGIN_HISTORY_PARTITIONS_AHEAD"],
+                app.config["LOGIN_HISTORY_RETENTION_MONTHS"],
+                app.config["LOGIN_HISTORY_DETACH_EXPIRED"],
+            ),
+        )
+
+    compaction_interval = app.config["DEVICE_TOKENS_COMPACTION_INTERVAL"]
+    if compaction_interval:
+        jobs.run_periodically(
+            "compact-device-tokens",
+            compaction_interval,
+            lambda: token_compactor.compact_exclusive(
+                app.config["DEVICE_TOKENS_COMPACTION_BATCH_SIZE"],
+                app.config["DEVICE_TOKENS_COMPACTION_MAX_KEYS_PER_SECOND"],
+                compaction_interval,
+            ),
+        )
 
     @jwt.user_identity_loader
     def user_identity_callback(user):
         return user.id
 
+    @jwt.decode_key_loader
+    def decode_key_callback(jwt_header, _jwt_payload):
+        return jwt_keys.verification_key(jwt_header.get("kid"))
+
     @jwt.user_lookup_loader
     def user_lookup_callback(_jwt_header, jwt_data):
+        if g.get("user_from_claims"):
+            return permissions.ClaimsUser.from_claims(jwt_data)
         identity = jwt_data["sub"]
-        return db.session.query(User).filter_by(id=identity).one_or_none()
+        return user_cache.get(identity)
 
     @jwt.token_in_blocklist_loader
     def token_in_blocklist_callback(_jwt_header, jwt_payload):
         if jwt_payload.get("type") == "access":
-            return False
+            return revocation.is_revoked(jwt_payload)
 
-        jti = jwt_payload.get("jti")
-        return not token_store.does_refresh_token_exist(jti)
+        return not token_store.does_refresh_token_exist(
+            jwt_payload["sub"],
+            token_store.token_device_fields(jwt_payload),
+            jwt_payload["jti"],
+        )
 
     app.cli = commands.cli
 
     return app
 
 
+def release_connections():
+    """In the gunicorn master that preloaded the app, before forking workers."""
+    db.release_connections()
+    token_store.release_connections()
+
+
+def start_worker(app: Flask):
+    """
+    In a forked worker: start the background work held back by the preloaded
+    app and open pool connections before the first requests.
+    """
+    jobs.start_background_work()
+    connections = app.config["POOL_WARM_UP_CONNECTIONS"]
+    if not connections:
+        return
+    try:
+        db.warm_up(connections)
+        token_store.warm_up(connections)
+    except (SQLAlchemyError, redis.RedisError) as e:
+        # the pools connect on demand then
+        logger.warning(f"pools are not warmed up: {e!r}")
+
+
 import commands  # noqa E402
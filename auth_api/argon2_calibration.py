@@ -0,0 +1,76 @@
+"""
+Argon2 cost for the hardware it runs on: the largest memory_cost fitting the
+memory budget of a worker when all of its hashing threads are busy, and the
+largest time_cost keeping one verification within the target latency. If no
+time_cost fits, memory_cost is halved down to MIN_MEMORY_COST.
+
+Run it on the production hardware without other load.
+"""
+
+import statistics
+import time
+from dataclasses import dataclass
+
+from passlib.hash import argon2
+
+# KiB, the OWASP minimum for argon2id
+MIN_MEMORY_COST = 19 * 1024
+MAX_TIME_COST = 10
+PASSWORD = "calibration-password"
+
+
+@dataclass
+class Measurement:
+    time_cost: int
+    memory_cost: int
+    parallelism: int
+    seconds: float
+
+    def __str__(self):
+        return (
+            f"time_cost={self.time_cost} memory_cost={self.memory_cost // 1024}MiB "
+            f"parallelism={self.parallelism}: {self.seconds * 1000:.1f}ms"
+        )
+
+
+def measure(
+    time_cost: int, memory_cost: int, parallelism: int, samples: int
+) -> Measurement:
+    """Median time of a verification."""
+    hasher = argon2.using(
+        time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism
+    )
+    hashed = hasher.hash(PASSWORD)
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        hasher.verify(PASSWORD, hashed)
+        timings.append(time.perf_counter() - started)
+    return Measurement(time_cost, memory_cost, parallelism, statistics.median(timings))
+
+
+def calibrate(
+    target: float,
+    memory_budget: int,
+    threads: int,
+    parallelism: int = 1,
+    samples: int = 5,
+    report=print,
+) -> Measurement:
+    """target in seconds, memory_budget in KiB for all threads of a worker."""
+    # whole MiB, at least 8 KiB per lane as argon2 requires
+    memory_cost = max(memory_budget // threads // 1024 * 1024, 8 * parallelism)
+    while True:
+        fitting = None
+        for time_cost in range(1, MAX_TIME_COST + 1):
+            measurement = measure(time_cost, memory_cost, parallelism, samples)
+            report(measurement)
+            if measurement.seconds > target:
+                break
+            fitting = measurement
+        if fitting:
+            return fitting
+        if memory_cost <= MIN_MEMORY_COST:
+            # time_cost=1 is slower than the target already
+            return measurement
+        memory_cost = max(MIN_MEMORY_COST, memory_cost // 2 // 1024 * 1024)
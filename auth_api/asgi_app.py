@@ -0,0 +1,3 @@
+from aio.app import create_app
+
+app = create_app()
@@ -1,24 +1,36 @@
 import logging
+from functools import lru_cache
 from typing import Optional
 
-from flask_jwt_extended import create_access_token, create_refresh_token, decode_token
-from passlib.hash import argon2
+from flask_jwt_extended import decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt import PyJWTError
 from werkzeug.useragents import UserAgent
 
+import hashing
+import login_history
+import revocation
 import token_store
-from exceptions import AlreadyExistsError, PasswordAuthenticationError
+import tokens
+import user_cache
+from exceptions import (
+    AlreadyExistsError,
+    PasswordAuthenticationError,
+    ServiceBusyError,
+    TokenError,
+)
 from storage import db
-from storage.db_models import LoginRecord, User
+from storage.db_models import User
 
 logger = logging.getLogger(__name__)
 
 
 def verify_password(user: User, password: str):
-    return argon2.verify(password, user.hashed_password)
+    return hashing.verify_password(password, user.hashed_password)
 
 
 def hash_password(password: str) -> str:
-    return argon2.hash(password)
+    return hashing.hash_password(password)
 
 
 def create_user(email: str, password: str) -> Optional[User]:
@@ -31,6 +43,7 @@ def create_user(email: str, password: str) -> Optional[User]:
     user = User(email=email, hashed_password=hashed_pass)
     db.session.add(user)
     db.session.commit()
+    user_cache.invalidate(user.id)
     return user
 
 
@@ -42,55 +55,151 @@ def authenticate_with_email(email: str, password: str) -> User:
     if not verify_password(user, password):
         logger.debug("password is not valid")
         raise PasswordAuthenticationError
+    if hashing.needs_update(user.hashed_password):
+        upgrade_password_hash(user, password)
     return user
 
 
-def issue_tokens(user: User, user_agent: UserAgent, ip: str) -> tuple[str, str]:
+def upgrade_password_hash(user: User, password: str):
+    """Rehash with the configured cost, the login goes on if the pool is busy."""
+    try:
+        user.hashed_password = hash_password(password)
+    except ServiceBusyError:
+        return
+    db.session.commit()
+    logger.debug(f"password hash of {user.id} is upgraded")
+
+
+def issue_tokens(user: User, user_agent: str, ip: str) -> tuple[str, str]:
     device_id = token_store.user_agent_to_device_id(user_agent)
-    access_token = create_access_token(user, additional_claims={"device": device_id})
-    refresh_token = create_refresh_token(user, additional_claims={"device": device_id})
-    token_data = decode_token(refresh_token)
+    roles = [role.name for role in user.roles]
+    pair = tokens.mint_pair(
+        user.id,
+        {
+            token_store.DEVICE_CLAIM: device_id,
+            **tokens.role_claims(roles, user.roles_version),
+        },
+    )
     token_store.replace_refresh_token(
-        token_data["jti"], token_data["sub"], token_data["device"]
+        pair.refresh_jti, str(user.id), token_store.device_fields(device_id)
     )
 
     # save login in history
-    browser_string = user_agent.browser
-    if user_agent.version:
-        browser_string = f"{browser_string}-{user_agent.version}"
-    record = LoginRecord(
-        user_id=user.id,
+    login_history.record(**login_record(user.id, user_agent, ip))
+
+    return pair.access_token, pair.refresh_token
+
+
+@lru_cache(maxsize=token_store.USER_AGENT_CACHE_SIZE)
+def parse_user_agent(user_agent: str) -> tuple[Optional[str], Optional[str]]:
+    """Platform and browser-version, parsed once per distinct User-Agent."""
+    parsed = UserAgent(user_agent)
+    browser_string = parsed.browser
+    if parsed.version:
+        browser_string = f"{browser_string}-{parsed.version}"
+    return parsed.platform, browser_string
+
+
+def login_record(user_id, user_agent: str, ip: str) -> dict:
+    platform, browser_string = parse_user_agent(user_agent)
+    return dict(
+        user_id=user_id,
         ip=ip,
-        user_agent=user_agent.string,
-        platform=user_agent.platform,
+        user_agent=user_agent,
+        platform=platform,
         browser=browser_string,
     )
-    db.session.add(record)
-    db.session.commit()
 
-    return access_token, refresh_token
+
+def check_roles_version(user: user_cache.UserSnapshot, token_data: dict):
+    if token_data.get("rv", 0) < user.roles_version:
+        logger.info(f"refresh token with stale roles: {token_data['jti']=}, {user=}")
+        raise TokenError("invalid_grant", "Roles of the user have changed")
 
 
-def refresh_tokens(user: User, token_data: dict) -> tuple[str, str]:
+def refresh_tokens(user: user_cache.UserSnapshot, token_data: dict) -> tuple[str, str]:
     logger.debug(f"refresh_tokens: {token_data=}, {user=}")
+    check_roles_version(user, token_data)
 
-    device_id = token_data["device"]
+    fields = token_store.token_device_fields(token_data)
 
-    access_token = create_access_token(user, additional_claims={"device": device_id})
-    refresh_token = create_refresh_token(user, additional_claims={"device": device_id})
-    new_token_jti = decode_token(refresh_token)["jti"]
+    pair = tokens.mint_pair(
+        user.id,
+        {
+            token_store.DEVICE_CLAIM: fields[0],
+            **tokens.role_claims(user.roles, user.roles_version),
+        },
+    )
 
-    token_store.replace_refresh_token(
-        new_token_jti, token_data["sub"], token_data["device"]
+    rotated = token_store.replace_refresh_token(
+        pair.refresh_jti, token_data["sub"], fields, token_data["jti"]
     )
+    if not rotated:
+        logger.warning(f"refresh token reuse: {token_data['jti']=}, {user=}")
+        raise TokenError("invalid_grant", "Refresh token has already been used")
 
-    return access_token, refresh_token
+    return pair.access_token, pair.refresh_token
 
 
 def logout_all_user_devices(user: User):
     token_store.remove_all_user_refresh_tokens(user.id)
 
 
-def remove_device_token(user: User, user_agent: UserAgent):
-    device_id = token_store.user_agent_to_device_id(user_agent)
-    token_store.remove_refresh_token(user.id, device_id)
+def remove_device_token(user: User, token_data: dict):
+    """Log out the device the presented token was issued to."""
+    token_store.remove_refresh_token(
+        user.id, token_store.token_device_fields(token_data)
+    )
+
+
+def introspect_tokens(encoded_tokens: list[str]) -> list[dict]:
+    """
+    RFC 7662 style state of every token. Refresh tokens are checked with one
+    redis pipeline and users not in the cache are loaded with one query.
+    """
+    payloads = []
+    for encoded in encoded_tokens:
+        try:
+            payloads.append(decode_token(encoded))
+        except (PyJWTError, JWTExtendedException) as e:
+            logger.debug(f"introspected token is invalid: {e!r}")
+            payloads.append(None)
+
+    refresh_tokens = [
+        (p["sub"], token_store.token_device_fields(p), p["jti"])
+        for p in payloads
+        if p and p["type"] == "refresh"
+    ]
+    stored = iter(
+        token_store.refresh_tokens_exist(refresh_tokens) if refresh_tokens else []
+    )
+    users = user_cache.get_many(p["sub"] for p in payloads if p)
+
+    results = []
+    for payload in payloads:
+        if payload is None:
+            results.append({"active": False})
+            continue
+        if payload["type"] == "refresh":
+            active = next(stored)
+        else:
+            active = not revocation.is_revoked(payload)
+        results.append(introspection_result(payload, active, users[payload["sub"]]))
+    return results
+
+
+def introspection_result(
+    payload: dict, active: bool, user: Optional[user_cache.UserSnapshot]
+) -> dict:
+    if not (active and user and user.active):
+        return {"active": False}
+    return {
+        "active": True,
+        "token_type": payload["type"],
+        "sub": payload["sub"],
+        "username": user.email,
+        "jti": payload["jti"],
+        "exp": payload["exp"],
+        "iat": payload["iat"],
+        "roles": list(user.roles),
+    }
@@ -0,0 +1,109 @@
+"""
+Circuit breaker for calls to a shared dependency.
+
+After failure_threshold consecutive failures the circuit opens and calls fail
+fast for reset_timeout seconds. Then one trial call is let through: success
+closes the circuit, failure opens it again.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Type
+
+from exceptions import StorageUnavailableError
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int,
+        reset_timeout: float,
+        errors: tuple[Type[BaseException], ...],
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.errors = errors
+        self.state = CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if (
+                self.state == OPEN
+                and time.monotonic() - self.opened_at >= self.reset_timeout
+            ):
+                self.state = HALF_OPEN
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info(f"{self.name} circuit closed")
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    logger.error(
+                        f"{self.name} circuit opened after {self.failures} failures"
+                    )
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def release_trial(self):
+        """Let another call be the trial, the interrupted one told nothing."""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+
+    def retry_after(self) -> int:
+        remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+        return max(1, round(remaining))
+
+    @contextmanager
+    def guard(self):
+        """Fail with StorageUnavailableError while open or when the call fails."""
+        if not self.allow():
+            raise StorageUnavailableError(self.retry_after())
+        try:
+            yield
+        except self.errors as e:
+            self.record_failure()
+            raise StorageUnavailableError(self.retry_after()) from e
+        except Exception:
+            # the dependency answered, with an error of the caller
+            self.record_success()
+            raise
+        except BaseException:
+            # gevent.Timeout, GreenletExit of a killed greenlet and the like
+            self.release_trial()
+            raise
+        else:
+            self.record_success()
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "rejected": self.rejected,
+        }
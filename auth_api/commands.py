@@ -1,18 +1,31 @@
+import os
+
 import click
+from flask import current_app
 from flask.cli import AppGroup, with_appcontext
-from sqlalchemy_utils import create_database, database_exists
 
 import auth
-from openapi_spec import get_api_spec
-from storage import db
-from storage.db import Base, engine
+import jwt_keys
+import roles
+import token_compactor
+from config import config
+from storage import db, partitions
+from storage.db import engine
+from storage.db_models import Role, SigningKey, User
 
+# modules only some commands need are imported by them, this one is imported
+# by every worker
 cli = AppGroup()
+keys_cli = AppGroup("keys", help="Manage JWT signing keys")
+cli.add_command(keys_cli)
 
 
 @cli.command("initdb")
 @with_appcontext
 def initdb():
+    """Create the database if needed and migrate it, once per deploy."""
+    from sqlalchemy_utils import create_database, database_exists
+
     if not database_exists(engine.url):
         print(f"creating database: {engine.url}")
         create_database(engine.url)
@@ -27,14 +40,192 @@ def create_user(name, password):
     auth.create_user(name, password)
 
 
+@cli.command("grant-role")
+@click.argument("email")
+@click.argument("role")
+@with_appcontext
+def grant_role(email, role):
+    """Grant a role to the user, creating the role if needed."""
+    user = User.get_user_universal(email)
+    if user is None:
+        raise click.ClickException(f"user {email} not found")
+    if Role.get_by_name(role) is None:
+        roles.create_role(role)
+    roles.grant_role(user.id, role)
+
+
+@cli.command("import-users")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(["csv", "jsonl"]),
+    help="Defaults to the file extension",
+)
+@click.option("--batch-size", default=1000, show_default=True)
+@click.option("--workers", type=int, help="Hashing processes, defaults to cores")
+@click.option("--resume", is_flag=True, help="Skip records imported by a last run")
+@click.option("--rejects", help="Defaults to PATH.rejected.jsonl")
+@with_appcontext
+def import_users(path, file_format, batch_size, workers, resume, rejects):
+    """
+    Import users from CSV or JSONL with email and password or hashed_password.
+    """
+    import user_import
+
+    file_format = file_format or ("csv" if path.endswith(".csv") else "jsonl")
+    state_path = f"{path}.import-state"
+    skip = user_import.load_state(state_path) if resume else 0
+    if skip:
+        print(f"resuming after {skip} records")
+    with open(path, newline="") as file, open(
+        rejects or f"{path}.rejected.jsonl", "a" if resume else "w"
+    ) as rejects_file:
+        importer = user_import.Importer(rejects_file, batch_size, workers)
+        progress = importer.run(
+            user_import.read_records(file, file_format),
+            state_path,
+            skip,
+            report=lambda line: click.echo(line, err=True),
+        )
+    print(progress)
+
+
+@cli.command("calibrate-argon2")
+@click.option("--target-ms", default=50.0, show_default=True, help="One verification")
+@click.option(
+    "--memory-budget-mb",
+    default=512,
+    show_default=True,
+    help="Memory of a worker for the hashes computed at once",
+)
+@click.option("--threads", type=int, help="Defaults to PASSWORD_HASH_WORKERS")
+@click.option(
+    "--parallelism",
+    default=1,
+    show_default=True,
+    help="Lanes of a hash, every core already runs its own hash under load",
+)
+@click.option("--samples", default=5, show_default=True)
+@with_appcontext
+def calibrate_argon2(target_ms, memory_budget_mb, threads, parallelism, samples):
+    """Pick ARGON2_* settings for this hardware."""
+    import argon2_calibration
+
+    threads = threads or current_app.config["PASSWORD_HASH_WORKERS"] or os.cpu_count()
+    chosen = argon2_calibration.calibrate(
+        target_ms / 1000, memory_budget_mb * 1024, threads, parallelism, samples
+    )
+    if chosen.seconds * 1000 > target_ms:
+        print(f"even the minimal cost is slower than {target_ms}ms")
+    print(f"chosen for {threads} hashing threads: {chosen}")
+    print(f"ARGON2_TIME_COST={chosen.time_cost}")
+    print(f"ARGON2_MEMORY_COST={chosen.memory_cost}")
+    print(f"ARGON2_PARALLELISM={chosen.parallelism}")
+
+
 @cli.command("cleanup")
 @with_appcontext
 def cleanup():
+    from sqlalchemy_utils import database_exists
+
     if database_exists(engine.url):
-        Base.metadata.drop_all(engine)
+        db.drop_all()
+
+
+@cli.command("compact-device-tokens")
+@click.option("--batch-size", default=500, show_default=True)
+@click.option(
+    "--max-keys-per-second", default=0, help="Throttle for a hot redis, 0 - no limit"
+)
+@click.option("--dry-run", is_flag=True, help="Only report what would be removed")
+@with_appcontext
+def compact_device_tokens(batch_size, max_keys_per_second, dry_run):
+    print(token_compactor.compact(batch_size, max_keys_per_second, dry_run))
+
+
+@cli.command("migrate-device-tokens")
+@click.option("--batch-size", default=500, show_default=True)
+@click.option("--dry-run", is_flag=True, help="Only report the legacy sessions")
+@with_appcontext
+def migrate_device_tokens(batch_size, dry_run):
+    """Move refresh tokens to device fingerprints, report bytes per session."""
+    import token_migration
+
+    print(token_migration.migrate(batch_size, dry_run))
+
+
+@cli.command("maintain-login-partitions")
+@click.option(
+    "--ahead", default=config.LOGIN_HISTORY_PARTITIONS_AHEAD, show_default=True
+)
+@click.option(
+    "--retention-months",
+    default=config.LOGIN_HISTORY_RETENTION_MONTHS,
+    show_default=True,
+)
+@click.option(
+    "--detach",
+    is_flag=True,
+    default=config.LOGIN_HISTORY_DETACH_EXPIRED,
+    help="Detach expired partitions instead of dropping them",
+)
+@with_appcontext
+def maintain_login_partitions(ahead, retention_months, detach):
+    created, removed = partitions.maintain(ahead, retention_months, detach)
+    print(f"created: {created}, {'detached' if detach else 'dropped'}: {removed}")
+
+
+@cli.command("partition-login-history")
+@with_appcontext
+def partition_login_history():
+    copied = partitions.convert_legacy_table(config.LOGIN_HISTORY_PARTITIONS_AHEAD)
+    print(f"copied {copied} login records into partitions")
+
+
+@keys_cli.command("list")
+@with_appcontext
+def list_keys():
+    for key in db.session.query(SigningKey).order_by(SigningKey.created_at):
+        state = "active" if key.active else "verify" if not key.private_key else "new"
+        print(f"{key.kid}\t{key.algorithm}\t{state}\t{key.created_at.isoformat()}")
+
+
+@keys_cli.command("generate")
+@click.option(
+    "--algorithm",
+    type=click.Choice(jwt_keys.SUPPORTED_ALGORITHMS),
+    help="Defaults to JWT_ALGORITHM",
+)
+@with_appcontext
+def generate_key(algorithm):
+    key = jwt_keys.generate(algorithm or current_app.config["JWT_ALGORITHM"])
+    print(key.kid)
+
+
+@keys_cli.command("activate")
+@click.argument("kid")
+@with_appcontext
+def activate_key(kid):
+    try:
+        jwt_keys.activate(kid)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+
+@keys_cli.command("remove")
+@click.argument("kid")
+@with_appcontext
+def remove_key(kid):
+    try:
+        jwt_keys.remove(kid)
+    except ValueError as e:
+        raise click.ClickException(str(e))
 
 
 @cli.command("showapi")
 @with_appcontext
 def showapi():
+    from openapi_spec import get_api_spec
+
     print(get_api_spec().to_yaml())
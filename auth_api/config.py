@@ -1,15 +1,85 @@
-from pydantic import BaseSettings
+from typing import Optional
+
+from pydantic import BaseSettings, validator
+
+REDIS_MODES = ("standalone", "sentinel", "cluster")
 
 
 class Settings(BaseSettings):
     LOG_LEVEL: str = "WARNING"
+    # host:port of the redis, or comma separated sentinels or cluster nodes
     REDIS_SOCKET: str = "127.0.0.1:6379"
+    # one of REDIS_MODES
+    REDIS_MODE: str = "standalone"
+    REDIS_SENTINEL_MASTER: str = "mymaster"
     POSTGRES_URI: str = "postgresql://postgres@127.0.0.1:5432/auth"
     DEBUG: bool = False
+
+    # connection pool of every worker process; with gevent one worker serves many
+    # requests at once, so size it for the concurrent queries of a worker
+    POSTGRES_POOL_SIZE: int = 20
+    POSTGRES_MAX_OVERFLOW: int = 10
+    # seconds a request waits for a free connection before failing with 503
+    POSTGRES_POOL_TIMEOUT: float = 5
+    POSTGRES_POOL_PRE_PING: bool = True
+    # seconds, reconnects before a proxy or the server closes idle connections
+    POSTGRES_POOL_RECYCLE: int = 30 * 60
+    # read replicas as a JSON list of URIs, pools are sized like the primary one
+    POSTGRES_REPLICA_URIS: list[str] = []
+    # seconds, replicas further behind are skipped until they catch up
+    POSTGRES_REPLICA_MAX_LAG: float = 2
     SECRET_KEY: str
+    # encrypts private keys of signing_keys at rest, SECRET_KEY when unset;
+    # the first of comma separated secrets encrypts, all of them decrypt
+    SIGNING_KEYS_SECRET: Optional[str] = None
+
+    # login history is partitioned by month
+    LOGIN_HISTORY_PARTITIONS_AHEAD: int = 3
+    LOGIN_HISTORY_RETENTION_MONTHS: int = 12
+    # keep expired partitions as standalone tables instead of dropping them
+    LOGIN_HISTORY_DETACH_EXPIRED: bool = False
+
+    # redis pool of every worker process, requests wait POOL_TIMEOUT seconds
+    # for a free connection
+    REDIS_MAX_CONNECTIONS: int = 50
+    REDIS_POOL_TIMEOUT: float = 1
+    REDIS_CONNECT_TIMEOUT: float = 0.5
+    REDIS_SOCKET_TIMEOUT: float = 0.5
+    REDIS_HEALTH_CHECK_INTERVAL: int = 30
+    # connection errors are retried with jittered exponential backoff
+    REDIS_RETRIES: int = 2
+    REDIS_RETRY_BACKOFF_BASE: float = 0.02
+    REDIS_RETRY_BACKOFF_CAP: float = 0.2
+    # refresh token operations fail fast with 503 after this many failures in a row
+    REDIS_BREAKER_FAILURES: int = 5
+    REDIS_BREAKER_RESET_TIMEOUT: float = 5
+
+    # pools of the ASGI app, per worker process
+    ASYNC_POSTGRES_POOL_SIZE: int = 20
+    ASYNC_POSTGRES_MAX_OVERFLOW: int = 0
+    ASYNC_POSTGRES_POOL_TIMEOUT: float = 5
+    ASYNC_REDIS_MAX_CONNECTIONS: int = 100
+    ASYNC_REDIS_POOL_TIMEOUT: float = 5
+
+    # cost of password hashes, pick them with `flask calibrate-argon2`;
+    # memory is in KiB and is taken by every hash computed at the same time;
+    # the defaults are those of argon2-cffi 20.1.0 that stored hashes were made
+    # with, other values rehash every password on its next login
+    ARGON2_TIME_COST: int = 2
+    ARGON2_MEMORY_COST: int = 102400
+    ARGON2_PARALLELISM: int = 8
+
+    # bearer secret of the gateways calling /introspect, unset disables the endpoint
+    INTROSPECTION_SECRET: Optional[str] = None
 
     JWT_PRIVATE_KEY: str
     JWT_PUBLIC_KEY: str
 
+    @validator("REDIS_MODE")
+    def known_redis_mode(cls, v):
+        if v not in REDIS_MODES:
+            raise ValueError(f"should be one of {REDIS_MODES}")
+        return v
+
 
 config = Settings()
@@ -1,6 +1,75 @@
 class DefaultConfig:
     JWT_ACCESS_TOKEN_EXPIRES = 15 * 60
     JWT_REFRESH_TOKEN_EXPIRES = 30 * 24 * 60 * 60
+    # RS256, ES256 or EdDSA: algorithm of keys created by `flask keys generate`
     JWT_ALGORITHM = "RS256"
+    # tokens signed by keys of any supported algorithm are accepted during rotation
+    JWT_DECODE_ALGORITHMS = ["RS256", "ES256", "EdDSA"]
+    # how often workers pick up keys changed with `flask keys`
+    KEYRING_REFRESH_INTERVAL = 60
+    JWKS_MAX_AGE = 60 * 60
 
-    JSONIFY_PRETTYPRINT_REGULAR: bool = True
+    JSONIFY_PRETTYPRINT_REGULAR: bool = False
+    # JSON bodies from this size are compressed for clients accepting br or gzip
+    COMPRESSION_MIN_SIZE = 1024
+    # fast levels, every body is compressed within its request
+    COMPRESSION_LEVELS = {"br": 4, "gzip": 5}
+
+    # None means one hashing thread per core
+    PASSWORD_HASH_WORKERS = None
+    # requests allowed to wait for a free hashing thread before 503
+    PASSWORD_HASH_QUEUE_SIZE = 32
+
+    # sliding window limits checked before password hashing:
+    # route -> scope -> (requests, window seconds), scopes are ip, email and global
+    RATE_LIMITS = {
+        "token": {"ip": (30, 60), "email": (10, 60), "global": (500, 1)},
+        "register": {"ip": (10, 60), "global": (100, 1)},
+    }
+
+    # with POSTGRES_REPLICA_URIS reads of other endpoints go to replicas; these
+    # read before writing or must see writes of the previous requests at once
+    DB_PRIMARY_ENDPOINTS = {
+        "v1.create_user",
+        "v1.change_user_info",
+        "v1.create_token_pair",
+        "v1.create_role",
+        "v1.grant_role",
+        "v1.revoke_role",
+    }
+    # how often workers measure replication lag of the replicas
+    DB_REPLICA_CHECK_INTERVAL = 2
+
+    # db and redis connections every gunicorn worker opens before serving
+    POOL_WARM_UP_CONNECTIONS = 4
+
+    # how often workers export db and redis pool usage to /metrics
+    METRICS_POOL_GAUGES_INTERVAL = 5
+
+    # tokens accepted by one /introspect call
+    INTROSPECTION_MAX_TOKENS = 100
+
+    # user snapshots kept by every worker for authenticated requests
+    USER_CACHE_SIZE = 10_000
+    USER_CACHE_TTL = 30
+
+    # revoked access tokens, sized for the tokens revoked within their lifetime
+    REVOCATION_BLOOM_CAPACITY = 100_000
+    REVOCATION_BLOOM_ERROR_RATE = 0.001
+    REVOCATION_RESYNC_INTERVAL = 60
+
+    # background compaction of user devices hashes, None disables it
+    DEVICE_TOKENS_COMPACTION_INTERVAL = None
+    DEVICE_TOKENS_COMPACTION_BATCH_SIZE = 500
+    DEVICE_TOKENS_COMPACTION_MAX_KEYS_PER_SECOND = 5_000
+
+    # write login history in batches from a queue instead of within the login request
+    LOGIN_HISTORY_WRITE_BEHIND = False
+    LOGIN_HISTORY_QUEUE_SIZE = 10_000
+    LOGIN_HISTORY_BATCH_SIZE = 500
+    LOGIN_HISTORY_FLUSH_INTERVAL = 1.0
+    # how long a login waits for space in a full queue before writing by itself
+    LOGIN_HISTORY_PUT_TIMEOUT = 0.05
+
+    # creates login history partitions ahead and removes expired ones
+    LOGIN_HISTORY_PARTITION_MAINTENANCE_INTERVAL = 6 * 60 * 60
@@ -1,6 +1,14 @@
-from flask import Response, make_response
+import json
+
+from flask import Response
 from pydantic import ValidationError
-from werkzeug.exceptions import BadRequest, HTTPException, Unauthorized
+from werkzeug.exceptions import (
+    BadRequest,
+    HTTPException,
+    ServiceUnavailable,
+    TooManyRequests,
+    Unauthorized,
+)
 
 
 class RequestValidationError(HTTPException):
@@ -22,8 +30,10 @@ class AuthenticationError(Unauthorized):
 class TokenError(Unauthorized):
     def __init__(self, error, error_description):
         super().__init__(
-            response=make_response(
-                {"error": error, "error_description": error_description}, self.code
+            response=Response(
+                json.dumps({"error": error, "error_description": error_description}),
+                status=self.code,
+                mimetype="application/json",
             )
         )
 
@@ -31,3 +41,23 @@ class TokenError(Unauthorized):
 class PasswordAuthenticationError(BadRequest):
     def __init__(self):
         super().__init__(description="User not found or password is invalid")
+
+
+class ServiceBusyError(ServiceUnavailable):
+    def __init__(self):
+        super().__init__(description="Server is busy, try again later", retry_after=1)
+
+
+class StorageUnavailableError(ServiceUnavailable):
+    def __init__(self, retry_after: int = 1):
+        super().__init__(
+            description="Token storage is unavailable, try again later",
+            retry_after=retry_after,
+        )
+
+
+class TooManyRequestsError(TooManyRequests):
+    def __init__(self, retry_after: int):
+        super().__init__(
+            description="Too many requests, try again later", retry_after=retry_after
+        )
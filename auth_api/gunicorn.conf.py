@@ -0,0 +1,54 @@
+import gc
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("GUNICORN_WORKERS", 4))
+worker_class = "gevent"
+worker_connections = 1000
+accesslog = "-"
+# the master imports the app once, workers share its memory copy-on-write
+# and boot without importing anything
+preload_app = True
+
+
+def on_starting(server):
+    # files of the previous run would be summed up with the new ones
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+
+def is_flask_app(app) -> bool:
+    # the asgi app of docker-compose reads this file too, its startup runs
+    # in every worker
+    from flask import Flask
+
+    return isinstance(app, Flask)
+
+
+def when_ready(server):
+    if not server.cfg.preload_app:
+        return
+    if is_flask_app(server.app.callable):
+        from app import release_connections
+
+        release_connections()
+    # objects of the preloaded app are never collected, the collector does not
+    # touch their pages and they stay shared with the workers
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    if is_flask_app(worker.wsgi):
+        from app import start_worker
+
+        start_worker(worker.wsgi)
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,142 @@
+"""
+Argon2 is computed in a pool of native threads: argon2-cffi releases the GIL
+while hashing, so the pool keeps every core busy while the gevent worker keeps
+serving other greenlets (or the event loop other requests, in the ASGI app).
+
+Cost parameters come from ARGON2_* settings (see `flask calibrate-argon2`).
+Hashes made with other parameters still verify and are upgraded on login.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+from gevent import monkey
+from passlib.hash import argon2
+
+import jobs
+import metrics
+from exceptions import ServiceBusyError
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+executor: Optional[Executor] = None
+pool_size = 1
+slots: Optional[threading.BoundedSemaphore] = None
+hasher = argon2
+
+# the process the executor belongs to, threads do not survive a fork
+_executor_pid: Optional[int] = None
+_executor_lock = threading.Lock()
+
+
+def configure(time_cost: int, memory_cost: int, parallelism: int):
+    """Cost of new hashes, memory_cost is in KiB."""
+    global hasher
+    hasher = argon2.using(
+        time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism
+    )
+
+
+def cost() -> tuple[int, int, int]:
+    return hasher.default_rounds, hasher.memory_cost, hasher.parallelism
+
+
+def init(
+    max_workers: Optional[int] = None,
+    max_queue: int = 0,
+    argon2_cost: Optional[tuple[int, int, int]] = None,
+):
+    global pool_size, slots
+    if argon2_cost:
+        configure(*argon2_cost)
+    max_workers = max_workers or os.cpu_count() or 1
+    # passlib loads its backend lazily and that is not thread-safe
+    argon2.get_backend()
+    pool_size = max_workers
+    slots = threading.BoundedSemaphore(max_workers + max_queue)
+    # a hash coming before the pool is started starts it, see _get_executor
+    jobs.in_background(_get_executor)
+    logger.info(f"password hashing pool: {max_workers=}, {max_queue=}, {cost()=}")
+
+
+def _get_executor() -> Executor:
+    """The pool of this process, started by the first caller."""
+    global executor, _executor_pid
+    with _executor_lock:
+        if _executor_pid != os.getpid():
+            if monkey.is_module_patched("threading"):
+                # patched threads are greenlets, gevent's executor runs real
+                # threads and its futures yield to the hub while waiting
+                from gevent.threadpool import (
+                    ThreadPoolExecutor as GeventThreadPoolExecutor,
+                )
+
+                executor = GeventThreadPoolExecutor(pool_size)
+            else:
+                executor = ThreadPoolExecutor(pool_size, thread_name_prefix="argon2")
+            _executor_pid = os.getpid()
+        return executor
+
+
+def run(fn: Callable[..., T], *args) -> T:
+    if slots is None:
+        # not initialized, e.g. in scripts
+        return fn(*args)
+    # fail fast instead of queueing requests that will time out anyway
+    if not slots.acquire(blocking=False):
+        logger.warning("password hashing pool is full")
+        raise ServiceBusyError
+    try:
+        return _get_executor().submit(fn, *args).result()
+    finally:
+        slots.release()
+
+
+async def run_async(fn: Callable[..., T], *args) -> T:
+    """run() for the asyncio app, awaits the pool without blocking the loop."""
+    if slots is None:
+        return fn(*args)
+    if not slots.acquire(blocking=False):
+        logger.warning("password hashing pool is full")
+        raise ServiceBusyError
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            _get_executor(), fn, *args
+        )
+    finally:
+        slots.release()
+
+
+_hash_seconds = metrics.PASSWORD_HASH_SECONDS.labels("hash")
+_verify_seconds = metrics.PASSWORD_HASH_SECONDS.labels("verify")
+
+
+def hash_password(password: str) -> str:
+    with _hash_seconds.time():
+        return run(hasher.hash, password)
+
+
+def verify_password(password: str, hashed_password: str) -> bool:
+    with _verify_seconds.time():
+        return run(hasher.verify, password, hashed_password)
+
+
+async def hash_password_async(password: str) -> str:
+    with _hash_seconds.time():
+        return await run_async(hasher.hash, password)
+
+
+async def verify_password_async(password: str, hashed_password: str) -> bool:
+    with _verify_seconds.time():
+        return await run_async(hasher.verify, password, hashed_password)
+
+
+def needs_update(hashed_password: str) -> bool:
+    """The hash was made with other parameters than the configured ones."""
+    return hasher.needs_update(hashed_password)
@@ -0,0 +1,51 @@
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# starters of background threads held back until the worker is forked: threads
+# of the gunicorn master that preloads the app would not survive the fork
+_deferred: Optional[list[Callable[[], object]]] = None
+
+
+def defer_background_work():
+    """Hold background threads back until start_background_work."""
+    global _deferred
+    if _deferred is None:
+        _deferred = []
+
+
+def in_background(start: Callable[[], object]):
+    """Call start, which starts threads of this process, or hold it back."""
+    if _deferred is None:
+        start()
+    else:
+        _deferred.append(start)
+
+
+def start_background_work():
+    """Start what was held back, later starters run right away."""
+    global _deferred
+    pending, _deferred = _deferred or [], None
+    for start in pending:
+        start()
+
+
+def run_periodically(name: str, interval: float, job: Callable[[], object]):
+    """Run job every interval seconds in a daemon thread of this worker."""
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                job()
+            except Exception:
+                logger.exception(f"job {name} failed")
+
+    def start():
+        threading.Thread(target=loop, name=name, daemon=True).start()
+        logger.info(f"scheduled job {name} every {interval}s")
+
+    in_background(start)
@@ -0,0 +1,256 @@
+"""
+JWT keys: one active signing key and verify-only keys, published as JWKS.
+
+Keys live in the signing_keys table, each with its own algorithm, JWT_ALGORITHM
+only selects the algorithm of generated keys. The key from JWT_PRIVATE_KEY / JWT_PUBLIC_KEY
+is always kept as a verify key, tokens issued before kid was added to the header
+are checked with it, and it signs while the table has no active key.
+Private keys in the table are encrypted with SIGNING_KEYS_SECRET, readers of
+the database, its backups and replicas only see public keys.
+
+Rotation:
+    flask keys generate         - new key is published in JWKS, does not sign yet
+    (wait for KEYRING_REFRESH_INTERVAL and JWKS_MAX_AGE)
+    flask keys activate <kid>   - the key signs, the previous one only verifies
+    flask keys remove <kid>     - after tokens signed by it have expired
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Optional
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+from jwt.algorithms import get_default_algorithms
+from jwt.exceptions import InvalidSignatureError
+from sqlalchemy.orm import Session
+
+from config import config
+from storage import db
+from storage.db_models import SigningKey
+
+logger = logging.getLogger(__name__)
+
+# EdDSA and ES256 sign much faster than RS256, all three verify tokens
+SUPPORTED_ALGORITHMS = ("RS256", "ES256", "EdDSA")
+# members of a JWK used for its thumbprint, RFC 7638
+THUMBPRINT_MEMBERS = {
+    "RSA": ("e", "kty", "n"),
+    "EC": ("crv", "kty", "x", "y"),
+    "OKP": ("crv", "kty", "x"),
+}
+# unknown kid triggers a reload, but not more often than this
+UNKNOWN_KID_RELOAD_INTERVAL = 5
+
+
+@dataclass(frozen=True)
+class Key:
+    kid: str
+    algorithm: str
+    public_key: Any
+    private_key: Optional[Any]
+    jwk: dict
+
+    @classmethod
+    def from_pem(
+        cls,
+        algorithm: str,
+        public_pem: str,
+        private_pem: Optional[str] = None,
+        kid: Optional[str] = None,
+    ) -> "Key":
+        jwt_algorithm = get_default_algorithms()[algorithm]
+        public_key = jwt_algorithm.prepare_key(public_pem)
+        private_key = jwt_algorithm.prepare_key(private_pem) if private_pem else None
+        jwk = json.loads(jwt_algorithm.to_jwk(public_key))
+        kid = kid or thumbprint(jwk)
+        jwk.update(kid=kid, alg=algorithm, use="sig")
+        return cls(kid, algorithm, public_key, private_key, jwk)
+
+
+class Keyring:
+    def __init__(self, signing: Key, legacy: Key, keys: list[Key]):
+        self.signing = signing
+        self.legacy = legacy
+        self.keys = {key.kid: key for key in keys}
+        self.jwks = json.dumps(
+            {"keys": [key.jwk for key in keys]}, separators=(",", ":"), sort_keys=True
+        ).encode()
+        self.jwks_etag = hashlib.sha256(self.jwks).hexdigest()[:32]
+
+
+algorithm = "RS256"
+
+_keyring: Optional[Keyring] = None
+_loaded_at = 0.0
+_lock = threading.Lock()
+
+
+def init(jwt_algorithm: str):
+    global algorithm, _keyring
+    if jwt_algorithm not in SUPPORTED_ALGORITHMS:
+        raise ValueError(f"JWT_ALGORITHM should be one of {SUPPORTED_ALGORITHMS}")
+    algorithm = jwt_algorithm
+    _keyring = None
+
+
+def current() -> Keyring:
+    if _keyring is None:
+        with _lock:
+            if _keyring is None:
+                reload()
+    return _keyring
+
+
+def signing_key() -> Key:
+    return current().signing
+
+
+def verification_key(kid: Optional[str]) -> Any:
+    keyring = current()
+    if not kid:
+        return keyring.legacy.public_key
+    key = keyring.keys.get(kid)
+    if key is None and time.monotonic() - _loaded_at > UNKNOWN_KID_RELOAD_INTERVAL:
+        logger.info(f"unknown {kid=}, reloading keys")
+        key = reload().keys.get(kid)
+    if key is None:
+        raise InvalidSignatureError(f"Unknown signing key: {kid}")
+    return key.public_key
+
+
+def reload() -> Keyring:
+    global _keyring, _loaded_at
+    legacy = Key.from_pem(
+        algorithm_of(config.JWT_PUBLIC_KEY),
+        config.JWT_PUBLIC_KEY,
+        config.JWT_PRIVATE_KEY,
+    )
+    keys = [legacy]
+    signing = legacy
+    with Session(db.engine) as session:
+        for row in session.query(SigningKey).order_by(SigningKey.created_at):
+            key = Key.from_pem(
+                row.algorithm,
+                row.public_key,
+                decrypt_private_key(row.private_key),
+                row.kid,
+            )
+            keys.append(key)
+            if row.active:
+                signing = key
+    _keyring, _loaded_at = Keyring(signing, legacy, keys), time.monotonic()
+    logger.debug(f"loaded {len(keys)} jwt keys, signing kid: {signing.kid}")
+    return _keyring
+
+
+def _fernet() -> MultiFernet:
+    secrets = (
+        config.SIGNING_KEYS_SECRET.split(",")
+        if config.SIGNING_KEYS_SECRET
+        else [config.SECRET_KEY]
+    )
+    return MultiFernet(
+        [
+            Fernet(base64.urlsafe_b64encode(hashlib.sha256(secret.encode()).digest()))
+            for secret in secrets
+        ]
+    )
+
+
+def encrypt_private_key(private_pem: str) -> str:
+    return _fernet().encrypt(private_pem.encode()).decode()
+
+
+def decrypt_private_key(encrypted: Optional[str]) -> Optional[str]:
+    if encrypted is None:
+        return None
+    try:
+        return _fernet().decrypt(encrypted.encode()).decode()
+    except InvalidToken:
+        raise ValueError("a signing key is not encrypted with SIGNING_KEYS_SECRET")
+
+
+def thumbprint(jwk: dict) -> str:
+    members = {name: jwk[name] for name in THUMBPRINT_MEMBERS[jwk["kty"]]}
+    digest = hashlib.sha256(
+        json.dumps(members, separators=(",", ":"), sort_keys=True).encode()
+    ).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def algorithm_of(public_pem: str) -> str:
+    public_key = serialization.load_pem_public_key(public_pem.encode())
+    if isinstance(public_key, rsa.RSAPublicKey):
+        return "RS256"
+    if isinstance(public_key, ec.EllipticCurvePublicKey):
+        return "ES256"
+    if isinstance(public_key, ed25519.Ed25519PublicKey):
+        return "EdDSA"
+    raise ValueError(f"unsupported key type: {type(public_key).__name__}")
+
+
+def generate_private_key(key_algorithm: str):
+    if key_algorithm == "RS256":
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    if key_algorithm == "ES256":
+        return ec.generate_private_key(ec.SECP256R1())
+    if key_algorithm == "EdDSA":
+        return ed25519.Ed25519PrivateKey.generate()
+    raise ValueError(f"unsupported algorithm: {key_algorithm}")
+
+
+def generate(key_algorithm: str) -> SigningKey:
+    private_key = generate_private_key(key_algorithm)
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+    public_pem = (
+        private_key.public_key()
+        .public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        .decode()
+    )
+    key = Key.from_pem(key_algorithm, public_pem)
+    row = SigningKey(
+        kid=key.kid,
+        algorithm=key_algorithm,
+        private_key=encrypt_private_key(private_pem),
+        public_key=public_pem,
+    )
+    db.session.add(row)
+    db.session.commit()
+    return row
+
+
+def activate(kid: str):
+    row = db.session.query(SigningKey).filter_by(kid=kid).one_or_none()
+    if row is None or row.private_key is None:
+        raise ValueError(f"key {kid} does not exist or was deactivated")
+    for previous in db.session.query(SigningKey).filter_by(active=True):
+        previous.active = False
+        previous.private_key = None
+        previous.deactivated_at = datetime.utcnow()
+    db.session.flush()
+    row.active = True
+    db.session.commit()
+
+
+def remove(kid: str):
+    row = db.session.query(SigningKey).filter_by(kid=kid).one_or_none()
+    if row is None:
+        raise ValueError(f"key {kid} does not exist")
+    if row.active:
+        raise ValueError(f"key {kid} is active")
+    db.session.delete(row)
+    db.session.commit()
@@ -0,0 +1,138 @@
+"""
+Login history recording.
+
+By default a record is committed within the login request. In write-behind mode
+records go to a bounded in-process queue and a flusher thread inserts them with
+one multi-row INSERT per batch, when the batch is full or flush_interval passes.
+"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy.exc import SQLAlchemyError
+
+import jobs
+import metrics
+from storage import db
+from storage.db_models import LoginRecord
+
+logger = logging.getLogger(__name__)
+
+FLUSH_ATTEMPTS = 3
+# seconds flush() waits for the flusher to write the batch it holds
+STOP_TIMEOUT = 10
+# queued by flush(), the flusher writes its batch and exits
+_STOP = object()
+
+records: Optional[queue.Queue] = None
+flusher: Optional[threading.Thread] = None
+batch_size = 0
+flush_interval = 0.0
+put_timeout = 0.0
+
+
+def init(max_queue: int, batch: int, interval: float, timeout: float):
+    global records, flusher, batch_size, flush_interval, put_timeout
+    records = queue.Queue(max_queue)
+    batch_size = batch
+    flush_interval = interval
+    put_timeout = timeout
+    flusher = threading.Thread(target=_flush_forever, name="login-history", daemon=True)
+    jobs.in_background(flusher.start)
+    atexit.register(flush)
+
+
+def record(user_id, ip: str, user_agent: str, platform: str, browser: str):
+    row = dict(
+        user_id=user_id,
+        ip=ip,
+        user_agent=user_agent,
+        platform=platform,
+        browser=browser,
+    )
+    if records is None:
+        db.session.add(LoginRecord(**row))
+        db.session.commit()
+        return
+    # login time, not the time of the flush
+    row["timestamp"] = datetime.utcnow()
+    try:
+        # a full queue slows logins down instead of growing without bound
+        records.put((time.monotonic(), row), timeout=put_timeout)
+    except queue.Full:
+        logger.warning("login history queue is full, writing synchronously")
+        _write([row])
+        metrics.LOGIN_HISTORY_RECORDS.labels("synchronous").inc()
+
+
+def flush():
+    """Write everything queued so far, used on shutdown."""
+    if flusher.is_alive():
+        try:
+            records.put(_STOP, timeout=STOP_TIMEOUT)
+        except queue.Full:
+            logger.warning("login history flusher is stuck, draining the queue")
+        else:
+            flusher.join(STOP_TIMEOUT)
+    batch = []
+    while True:
+        try:
+            item = records.get_nowait()
+        except queue.Empty:
+            break
+        if item is _STOP:
+            # the flusher did not get to it in time
+            continue
+        batch.append(item)
+        if len(batch) >= batch_size:
+            _write_batch(batch)
+            batch = []
+    if batch:
+        _write_batch(batch)
+
+
+def _flush_forever():
+    while True:
+        item = records.get()
+        if item is _STOP:
+            return
+        batch = [item]
+        deadline = time.monotonic() + flush_interval
+        while len(batch) < batch_size:
+            try:
+                item = records.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is _STOP:
+                _write_batch(batch)
+                return
+            batch.append(item)
+        _write_batch(batch)
+
+
+def _write_batch(batch: list[tuple[float, dict]]):
+    metrics.LOGIN_HISTORY_QUEUE_DEPTH.set(records.qsize())
+    for attempt in range(1, FLUSH_ATTEMPTS + 1):
+        try:
+            _write([row for _, row in batch])
+            break
+        except SQLAlchemyError:
+            logger.exception(f"login history flush failed, {attempt=}")
+            time.sleep(attempt)
+    else:
+        metrics.LOGIN_HISTORY_RECORDS.labels("dropped").inc(len(batch))
+        logger.error(f"dropped {len(batch)} login records")
+        return
+    metrics.LOGIN_HISTORY_RECORDS.labels("flushed").inc(len(batch))
+    # from the login of the oldest record of the batch to its write
+    metrics.LOGIN_HISTORY_FLUSH_LAG.observe(time.monotonic() - batch[0][0])
+
+
+def _write(rows: list[dict]):
+    with db.engine.begin() as connection:
+        connection.execute(LoginRecord.__table__.insert(), rows)
@@ -0,0 +1,163 @@
+"""
+Prometheus metrics of the request hot path.
+
+Under gunicorn PROMETHEUS_MULTIPROC_DIR is set (see Dockerfile and
+gunicorn.conf.py): every worker writes samples to its own mmap files there and
+/metrics of any worker aggregates the files of all of them.
+"""
+
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# seconds, from the sub-millisecond redis calls to slow requests
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+SIGN_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025)
+HASH_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+STATEMENTS = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+
+REQUEST_SECONDS = Histogram(
+    "auth_request_seconds",
+    "Request latency by endpoint and status",
+    ["endpoint", "method", "status"],
+    buckets=FAST_BUCKETS + (2.5, 5, 10),
+)
+PASSWORD_HASH_SECONDS = Histogram(
+    "auth_password_hash_seconds",
+    "Argon2 hashing and verification including the wait for the pool",
+    ["operation"],
+    buckets=HASH_BUCKETS,
+)
+JWT_SIGN_SECONDS = Histogram(
+    "auth_jwt_sign_seconds", "JWT signing", ["algorithm"], buckets=SIGN_BUCKETS
+)
+REDIS_SECONDS = Histogram(
+    "auth_redis_command_seconds",
+    "Round trips of token_store commands",
+    ["command"],
+    buckets=FAST_BUCKETS,
+)
+DB_QUERY_SECONDS = Histogram(
+    "auth_db_query_seconds", "SQL statements", ["statement"], buckets=FAST_BUCKETS
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    "auth_db_pool_wait_seconds",
+    "Wait for a free connection of the db pool",
+    buckets=FAST_BUCKETS + (2.5, 5),
+)
+DB_POOL_CONNECTIONS = Gauge(
+    "auth_db_pool_connections",
+    "Db pool connections of live workers",
+    ["state"],
+    multiprocess_mode="livesum",
+)
+DB_REPLICA_LAG = Gauge(
+    "auth_db_replica_lag_seconds",
+    "Replication lag of read replicas by worker, -1 while unusable, +Inf without WAL",
+    ["replica"],
+    multiprocess_mode="liveall",
+)
+DB_READS = Counter(
+    "auth_db_routed_reads", "Reads of requests allowed to use replicas", ["target"]
+)
+REDIS_POOL_CONNECTIONS = Gauge(
+    "auth_redis_pool_connections",
+    "Redis pool connections of live workers",
+    ["state"],
+    multiprocess_mode="livesum",
+)
+RATE_LIMITED = Counter(
+    "auth_rate_limited_requests", "Requests rejected by rate limits", ["route"]
+)
+REDIS_CIRCUIT_OPEN = Gauge(
+    "auth_redis_circuit_open",
+    "1 while refresh token commands fail fast, per live worker pid",
+    multiprocess_mode="liveall",
+)
+
+USER_CACHE_LOOKUPS = Counter(
+    "auth_user_cache_lookups", "User snapshot lookups by result", ["result"]
+)
+USER_CACHE_ENTRIES = Gauge(
+    "auth_user_cache_entries",
+    "User snapshots cached by live workers",
+    multiprocess_mode="livesum",
+)
+LOGIN_HISTORY_RECORDS = Counter(
+    "auth_login_history_records",
+    "Write-behind login records by outcome",
+    ["result"],
+)
+LOGIN_HISTORY_QUEUE_DEPTH = Gauge(
+    "auth_login_history_queue_depth",
+    "Login records waiting for the flusher in live workers",
+    multiprocess_mode="livesum",
+)
+LOGIN_HISTORY_FLUSH_LAG = Histogram(
+    "auth_login_history_flush_lag_seconds",
+    "From the login to the flush of the oldest record of a batch",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+
+def render() -> tuple[bytes, str]:
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def observe_request(endpoint, method: str, status: int, started: float):
+    REQUEST_SECONDS.labels(endpoint or "none", method, status).observe(
+        time.perf_counter() - started
+    )
+
+
+def set_pool_gauges(db_stats: dict, redis_stats: dict):
+    DB_POOL_CONNECTIONS.labels("size").set(db_stats["size"])
+    DB_POOL_CONNECTIONS.labels("checked_out").set(db_stats["checked_out"])
+    # negative while the pool itself is not full yet
+    DB_POOL_CONNECTIONS.labels("overflow").set(max(0, db_stats["overflow"]))
+    for state in ("max_connections", "created", "in_use"):
+        # sentinel and cluster pools do not report created and in_use
+        if state in redis_stats:
+            REDIS_POOL_CONNECTIONS.labels(state).set(redis_stats[state])
+    REDIS_CIRCUIT_OPEN.set(redis_stats["state"] != "closed")
+
+
+def instrument_engine(engine: Engine):
+    """Time every statement of the engine, labelled by its verb."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, _cursor, _statement, _params, _context, _many):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, _cursor, statement, _params, _context, _many):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        verb = statement.lstrip()[:6].upper()
+        DB_QUERY_SECONDS.labels(verb if verb in STATEMENTS else "OTHER").observe(
+            elapsed
+        )
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # a failed statement has no after_cursor_execute
+        if context.connection is not None and context.connection.info.get(
+            "query_started"
+        ):
+            context.connection.info["query_started"].pop()
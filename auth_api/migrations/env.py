@@ -0,0 +1,42 @@
+import logging.config
+
+from alembic import context
+
+import storage.db_models  # noqa: F401
+from storage.db import Base, engine
+
+config = context.config
+# the app configures logging itself, the CLI takes it from alembic.ini
+if config.config_file_name and not config.attributes.get("connection"):
+    logging.config.fileConfig(config.config_file_name)
+
+# partitions of login_entries are managed by storage.partitions
+IGNORED_TABLES = ("login_entries_",)
+
+
+def include_object(obj, name, type_, _reflected, _compare_to):
+    return not (type_ == "table" and name.startswith(IGNORED_TABLES))
+
+
+def configure(**kwargs):
+    context.configure(
+        target_metadata=Base.metadata,
+        include_object=include_object,
+        compare_type=True,
+        **kwargs,
+    )
+
+
+if context.is_offline_mode():
+    configure(url=engine.url, literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+elif config.attributes.get("connection") is not None:
+    configure(connection=config.attributes["connection"])
+    with context.begin_transaction():
+        context.run_migrations()
+else:
+    with engine.connect() as connection:
+        configure(connection=connection)
+        with context.begin_transaction():
+            context.run_migrations()
@@ -0,0 +1,72 @@
+"""baseline: the schema create_all made before any later changes
+
+Databases created by create_all are stamped with this revision by
+storage.db.upgrade_schema instead of running it, the following revisions
+check what such a database already has.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 12:00:00
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects.postgresql import UUID
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "users",
+        sa.Column("id", UUID(as_uuid=True), nullable=False),
+        sa.Column("email", sa.String(255), nullable=True),
+        sa.Column("password", sa.String(255), nullable=False),
+        sa.Column("registered_at", sa.DateTime(), nullable=False),
+        sa.Column("active", sa.Boolean(), nullable=False),
+        sa.Column("should_change_password", sa.Boolean(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("email"),
+        sa.UniqueConstraint("id"),
+    )
+    op.create_table(
+        "roles",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("name", sa.String(80), nullable=True),
+        sa.Column("description", sa.String(255), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("id"),
+        sa.UniqueConstraint("name"),
+    )
+    op.create_table(
+        "roles_users",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("user_id", UUID(as_uuid=True), nullable=True),
+        sa.Column("role_id", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(["role_id"], ["roles.id"]),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_table(
+        "login_entries",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("user_id", UUID(as_uuid=True), nullable=True),
+        sa.Column("user_agent", sa.String(), nullable=True),
+        sa.Column("platform", sa.String(100), nullable=True),
+        sa.Column("browser", sa.String(255), nullable=True),
+        sa.Column("timestamp", sa.DateTime(), nullable=False),
+        sa.Column("ip", sa.String(100), nullable=True),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"]),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("id"),
+    )
+
+
+def downgrade():
+    op.drop_table("login_entries")
+    op.drop_table("roles_users")
+    op.drop_table("roles")
+    op.drop_table("users")
@@ -0,0 +1,26 @@
+"""index of login history pages
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 12:00:00
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+INDEX = "ix_login_entries_user_id_timestamp_id"
+
+
+def upgrade():
+    indexes = sa.inspect(op.get_bind()).get_indexes("login_entries")
+    if INDEX not in {index["name"] for index in indexes}:
+        op.create_index(INDEX, "login_entries", ["user_id", "timestamp", "id"])
+
+
+def downgrade():
+    op.drop_index(INDEX, table_name="login_entries")
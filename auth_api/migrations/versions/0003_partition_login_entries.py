@@ -0,0 +1,74 @@
+"""login_entries partitioned by month, primary key (id, timestamp)
+
+Only an empty table is recreated here. Rows of a filled one are moved by
+`flask partition-login-history`, which locks the table for the copy; until
+then init_db warns about it.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 12:00:00
+"""
+
+import logging
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects.postgresql import UUID
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger(__name__)
+
+
+def is_partitioned(connection) -> bool:
+    if connection.dialect.name != "postgresql":
+        primary_key = sa.inspect(connection).get_pk_constraint("login_entries")
+        return "timestamp" in primary_key["constrained_columns"]
+    kind = connection.execute(
+        sa.text("SELECT relkind FROM pg_class WHERE relname = 'login_entries'")
+    ).scalar()
+    return kind == "p"
+
+
+def upgrade():
+    connection = op.get_bind()
+    if is_partitioned(connection):
+        return
+    if connection.execute(sa.text("SELECT 1 FROM login_entries LIMIT 1")).first():
+        logger.warning("login_entries has rows, run flask partition-login-history")
+        return
+
+    op.drop_table("login_entries")
+    op.create_table(
+        "login_entries",
+        # sqlite has no autoincrement within a composite key, the stand-ins
+        # give ids from the model
+        sa.Column(
+            "id",
+            sa.Integer(),
+            autoincrement=connection.dialect.name != "sqlite",
+            nullable=False,
+        ),
+        sa.Column("user_id", UUID(as_uuid=True), nullable=True),
+        sa.Column("user_agent", sa.String(), nullable=True),
+        sa.Column("platform", sa.String(100), nullable=True),
+        sa.Column("browser", sa.String(255), nullable=True),
+        sa.Column("timestamp", sa.DateTime(), nullable=False),
+        sa.Column("ip", sa.String(100), nullable=True),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"]),
+        sa.PrimaryKeyConstraint("id", "timestamp"),
+        postgresql_partition_by="RANGE (timestamp)",
+    )
+    op.create_index(
+        "ix_login_entries_user_id_timestamp_id",
+        "login_entries",
+        ["user_id", "timestamp", "id"],
+    )
+
+
+def downgrade():
+    # the partitioned table serves the code of the previous revisions as well
+    pass
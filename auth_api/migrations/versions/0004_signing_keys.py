@@ -0,0 +1,43 @@
+"""signing_keys of rotatable JWT keys
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 12:00:00
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if sa.inspect(op.get_bind()).has_table("signing_keys"):
+        return
+    op.create_table(
+        "signing_keys",
+        sa.Column("kid", sa.String(64), nullable=False),
+        sa.Column("algorithm", sa.String(16), nullable=False),
+        sa.Column("private_key", sa.Text(), nullable=True),
+        sa.Column("public_key", sa.Text(), nullable=False),
+        sa.Column("active", sa.Boolean(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("deactivated_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("kid"),
+    )
+    op.create_index(
+        "uq_signing_keys_active",
+        "signing_keys",
+        ["active"],
+        unique=True,
+        postgresql_where=sa.text("active"),
+        sqlite_where=sa.text("active"),
+    )
+
+
+def downgrade():
+    op.drop_index("uq_signing_keys_active", table_name="signing_keys")
+    op.drop_table("signing_keys")
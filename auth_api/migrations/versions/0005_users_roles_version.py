@@ -0,0 +1,29 @@
+"""users.roles_version
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 12:00:00
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = sa.inspect(op.get_bind()).get_columns("users")
+    if "roles_version" not in {column["name"] for column in columns}:
+        op.add_column(
+            "users",
+            sa.Column(
+                "roles_version", sa.Integer(), server_default="0", nullable=False
+            ),
+        )
+
+
+def downgrade():
+    op.drop_column("users", "roles_version")
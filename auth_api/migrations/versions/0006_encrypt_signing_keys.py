@@ -0,0 +1,45 @@
+"""encrypt private keys of signing_keys
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 12:00:00
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+import jwt_keys
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+signing_keys = sa.table(
+    "signing_keys", sa.column("kid", sa.String), sa.column("private_key", sa.Text)
+)
+
+
+def convert(transform, stored_as_pem: bool):
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.select(signing_keys.c.kid, signing_keys.c.private_key).where(
+            signing_keys.c.private_key.isnot(None)
+        )
+    ).fetchall()
+    for kid, private_key in rows:
+        # PEMs start with -----BEGIN, Fernet tokens are base64
+        if private_key.startswith("-----") == stored_as_pem:
+            connection.execute(
+                signing_keys.update()
+                .where(signing_keys.c.kid == kid)
+                .values(private_key=transform(private_key))
+            )
+
+
+def upgrade():
+    convert(jwt_keys.encrypt_private_key, stored_as_pem=True)
+
+
+def downgrade():
+    convert(jwt_keys.decrypt_private_key, stored_as_pem=False)
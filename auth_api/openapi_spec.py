@@ -3,6 +3,12 @@ from apispec_webframeworks.flask import FlaskPlugin
 from flask import current_app
 
 from api.models import (
+    IntrospectIn,
+    IntrospectionResult,
+    IntrospectOut,
+    RoleIn,
+    RoleOut,
+    RolesOut,
     TokenGrantOut,
     TokenInPassword,
     TokenRevokeIn,
@@ -27,6 +33,9 @@ def get_api_spec():
     jwt_refresh = {"type": "http", "scheme": "bearer", "bearerFormat": "JWT"}
     spec.components.security_scheme("jwt_access", jwt_access)
     spec.components.security_scheme("jwt_refresh", jwt_refresh)
+    spec.components.security_scheme(
+        "introspection_secret", {"type": "http", "scheme": "bearer"}
+    )
 
     with current_app.test_request_context():
         for rule in current_app.url_map.iter_rules():
@@ -40,5 +49,11 @@ def get_api_spec():
     spec.components.schema("TokenInPassword", TokenInPassword.schema())
     spec.components.schema("TokenRevokeIn", TokenRevokeIn.schema())
     spec.components.schema("TokenGrantOut", TokenGrantOut.schema())
+    spec.components.schema("RoleIn", RoleIn.schema())
+    spec.components.schema("RoleOut", RoleOut.schema())
+    spec.components.schema("RolesOut", RolesOut.schema())
+    spec.components.schema("IntrospectIn", IntrospectIn.schema())
+    spec.components.schema("IntrospectionResult", IntrospectionResult.schema())
+    spec.components.schema("IntrospectOut", IntrospectOut.schema())
 
     return spec
@@ -0,0 +1,40 @@
+"""
+Authorization by the claims of access tokens, without db queries: under
+roles_required the user is not loaded and current_user is a ClaimsUser.
+"""
+
+from functools import wraps
+from typing import NamedTuple
+
+from flask import g
+from flask_jwt_extended import get_jwt, verify_jwt_in_request
+from werkzeug.exceptions import Forbidden
+
+ADMIN_ROLE = "admin"
+
+
+class ClaimsUser(NamedTuple):
+    id: str
+    roles: tuple[str, ...]
+
+    @classmethod
+    def from_claims(cls, jwt_data: dict) -> "ClaimsUser":
+        return cls(id=jwt_data["sub"], roles=tuple(jwt_data.get("roles", ())))
+
+
+def roles_required(*roles: str):
+    """Allow access tokens having all of the roles."""
+    required = frozenset(roles)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            g.user_from_claims = True
+            verify_jwt_in_request()
+            if not required.issubset(get_jwt().get("roles", ())):
+                raise Forbidden(description="Not enough roles")
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
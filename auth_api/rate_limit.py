@@ -0,0 +1,113 @@
+"""
+Sliding window rate limits of the password routes, checked before any db
+lookup or password hashing.
+
+A limit counts requests in fixed windows and weighs the previous window by the
+part of it still inside the sliding one, two counters per limited value:
+
+rate:{route:scope:value}:{window start} = count
+
+Both counters of a value share a cluster slot and every limit is checked and
+counted by its own script call. A request is counted only if it passes all of
+its limits, a rejected one is taken back from the limits it passed. Requests
+are let through while redis is unavailable.
+"""
+
+import logging
+import math
+import time
+from typing import Optional
+
+import redis
+
+import metrics
+import token_store
+from exceptions import StorageUnavailableError, TooManyRequestsError
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_SCOPE = "global"
+
+# KEYS: counters of the current and the previous window,
+# ARGV: limit, window_ms, milliseconds elapsed in the current window.
+# Returns 0 if the request is counted, otherwise milliseconds to wait.
+SCRIPT = """
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local elapsed = tonumber(ARGV[3])
+local current = tonumber(redis.call("GET", KEYS[1]) or 0)
+local previous = tonumber(redis.call("GET", KEYS[2]) or 0)
+if previous * (window - elapsed) / window + current + 1 > limit then
+    -- until the weighted count leaves room for one more request
+    local wait
+    if current + 1 <= limit then
+        wait = math.ceil(window * (1 - (limit - current - 1) / previous)) - elapsed
+    else
+        wait = window - elapsed + math.ceil(window * (1 - (limit - 1) / math.max(current, 1)))
+    end
+    return math.max(wait, 1)
+end
+redis.call("INCR", KEYS[1])
+redis.call("PEXPIRE", KEYS[1], window * 2)
+return 0
+"""
+
+limits: dict[str, dict[str, tuple[int, float]]] = {}
+client = None
+script = None
+
+
+def init(redis_client: redis.StrictRedis, route_limits: dict):
+    global limits, client, script
+    limits = route_limits
+    client = redis_client
+    script = redis_client.register_script(SCRIPT)
+
+
+def script_arguments(
+    route_limits: dict, route: str, values: dict[str, Optional[str]], now_ms: int
+) -> list[tuple[list[str], list]]:
+    """Script calls, (keys, args), of the route limits for the given scope values."""
+    calls = []
+    for scope, (count, window) in route_limits.get(route, {}).items():
+        if scope == GLOBAL_SCOPE:
+            prefix = f"rate:{{{route}:{scope}}}"
+        elif values.get(scope):
+            prefix = f"rate:{{{route}:{scope}:{values[scope].lower()}}}"
+        else:
+            continue
+        window_ms = int(window * 1000)
+        start = now_ms - now_ms % window_ms
+        keys = [f"{prefix}:{start}", f"{prefix}:{start - window_ms}"]
+        calls.append((keys, [count, window_ms, now_ms - start]))
+    return calls
+
+
+def counted(calls: list[tuple[list[str], list]], retries: list) -> list[str]:
+    """Current window counters of the limits that counted the request."""
+    return [keys[0] for (keys, _), retry_ms in zip(calls, retries) if not retry_ms]
+
+
+def reject(route: str, retry_ms: int):
+    metrics.RATE_LIMITED.labels(route).inc()
+    raise TooManyRequestsError(max(1, math.ceil(retry_ms / 1000)))
+
+
+def check(route: str, **values: Optional[str]):
+    """Count the request or raise TooManyRequestsError with Retry-After."""
+    calls = script_arguments(limits, route, values, int(time.time() * 1000))
+    if not calls:
+        return
+    try:
+        with token_store.command("rate_limit"):
+            retries = token_store.run_scripts(script, calls)
+            if any(retries):
+                pipeline = client.pipeline(transaction=False)
+                for counter in counted(calls, retries):
+                    pipeline.decr(counter)
+                pipeline.execute()
+    except (redis.RedisError, StorageUnavailableError):
+        logger.warning(f"rate limit of {route} is not checked, redis is unavailable")
+        return
+    if any(retries):
+        reject(route, max(retries))
@@ -0,0 +1,214 @@
+"""
+Отзыв access токенов.
+
+В redis хранятся отозванные jti и время, до которого отозваны все токены пользователя:
+
+revoked:jti:{jti} = 1
+revoked:user:{user_id} = {timestamp}
+
+Ключи живут не дольше access токена. Каждый воркер держит в памяти bloom filter по jti
+и точный словарь пользователей, обновляет их через pub/sub и периодически пересобирает
+из redis. В redis идут только запросы, для которых bloom filter ответил "возможно".
+"""
+
+import hashlib
+import logging
+import math
+import threading
+import time
+from typing import Optional
+
+import redis
+
+import jobs
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "revocation"
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item)
+        )
+
+
+client: Optional[redis.StrictRedis] = None
+access_token_ttl = 0
+bloom_capacity = 0
+bloom_error_rate = 0.0
+
+_bloom: Optional[BloomFilter] = None
+_revoked_before: dict[str, int] = {}
+# messages received while a resync is running, replayed after the swap
+_pending: Optional[list[str]] = None
+_lock = threading.Lock()
+
+
+def init(
+    redis_client: redis.StrictRedis,
+    access_ttl: int,
+    capacity: int,
+    error_rate: float,
+    resync_interval: float,
+):
+    global client, access_token_ttl, bloom_capacity, bloom_error_rate, _bloom
+    client = redis_client
+    access_token_ttl = access_ttl
+    bloom_capacity = capacity
+    bloom_error_rate = error_rate
+    _bloom = BloomFilter(capacity, error_rate)
+    jobs.in_background(lambda: _subscribe(resync_interval))
+
+
+def _subscribe(resync_interval: float):
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(**{CHANNEL: _on_message})
+    except redis.RedisError:
+        logger.warning("revocation updates are not subscribed, relying on resync")
+    else:
+        pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    threading.Thread(
+        target=_resync_forever, args=(resync_interval,), daemon=True
+    ).start()
+
+
+def jti_key(jti) -> str:
+    return f"revoked:jti:{jti}"
+
+
+def user_key(user_id) -> str:
+    # hash tag: the same cluster slot as the device tokens of the user
+    return f"revoked:user:{{{user_id}}}"
+
+
+def _store(key: str, value: int, ttl: int, message: str):
+    try:
+        client.set(key, value, ex=ttl)
+        client.publish(CHANNEL, message)
+    except redis.RedisError:
+        # other workers learn of a stored revocation on resync
+        logger.exception(f"revocation is not stored or published: {message}")
+    apply(message)
+
+
+def revoke_token(jwt_payload: dict):
+    jti = jwt_payload["jti"]
+    ttl = max(1, int(jwt_payload["exp"] - time.time()))
+    _store(jti_key(jti), 1, ttl, f"jti {jti}")
+
+
+def revoke_user_tokens(user_id):
+    """
+    Revoke access tokens of the user issued before the current second.
+    iat has a second resolution, so a token issued right after the revocation
+    stays valid and the caller revokes the token it holds by its jti.
+    """
+    revoked_at = int(time.time())
+    _store(
+        user_key(user_id), revoked_at, access_token_ttl, f"user {user_id} {revoked_at}"
+    )
+
+
+def check_locally(jwt_payload: dict) -> Optional[bool]:
+    """Answer from memory, None if the bloom filter says "maybe"."""
+    revoked_before = _revoked_before.get(jwt_payload["sub"])
+    if revoked_before and jwt_payload["iat"] < revoked_before:
+        return True
+    if jwt_payload["jti"] not in _bloom:
+        return False
+    return None
+
+
+def is_revoked(jwt_payload: dict) -> bool:
+    revoked = check_locally(jwt_payload)
+    if revoked is not None:
+        return revoked
+    try:
+        return bool(client.exists(jti_key(jwt_payload["jti"])))
+    except redis.RedisError:
+        logger.exception("revocation check failed, treating token as revoked")
+        return True
+
+
+def resync():
+    global _bloom, _revoked_before, _pending
+    with _lock:
+        _pending = []
+
+    try:
+        bloom = BloomFilter(bloom_capacity, bloom_error_rate)
+        count = 0
+        for key in client.scan_iter("revoked:jti:*", count=1000):
+            bloom.add(key.split(":", 2)[2])
+            count += 1
+        if count > bloom_capacity:
+            logger.warning(f"revoked tokens exceed bloom capacity: {count=}")
+
+        revoked_before = {}
+        user_keys = list(client.scan_iter("revoked:user:*", count=1000))
+        if user_keys:
+            # keys of a cluster are on many nodes, MGET would be cross-slot
+            pipe = client.pipeline(transaction=False)
+            for key in user_keys:
+                pipe.get(key)
+            for key, value in zip(user_keys, pipe.execute()):
+                if value:
+                    revoked_before[key.split(":", 2)[2].strip("{}")] = int(value)
+    except BaseException:
+        with _lock:
+            _pending = None
+        raise
+
+    with _lock:
+        _bloom, _revoked_before = bloom, revoked_before
+        pending, _pending = _pending, None
+    for message in pending:
+        apply(message)
+    logger.debug(f"revocation resynced: {count} jti, {len(revoked_before)} users")
+
+
+def apply(message: str):
+    kind, *args = message.split()
+    if kind == "jti":
+        _bloom.add(args[0])
+    elif kind == "user":
+        user_id, revoked_at = args[0], int(args[1])
+        if revoked_at > _revoked_before.get(user_id, 0):
+            _revoked_before[user_id] = revoked_at
+    with _lock:
+        if _pending is not None:
+            _pending.append(message)
+
+
+def _on_message(message):
+    data = message["data"]
+    apply(data.decode() if isinstance(data, bytes) else data)
+
+
+def _resync_forever(interval: float):
+    # expired entries are dropped from memory only by a rebuild
+    while True:
+        try:
+            resync()
+        except redis.RedisError:
+            logger.exception("revocation resync failed")
+        time.sleep(interval)
@@ -0,0 +1,69 @@
+"""
+Role management. Roles are copied into tokens when they are issued, a change
+of the roles of a user bumps users.roles_version, so refresh tokens issued
+before it are rejected. Access tokens keep their roles until they expire.
+"""
+
+import logging
+import uuid
+
+from werkzeug.exceptions import NotFound
+
+import user_cache
+from exceptions import AlreadyExistsError
+from storage import db
+from storage.db_models import Role, User
+
+logger = logging.getLogger(__name__)
+
+
+def list_roles() -> list[Role]:
+    return db.session.query(Role).order_by(Role.name).all()
+
+
+def create_role(name: str, description: str = None) -> Role:
+    if Role.get_by_name(name) is not None:
+        raise AlreadyExistsError(f"Role {name} already exists")
+    role = Role(name=name, description=description)
+    db.session.add(role)
+    db.session.commit()
+    return role
+
+
+def _user_and_role(user_id, name: str) -> tuple[User, Role]:
+    try:
+        user = User.get_by_id(uuid.UUID(str(user_id)))
+    except ValueError:
+        user = None
+    if user is None:
+        raise NotFound(description=f"User {user_id} not found")
+    role = Role.get_by_name(name)
+    if role is None:
+        raise NotFound(description=f"Role {name} not found")
+    return user, role
+
+
+def _save_roles(user: User):
+    # evaluated by the db, concurrent changes do not lose a bump
+    user.roles_version = User.roles_version + 1
+    db.session.commit()
+    user_cache.invalidate(user.id)
+    logger.info(f"roles of {user.id} changed")
+
+
+def grant_role(user_id, name: str) -> bool:
+    user, role = _user_and_role(user_id, name)
+    if role in user.roles:
+        return False
+    user.roles.append(role)
+    _save_roles(user)
+    return True
+
+
+def revoke_role(user_id, name: str) -> bool:
+    user, role = _user_and_role(user_id, name)
+    if role not in user.roles:
+        return False
+    user.roles.remove(role)
+    _save_roles(user)
+    return True
@@ -1,18 +1,302 @@
 import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base, scoped_session, sessionmaker
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError, TimeoutError
+from sqlalchemy.orm import Session, declarative_base, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import Select
+from sqlalchemy.util import queue as sqla_queue
 
+import metrics
 from config import config
 
 logger = logging.getLogger(__name__)
-engine = create_engine(config.POSTGRES_URI)
-session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+
+# checkouts waiting longer than this are counted and logged once per interval
+SLOW_CHECKOUT = 0.1
+SLOW_CHECKOUT_LOG_INTERVAL = 60
+
+PRIMARY_LSN_QUERY = "SELECT pg_current_wal_lsn()"
+# seconds behind the primary: 0 once the replica replayed the WAL the primary
+# had written before the check, infinite without a WAL receiver (the replica
+# lost its primary and would stay at what it replayed), NULL before it
+# replayed anything
+REPLICA_LAG_QUERY = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver) THEN 'Infinity'::float8
+    WHEN pg_last_wal_replay_lsn() >= CAST(:primary_lsn AS pg_lsn) THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())::float8
+END
+"""
+
+ALEMBIC_INI = os.path.join(os.path.dirname(__file__), os.pardir, "alembic.ini")
+# the oldest schema create_all made, later revisions check what a database
+# created by a newer create_all already has
+BASELINE_REVISION = "0001"
+
+
+class TimedQueue(sqla_queue.Queue):
+    """Queue of idle connections, times how long a get waits for one."""
+
+    def get(self, block=True, timeout=None):
+        started = time.perf_counter()
+        try:
+            return super().get(block, timeout)
+        finally:
+            TimedQueuePool.observe_wait(time.perf_counter() - started)
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool measuring how long requests wait for a free connection. Only the
+    wait on the queue counts, the time to open a new connection does not.
+    """
+
+    checkouts = 0
+    timeouts = 0
+    wait_total = 0.0
+    wait_max = 0.0
+    slow_waits = 0
+    _logged_at = 0.0
+    _stats_lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool = TimedQueue(self._pool.maxsize, use_lifo=self._pool.use_lifo)
+
+    def _do_get(self):
+        with self._stats_lock:
+            TimedQueuePool.checkouts += 1
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            with self._stats_lock:
+                TimedQueuePool.timeouts += 1
+            raise
+
+    @classmethod
+    def observe_wait(cls, waited: float):
+        metrics.DB_POOL_WAIT_SECONDS.observe(waited)
+        with cls._stats_lock:
+            cls.wait_total += waited
+            cls.wait_max = max(cls.wait_max, waited)
+            if waited <= SLOW_CHECKOUT:
+                return
+            cls.slow_waits += 1
+            now = time.monotonic()
+            if now - cls._logged_at < SLOW_CHECKOUT_LOG_INTERVAL:
+                return
+            cls._logged_at, slow_waits, cls.slow_waits = now, cls.slow_waits, 0
+        logger.warning(
+            f"{slow_waits} db connection checkouts waited over {SLOW_CHECKOUT}s"
+            f" in {SLOW_CHECKOUT_LOG_INTERVAL}s, the last {waited:.3f}s"
+        )
+
+
+def pool_stats() -> dict:
+    pool = engine.pool
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "checkouts": TimedQueuePool.checkouts,
+        "timeouts": TimedQueuePool.timeouts,
+        "wait_total": TimedQueuePool.wait_total,
+        "wait_max": TimedQueuePool.wait_max,
+    }
+
+
+class Replica:
+    def __init__(self, name: str, uri: str):
+        self.name = name
+        self.engine = create_engine(
+            uri,
+            poolclass=QueuePool,
+            pool_size=config.POSTGRES_POOL_SIZE,
+            max_overflow=config.POSTGRES_MAX_OVERFLOW,
+            pool_timeout=config.POSTGRES_POOL_TIMEOUT,
+            pool_pre_ping=config.POSTGRES_POOL_PRE_PING,
+            pool_recycle=config.POSTGRES_POOL_RECYCLE,
+        )
+        metrics.instrument_engine(self.engine)
+        # seconds, None until measured and while the replica is unreachable
+        self.lag: Optional[float] = None
+
+    def measure_lag(self, primary_lsn: Optional[str] = None):
+        try:
+            with self.engine.connect() as connection:
+                if self.engine.dialect.name == "postgresql":
+                    lag = connection.execute(
+                        text(REPLICA_LAG_QUERY), {"primary_lsn": primary_lsn}
+                    ).scalar()
+                else:
+                    lag = 0.0
+        except SQLAlchemyError as e:
+            logger.warning(f"replica {self.name} is unavailable: {e!r}")
+            lag = None
+        else:
+            if lag is None:
+                logger.warning(f"replica {self.name} has not replayed anything yet")
+            elif lag == float("inf"):
+                logger.warning(f"replica {self.name} receives no WAL from the primary")
+        self.lag = None if lag is None else float(lag)
+        metrics.DB_REPLICA_LAG.labels(self.name).set(
+            -1 if self.lag is None else self.lag
+        )
+
+
+class RoutingSession(Session):
+    """
+    Reads go to a replica within requests allowed to use them, unless the
+    session has written: then it reads its writes from the primary. Replicas
+    lagging more than POSTGRES_REPLICA_MAX_LAG are skipped, with none left the
+    primary serves the reads.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or not isinstance(clause, Select):
+            # flushes, DML, textual statements and session.connection() may write
+            self.info["wrote"] = True
+        elif (
+            self.info.get("replica_reads")
+            and not self.info.get("wrote")
+            and clause._for_update_arg is None
+        ):
+            replica = pick_replica()
+            if replica is not None:
+                metrics.DB_READS.labels("replica").inc()
+                return replica.engine
+            metrics.DB_READS.labels("primary").inc()
+        return engine
+
+
+def pick_replica() -> Optional[Replica]:
+    fresh = [
+        replica
+        for replica in replicas
+        if replica.lag is not None and replica.lag <= config.POSTGRES_REPLICA_MAX_LAG
+    ]
+    return random.choice(fresh) if fresh else None
+
+
+def primary_lsn() -> Optional[str]:
+    """WAL position of the primary, None if it is not postgres or unreachable."""
+    if engine.dialect.name != "postgresql":
+        return None
+    try:
+        with engine.connect() as connection:
+            return connection.execute(text(PRIMARY_LSN_QUERY)).scalar()
+    except SQLAlchemyError as e:
+        # replicas are then measured by the age of their last replayed commit
+        logger.warning(f"WAL position of the primary is unknown: {e!r}")
+        return None
+
+
+def check_replicas():
+    # before the replicas: replaying it means being as fresh as the check
+    lsn = primary_lsn()
+    for replica in replicas:
+        replica.measure_lag(lsn)
+
+
+def allow_replica_reads(allowed: bool = True):
+    """Let reads of the current session go to replicas, see RoutingSession."""
+    session().info["replica_reads"] = allowed and bool(replicas)
+
+
+@contextmanager
+def primary_reads():
+    """Read from the primary within the block, e.g. right after a write elsewhere."""
+    info = session().info
+    allowed = info.get("replica_reads")
+    info["replica_reads"] = False
+    try:
+        yield
+    finally:
+        info["replica_reads"] = allowed
+
+
+engine: Engine = create_engine(
+    config.POSTGRES_URI,
+    poolclass=TimedQueuePool,
+    pool_size=config.POSTGRES_POOL_SIZE,
+    max_overflow=config.POSTGRES_MAX_OVERFLOW,
+    pool_timeout=config.POSTGRES_POOL_TIMEOUT,
+    pool_pre_ping=config.POSTGRES_POOL_PRE_PING,
+    pool_recycle=config.POSTGRES_POOL_RECYCLE,
+)
+metrics.instrument_engine(engine)
+replicas = [
+    Replica(f"replica-{number}", uri)
+    for number, uri in enumerate(config.POSTGRES_REPLICA_URIS, 1)
+]
+session = scoped_session(
+    sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False, bind=engine)
+)
 Base = declarative_base()
 
 
+def upgrade_schema():
+    """
+    Migrate to the latest revision. A database created by create_all before
+    migrations is stamped with the baseline first.
+    """
+    from alembic import command
+    from alembic.config import Config
+
+    alembic_config = Config(ALEMBIC_INI)
+    with engine.begin() as connection:
+        alembic_config.attributes["connection"] = connection
+        tables = inspect(connection).get_table_names()
+        if "users" in tables and "alembic_version" not in tables:
+            logger.info(f"stamping the schema made by create_all: {BASELINE_REVISION}")
+            command.stamp(alembic_config, BASELINE_REVISION)
+        command.upgrade(alembic_config, "head")
+
+
 def init_db():
+    """Deploy step, see flask initdb: migrations and login history partitions."""
     logger.info("init_db")
+    from storage import partitions
+
+    upgrade_schema()
+
+    if not partitions.is_supported():
+        return
+    with engine.begin() as connection:
+        if not partitions.is_partitioned(connection):
+            logger.warning(
+                "login history is not partitioned, run partition-login-history"
+            )
+            return
+        partitions.create_partitions(connection, config.LOGIN_HISTORY_PARTITIONS_AHEAD)
+
+
+def drop_all():
     import storage.db_models  # noqa: F401
 
-    Base.metadata.create_all(bind=engine)
+    Base.metadata.drop_all(bind=engine)
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE IF EXISTS alembic_version"))
+
+
+def warm_up(connections: int):
+    """Open connections of the pool ahead of the first requests."""
+    opened = [engine.connect() for _ in range(min(connections, engine.pool.size()))]
+    for connection in opened:
+        connection.close()
+
+
+def release_connections():
+    """Close connections before forking, workers must not share them."""
+    engine.dispose()
+    for replica in replicas:
+        replica.engine.dispose()
@@ -3,11 +3,24 @@ import uuid
 from datetime import datetime
 from typing import Optional
 
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import (
+    Boolean,
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    Text,
+    select,
+    text,
+    tuple_,
+)
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import backref, relationship
+from sqlalchemy.sql import Select
 
-from api.models import UserLoginRecord
+from api.models import LoginHistoryCursor, UserLoginRecord
 from storage.db import Base, session
 
 logger = logging.getLogger(__name__)
@@ -29,8 +42,13 @@ class User(Base):
 
     active = Column(Boolean, default=True, nullable=False)
     roles = relationship(
-        "Role", secondary="roles_users", backref=backref("users", lazy="dynamic")
+        "Role",
+        secondary="roles_users",
+        backref=backref("users", lazy="dynamic"),
     )
+    # bumped on every change of roles, refresh tokens with an older "rv" claim
+    # are rejected
+    roles_version = Column(Integer, default=0, server_default="0", nullable=False)
 
     logins = relationship(
         "LoginRecord",
@@ -67,6 +85,10 @@ class Role(Base):
     name = Column(String(80), unique=True)
     description = Column(String(255))
 
+    @classmethod
+    def get_by_name(cls, name: str) -> Optional["Role"]:
+        return session.query(cls).filter_by(name=name).one_or_none()
+
 
 class RolesUsers(Base):
     __tablename__ = "roles_users"
@@ -77,12 +99,21 @@ class RolesUsers(Base):
 
 class LoginRecord(Base):
     __tablename__ = "login_entries"
-    id = Column(Integer, primary_key=True, unique=True)
+    __table_args__ = (
+        # serves user history pages: filter by user, keyset order by (timestamp, id)
+        Index("ix_login_entries_user_id_timestamp_id", "user_id", "timestamp", "id"),
+        # monthly partitions are managed by storage.partitions
+        {"postgresql_partition_by": "RANGE (timestamp)"},
+    )
+    # the partition key has to be a part of the primary key
+    id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column("user_id", UUID(as_uuid=True), ForeignKey("users.id"))
     user_agent = Column(String)
     platform = Column(String(100))
     browser = Column(String(255))
-    timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
+    timestamp = Column(
+        DateTime, primary_key=True, default=datetime.utcnow, nullable=False
+    )
     ip = Column(String(100))
 
     def __init__(self, user_id, platform, browser, user_agent, ip):
@@ -92,11 +123,64 @@ class LoginRecord(Base):
         self.user_agent = user_agent
         self.ip = ip
 
+    @classmethod
+    def history_query(
+        cls,
+        user_id,
+        limit: int,
+        after: Optional[LoginHistoryCursor] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> Select:
+        query = select(cls).where(cls.user_id == user_id)
+        if since:
+            query = query.where(cls.timestamp >= since)
+        if until:
+            query = query.where(cls.timestamp < until)
+        if after:
+            query = query.where(
+                tuple_(cls.timestamp, cls.id) < (after.timestamp, after.id)
+            )
+        return query.order_by(cls.timestamp.desc(), cls.id.desc()).limit(limit)
+
+    @classmethod
+    def get_user_history(cls, user_id, limit: int, **filters) -> list["LoginRecord"]:
+        query = cls.history_query(user_id, limit, **filters)
+        return session.execute(query).scalars().all()
+
+    def to_cursor(self) -> LoginHistoryCursor:
+        return LoginHistoryCursor(timestamp=self.timestamp, id=self.id)
+
     def to_api_model(self) -> UserLoginRecord:
-        return UserLoginRecord(
+        # trusted data, not validated again
+        return UserLoginRecord.construct(
             user_agent=self.user_agent,
             platform=self.platform,
             browser=self.browser,
             timestamp=self.timestamp,
             ip=self.ip,
         )
+
+
+class SigningKey(Base):
+    """
+    JWT signing key. A new key is published in JWKS before it is activated,
+    a deactivated key loses its private part and only verifies old tokens.
+    """
+
+    __tablename__ = "signing_keys"
+    __table_args__ = (
+        Index(
+            "uq_signing_keys_active",
+            "active",
+            unique=True,
+            postgresql_where=text("active"),
+        ),
+    )
+    kid = Column(String(64), primary_key=True)
+    algorithm = Column(String(16), nullable=False)
+    private_key = Column(Text)
+    public_key = Column(Text, nullable=False)
+    active = Column(Boolean, default=False, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    deactivated_at = Column(DateTime)
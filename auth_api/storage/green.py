@@ -0,0 +1,28 @@
+"""
+psycopg2 is a C extension, gevent's monkey patching does not reach its sockets
+and every query would block the whole worker. With a wait callback psycopg2
+runs its connections in non-blocking mode and waits for the socket through the
+gevent hub, so other greenlets run while a query is in flight.
+"""
+
+import psycopg2
+from gevent.socket import wait_read, wait_write
+from psycopg2 import extensions
+
+
+def patch_psycopg():
+    """Call once after monkey.patch_all(), before the first connection."""
+    extensions.set_wait_callback(gevent_wait_callback)
+
+
+def gevent_wait_callback(connection, timeout=None):
+    while True:
+        state = connection.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(connection.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(connection.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f"Bad result from poll: {state!r}")
@@ -0,0 +1,200 @@
+"""
+Monthly range partitions of login_entries.
+
+Partitions are created ahead of time, partitions older than the retention
+period are dropped or detached as a whole instead of deleting rows.
+A default partition catches rows if maintenance did not run in time, the next
+run moves them into partitions of their months.
+"""
+
+import logging
+import re
+from datetime import date, datetime
+from typing import Optional
+
+from sqlalchemy import text
+
+from storage.db import engine
+from storage.db_models import LoginRecord
+
+logger = logging.getLogger(__name__)
+
+PARENT = LoginRecord.__tablename__
+DEFAULT_PARTITION = f"{PARENT}_default"
+PARTITION_RE = re.compile(rf"^{PARENT}_y(\d{{4}})m(\d{{2}})$")
+COLUMNS = ", ".join(column.name for column in LoginRecord.__table__.columns)
+# any constant shared by all workers, keeps concurrent maintenance runs apart
+ADVISORY_LOCK_ID = 0x6C6F67696E
+
+
+def is_supported() -> bool:
+    return engine.dialect.name == "postgresql"
+
+
+def add_months(month: date, count: int) -> date:
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"{PARENT}_y{month.year}m{month.month:02d}"
+
+
+def list_partitions(connection) -> dict[str, date]:
+    rows = connection.execute(
+        text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = :parent"
+        ),
+        {"parent": PARENT},
+    )
+    partitions = {}
+    for (name,) in rows:
+        match = PARTITION_RE.match(name)
+        if match:
+            partitions[name] = date(int(match[1]), int(match[2]), 1)
+    return partitions
+
+
+def default_partition_months(connection) -> list[date]:
+    """Months of the rows the default partition caught."""
+    exists = connection.execute(
+        text("SELECT to_regclass(:name)"), {"name": DEFAULT_PARTITION}
+    ).scalar()
+    if exists is None:
+        return []
+    rows = connection.execute(
+        text(
+            f"SELECT DISTINCT date_trunc('month', timestamp)::date "
+            f"FROM {DEFAULT_PARTITION}"
+        )
+    )
+    return [month for (month,) in rows]
+
+
+def create_partitions(connection, months_ahead: int, start: Optional[date] = None):
+    current = date.today().replace(day=1)
+    month = (start or current).replace(day=1)
+    months = []
+    while month <= add_months(current, months_ahead):
+        months.append(month)
+        month = add_months(month, 1)
+    # a partition for rows of the default one cannot be created while they are
+    # there: the default is detached, the rows go to their new partitions
+    stray = default_partition_months(connection)
+    if stray:
+        connection.execute(
+            text(f"ALTER TABLE {PARENT} DETACH PARTITION {DEFAULT_PARTITION}")
+        )
+
+    created = []
+    existing = list_partitions(connection)
+    for month in sorted(set(months + stray)):
+        name = partition_name(month)
+        if name not in existing:
+            connection.execute(
+                text(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {PARENT} "
+                    f"FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')"
+                )
+            )
+            created.append(name)
+
+    if stray:
+        moved = connection.execute(
+            text(
+                f"INSERT INTO {PARENT} ({COLUMNS}) "
+                f"SELECT {COLUMNS} FROM {DEFAULT_PARTITION}"
+            )
+        ).rowcount
+        connection.execute(text(f"TRUNCATE {DEFAULT_PARTITION}"))
+        connection.execute(
+            text(f"ALTER TABLE {PARENT} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT")
+        )
+        logger.warning(f"moved {moved} rows out of {DEFAULT_PARTITION}")
+    connection.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF {PARENT} DEFAULT"
+        )
+    )
+    return created
+
+
+def remove_expired_partitions(
+    connection, retention_months: int, detach: bool = False
+) -> list[str]:
+    """Drop (or only detach) partitions entirely older than retention_months."""
+    cutoff = add_months(date.today().replace(day=1), -retention_months)
+    removed = []
+    for name, month in sorted(list_partitions(connection).items()):
+        if add_months(month, 1) > cutoff:
+            continue
+        if detach:
+            connection.execute(text(f"ALTER TABLE {PARENT} DETACH PARTITION {name}"))
+        else:
+            connection.execute(text(f"DROP TABLE {name}"))
+        removed.append(name)
+    return removed
+
+
+def maintain(months_ahead: int, retention_months: int, detach: bool = False):
+    with engine.begin() as connection:
+        locked = connection.execute(
+            text("SELECT pg_try_advisory_xact_lock(:id)"), {"id": ADVISORY_LOCK_ID}
+        ).scalar()
+        if not locked:
+            logger.debug("partition maintenance is running elsewhere")
+            return [], []
+        created = create_partitions(connection, months_ahead)
+        removed = remove_expired_partitions(connection, retention_months, detach)
+    logger.info(f"login history partitions: {created=}, {removed=}")
+    return created, removed
+
+
+def is_partitioned(connection) -> bool:
+    kind = connection.execute(
+        text("SELECT relkind FROM pg_class WHERE relname = :name"), {"name": PARENT}
+    ).scalar()
+    return kind == "p"
+
+
+def convert_legacy_table(months_ahead: int):
+    """
+    Move rows of a login_entries heap table created before partitioning into
+    the partitioned table. Runs in one transaction and locks the table for
+    the duration of the copy.
+    """
+    legacy = f"{PARENT}_legacy"
+    with engine.begin() as connection:
+        if is_partitioned(connection):
+            logger.info(f"{PARENT} is already partitioned")
+            return 0
+        for statement in (
+            f"ALTER TABLE {PARENT} RENAME TO {legacy}",
+            f"ALTER INDEX IF EXISTS {PARENT}_pkey RENAME TO {legacy}_pkey",
+            f"ALTER INDEX IF EXISTS {PARENT}_id_key RENAME TO {legacy}_id_key",
+            "ALTER INDEX IF EXISTS ix_login_entries_user_id_timestamp_id "
+            f"RENAME TO ix_{legacy}_user_id_timestamp_id",
+            f"ALTER SEQUENCE IF EXISTS {PARENT}_id_seq RENAME TO {legacy}_id_seq",
+        ):
+            connection.execute(text(statement))
+
+        LoginRecord.__table__.create(connection)
+        oldest: Optional[datetime] = connection.execute(
+            text(f"SELECT min(timestamp) FROM {legacy}")
+        ).scalar()
+        create_partitions(connection, months_ahead, start=oldest and oldest.date())
+
+        copied = connection.execute(
+            text(f"INSERT INTO {PARENT} ({COLUMNS}) SELECT {COLUMNS} FROM {legacy}")
+        ).rowcount
+        connection.execute(
+            text(
+                f"SELECT setval(pg_get_serial_sequence('{PARENT}', 'id'), "
+                f"coalesce((SELECT max(id) FROM {PARENT}), 0) + 1, false)"
+            )
+        )
+        connection.execute(text(f"DROP TABLE {legacy}"))
+    return copied
@@ -0,0 +1,169 @@
+"""
+Compaction of user:{user_id}:device_tokens hashes.
+
+A device field outlives its token while other devices of the user keep the
+hash alive. The compactor walks the hashes with SCAN in batches, drops the
+fields whose token has expired and sets the TTL of each hash to the TTL of its
+newest token. Expiry is read from the "jti:exp" value, for fields of the layout
+before device fingerprints from the TTL of their token:{jti} key.
+"""
+
+import logging
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Optional
+
+import redis
+
+import token_store
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = "device_tokens_compactor:lock"
+
+
+@dataclass
+class CompactionReport:
+    keys_scanned: int = 0
+    fields_scanned: int = 0
+    fields_removed: int = 0
+    keys_expired: int = 0
+    bytes_reclaimed: int = 0
+    seconds: float = 0.0
+
+    def __str__(self):
+        return (
+            f"scanned {self.keys_scanned} hashes with {self.fields_scanned} devices, "
+            f"removed {self.fields_removed} devices, set ttl on {self.keys_expired} hashes, "
+            f"reclaimed {self.bytes_reclaimed} bytes in {self.seconds:.1f}s"
+        )
+
+
+def compact(
+    batch_size: int = 500, max_keys_per_second: int = 0, dry_run: bool = False
+) -> CompactionReport:
+    report = CompactionReport()
+    started = time.monotonic()
+    measure = _memory_usage_supported()
+    batch = []
+    for key in token_store.client.scan_iter(
+        token_store.DEVICE_TOKENS_PATTERN, count=batch_size
+    ):
+        batch.append(key)
+        if len(batch) >= batch_size:
+            _compact_batch(batch, dry_run, measure, report)
+            batch = []
+            _throttle(report.keys_scanned, started, max_keys_per_second)
+    if batch:
+        _compact_batch(batch, dry_run, measure, report)
+    report.seconds = time.monotonic() - started
+    return report
+
+
+def compact_exclusive(batch_size: int, max_keys_per_second: int, lock_ttl: int):
+    """Scheduled run: only one worker in the deployment compacts per lock_ttl."""
+    if not token_store.client.set(LOCK_KEY, 1, nx=True, ex=lock_ttl):
+        logger.debug("device tokens compaction is running elsewhere")
+        return
+    report = compact(batch_size, max_keys_per_second)
+    logger.info(f"device tokens compaction: {report}")
+
+
+def _memory_usage_supported() -> bool:
+    try:
+        token_store.client.memory_usage(LOCK_KEY)
+    except redis.ResponseError:
+        logger.warning("MEMORY USAGE is not available, reporting payload bytes")
+        return False
+    return True
+
+
+def _throttle(keys_done: int, started: float, max_keys_per_second: int):
+    if not max_keys_per_second:
+        return
+    ahead = keys_done / max_keys_per_second - (time.monotonic() - started)
+    if ahead > 0:
+        time.sleep(ahead)
+
+
+def _compact_batch(
+    keys: list[str], dry_run: bool, measure: bool, report: CompactionReport
+):
+    client = token_store.client
+
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+        pipe.pttl(key)
+    replies = pipe.execute()
+    hashes, hash_ttls = replies[0::2], replies[1::2]
+
+    fields = [
+        (key, device_id, value)
+        for key, devices in zip(keys, hashes)
+        for device_id, value in devices.items()
+    ]
+    pipe = client.pipeline(transaction=False)
+    for _, _, value in fields:
+        if ":" not in value:
+            pipe.pttl(token_store.token_key(value))
+    legacy_ttls = iter(pipe.execute())
+
+    now = time.time()
+    dead = defaultdict(list)
+    newest = defaultdict(int)
+    for key, device_id, value in fields:
+        ttl = _ttl_ms(value, now) if ":" in value else next(legacy_ttls)
+        if ttl == -2:
+            dead[key] += [device_id, value]
+        elif ttl > 0:
+            newest[key] = max(newest[key], ttl)
+
+    changed = [
+        key
+        for key, hash_ttl in zip(keys, hash_ttls)
+        if dead[key] or (newest[key] and (hash_ttl == -1 or hash_ttl < newest[key]))
+    ]
+
+    report.keys_scanned += len(keys)
+    report.fields_scanned += len(fields)
+    if dry_run or not changed:
+        report.fields_removed += sum(len(dead[key]) // 2 for key in changed)
+        report.keys_expired += sum(1 for key in changed if newest[key])
+        report.bytes_reclaimed += _payload_size(changed, dead)
+        return
+
+    sizes_before = _memory_usage(changed) if measure else None
+
+    removed = token_store.run_scripts(
+        token_store.compact_script,
+        [([key], [newest[key], *dead[key]]) for key in changed],
+    )
+
+    report.fields_removed += sum(removed)
+    report.keys_expired += sum(1 for key in changed if newest[key])
+    if measure:
+        sizes_after = _memory_usage(changed)
+        report.bytes_reclaimed += sum(
+            before - (after or 0) for before, after in zip(sizes_before, sizes_after)
+        )
+    else:
+        report.bytes_reclaimed += _payload_size(changed, dead)
+
+
+def _ttl_ms(value: str, now: float) -> int:
+    """TTL of a "jti:exp" value in PTTL terms, -2 for an expired token."""
+    ttl = int((int(value.rpartition(":")[2]) - now) * 1000)
+    return ttl if ttl > 0 else -2
+
+
+def _payload_size(keys: list[str], dead: dict[str, list[str]]) -> int:
+    return sum(len(value) for key in keys for value in dead[key])
+
+
+def _memory_usage(keys: list[str]) -> list[Optional[int]]:
+    pipe = token_store.client.pipeline(transaction=False)
+    for key in keys:
+        pipe.memory_usage(key)
+    return pipe.execute()
@@ -0,0 +1,164 @@
+"""
+Migration of user:{user_id}:device_tokens hashes to the current layout.
+
+Before fingerprints a hash field was the raw User-Agent and every refresh token
+had its own token:{jti} key. Before hash tags the hash was named without braces
+around the user id. The migration walks the hashes with SCAN in batches, merges
+untagged hashes into the tagged ones and moves every User-Agent field to its
+device id with a "jti:exp" value, taking exp from the TTL of the token key and
+deleting the key. Tokens already issued keep working: their device claim is
+still the User-Agent and maps to the same device id.
+
+Both old layouts only exist on a standalone redis or behind sentinel.
+"""
+
+import logging
+import time
+from dataclasses import dataclass
+
+import redis
+
+import token_store
+
+logger = logging.getLogger(__name__)
+
+# KEYS[1] - user devices hash, KEYS[2] - its name without hash tag,
+# ARGV: legacy_field1, device_id1, legacy_field2...
+# A device that got a token in the new layout meanwhile keeps it.
+MIGRATE_SCRIPT = token_store.MERGE_LEGACY_KEY + """
+local now = tonumber(redis.call("TIME")[1])
+local moved = 0
+local newest = 0
+for i = 1, #ARGV, 2 do
+    local jti = redis.call("HGET", KEYS[1], ARGV[i])
+    if jti and not string.find(jti, ":", 1, true) then
+        local ttl = redis.call("PTTL", "token:" .. jti)
+        redis.call("HDEL", KEYS[1], ARGV[i])
+        redis.call("DEL", "token:" .. jti)
+        if ttl > 0 then
+            local exp = now + math.ceil(ttl / 1000)
+            moved = moved + redis.call("HSETNX", KEYS[1], ARGV[i + 1], jti .. ":" .. exp)
+            newest = math.max(newest, ttl)
+        end
+    end
+end
+if newest > 0 then
+    local current = redis.call("PTTL", KEYS[1])
+    if current == -1 or current < newest then
+        redis.call("PEXPIRE", KEYS[1], newest)
+    end
+end
+return moved
+"""
+
+
+@dataclass
+class MigrationReport:
+    keys_scanned: int = 0
+    keys_migrated: int = 0
+    sessions_moved: int = 0
+    sessions_before: int = 0
+    sessions_after: int = 0
+    bytes_before: int = 0
+    bytes_after: int = 0
+    measured: bool = True
+    seconds: float = 0.0
+
+    def __str__(self):
+        summary = (
+            f"scanned {self.keys_scanned} hashes, migrated {self.keys_migrated} "
+            f"with {self.sessions_moved} sessions in {self.seconds:.1f}s"
+        )
+        if not self.measured:
+            return summary
+        before = self.bytes_before / max(self.sessions_before, 1)
+        after = self.bytes_after / max(self.sessions_after, 1)
+        return f"{summary}; bytes per session: {before:.0f} before, {after:.0f} after"
+
+
+def migrate(batch_size: int = 500, dry_run: bool = False) -> MigrationReport:
+    """
+    Bytes are MEMORY USAGE of the migrated hashes with their token keys before
+    and of the hashes after, divided by the sessions they hold.
+    """
+    report = MigrationReport(measured=_memory_usage_supported())
+    started = time.monotonic()
+    script = token_store.client.register_script(MIGRATE_SCRIPT)
+    batch = []
+    for key in token_store.client.scan_iter(
+        token_store.DEVICE_TOKENS_PATTERN, count=batch_size
+    ):
+        batch.append(key)
+        if len(batch) >= batch_size:
+            _migrate_batch(batch, script, dry_run, report)
+            batch = []
+    if batch:
+        _migrate_batch(batch, script, dry_run, report)
+    report.seconds = time.monotonic() - started
+    return report
+
+
+def _migrate_batch(keys: list[str], script, dry_run: bool, report: MigrationReport):
+    client = token_store.client
+
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+    hashes = pipe.execute()
+    report.keys_scanned += len(keys)
+
+    # key -> (keys of the script, legacy fields)
+    todo = {}
+    for key, devices in zip(keys, hashes):
+        legacy = [(field, jti) for field, jti in devices.items() if ":" not in jti]
+        if "{" not in key:
+            user_id = key.split(":")[1]
+            todo[key] = (token_store.devices_keys(user_id), legacy)
+        elif legacy:
+            todo[key] = ([key], legacy)
+    if not todo:
+        return
+
+    sessions = {key: len(devices) for key, devices in zip(keys, hashes)}
+    report.sessions_before += sum(sessions[key] for key in todo)
+    token_keys = [
+        token_store.token_key(jti) for _, legacy in todo.values() for _, jti in legacy
+    ]
+    if report.measured:
+        report.bytes_before += sum(_memory_usage([*todo, *token_keys]))
+    if dry_run:
+        return
+
+    calls = []
+    for script_keys, legacy in todo.values():
+        args = []
+        for field, _ in legacy:
+            args += [field, token_store.user_agent_to_device_id(field)]
+        calls.append((script_keys, args))
+    moved = token_store.run_scripts(script, calls)
+
+    targets = list({script_keys[0]: None for script_keys, _ in todo.values()})
+    pipe = client.pipeline(transaction=False)
+    for key in targets:
+        pipe.hlen(key)
+    report.sessions_after += sum(pipe.execute())
+    if report.measured:
+        report.bytes_after += sum(_memory_usage(targets))
+    report.keys_migrated += len(todo)
+    report.sessions_moved += sum(moved)
+
+
+def _memory_usage_supported() -> bool:
+    try:
+        token_store.client.memory_usage(token_store.DEVICE_TOKENS_PATTERN)
+    except redis.ResponseError:
+        logger.warning("MEMORY USAGE is not available, bytes are not reported")
+        return False
+    return True
+
+
+def _memory_usage(keys: list[str]) -> list[int]:
+    pipe = token_store.client.pipeline(transaction=False)
+    for key in keys:
+        pipe.memory_usage(key)
+    return [size or 0 for size in pipe.execute()]
@@ -1,68 +1,418 @@
 """
-Девайсы пользователя будут храниться в redis hash map,
-а токены будут храниться в key-value.
+Девайсы пользователя и их refresh токены хранятся в одном redis hash:
 
-user:{user_id}:device_tokens = {device_id1: jti1, device_id2: jti2}
-token:{jti} = 1
+user:{user_id}:device_tokens = {device_id1: "jti1:exp1", device_id2: "jti2:exp2"}
+
+device_id - отпечаток User-Agent фиксированной длины, а exp - unix время
+истечения токена. Поля и значения короче hash-max-listpack-value (64 байта),
+поэтому хеш пользователя хранится в компактной кодировке. TTL хеша - TTL
+самого нового токена, истекшие поля удаляет token_compactor.
+
+Раньше полем был сам User-Agent, а токен хранился отдельным ключом
+token:{jti} = 1. Такие поля продолжают работать, пока их не перенесёт
+`flask migrate-device-tokens` или первая ротация токена девайса.
+
+{user_id} в фигурных скобках - hash tag: в Redis Cluster все ключи
+пользователя (хеш девайсов и revoked:user:{user_id}) лежат в одном слоте,
+а скрипты работают только с ключами одного слота. Хеши без hash tag
+остались от раскладки до кластера, на одиночном redis и за sentinel их
+вливает в новый хеш первая запись или миграция. В кластере старых ключей нет.
 """
 
+import base64
+import hashlib
 import logging
-from typing import Optional
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Optional, Union
 
 import redis
-from werkzeug.useragents import UserAgent
+from redis.backoff import EqualJitterBackoff
+from redis.cluster import ClusterNode, RedisCluster
+from redis.retry import Retry
+from redis.sentinel import Sentinel
+
+import metrics
+from circuit_breaker import CircuitBreaker
+from config import config
 
 logger = logging.getLogger(__name__)
 
-client: Optional[redis.StrictRedis] = None
+# Скрипты не идемпотентны: повтор после таймаута чтения мог бы второй раз
+# выполнить ротацию, поэтому повторяются только ошибки соединения.
+RETRY_ERRORS = (redis.ConnectionError,)
+BREAKER_ERRORS = (redis.ConnectionError, redis.TimeoutError)
+
+DEVICE_ID_BYTES = 12
+# Claim с отпечатком девайса. Токены, выданные до отпечатков, несут User-Agent
+# в "device", он же поле хеша в старой раскладке.
+DEVICE_CLAIM = "device_id"
+LEGACY_DEVICE_CLAIM = "device"
+USER_AGENT_CACHE_SIZE = 10_000
+
+client: Optional[Union[redis.StrictRedis, RedisCluster]] = None
+breaker: Optional[CircuitBreaker] = None
 refresh_token_ttl = None
 
+# Скрипты выполняются атомарно и за один запрос к redis.
+# Значение поля без ":" - jti в старой раскладке с ключом token:{jti}.
 
-def init(host: str, port: int, rf_token_ttl: int):
-    global client, refresh_token_ttl
-    client = redis.StrictRedis(host=host, port=port, decode_responses=True)
-    refresh_token_ttl = rf_token_ttl
+# Хеш без hash tag (KEYS[2], только не в кластере) вливается в KEYS[1].
+MERGE_LEGACY_KEY = """
+if KEYS[2] and redis.call("EXISTS", KEYS[2]) == 1 then
+    local ttl = redis.call("PTTL", KEYS[2])
+    local entries = redis.call("HGETALL", KEYS[2])
+    for i = 1, #entries, 2 do
+        redis.call("HSETNX", KEYS[1], entries[i], entries[i + 1])
+    end
+    redis.call("DEL", KEYS[2])
+    if ttl > 0 and redis.call("PTTL", KEYS[1]) < ttl then
+        redis.call("PEXPIRE", KEYS[1], ttl)
+    end
+end
+"""
 
+# KEYS[1] - user devices hash, KEYS[2] - its name without hash tag,
+# ARGV: device_id, "new_jti:exp", ttl, expected_jti or "", legacy field or "".
+# Если текущий токен девайса не совпадает с ожидаемым, то предъявленный токен
+# уже был использован: девайс разлогинивается.
+ROTATE_SCRIPT = MERGE_LEGACY_KEY + """
+local current = redis.call("HGET", KEYS[1], ARGV[1])
+if ARGV[5] ~= "" then
+    local legacy = redis.call("HGET", KEYS[1], ARGV[5])
+    if legacy then
+        redis.call("HDEL", KEYS[1], ARGV[5])
+        if redis.call("DEL", "token:" .. legacy) == 1 and not current then
+            current = legacy .. ":"
+        end
+    end
+end
+if ARGV[4] ~= "" and (not current or string.sub(current, 1, #ARGV[4] + 1) ~= ARGV[4] .. ":") then
+    if current then
+        redis.call("HDEL", KEYS[1], ARGV[1])
+    end
+    return 0
+end
+redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+redis.call("EXPIRE", KEYS[1], ARGV[3])
+return 1
+"""
 
-def user_agent_to_device_id(user_agent: UserAgent) -> str:
-    return user_agent.string
+# KEYS[1] - user devices hash, KEYS[2] - its name without hash tag,
+# ARGV - fields of the device
+REVOKE_DEVICE_SCRIPT = MERGE_LEGACY_KEY + """
+local removed = 0
+for _, field in ipairs(ARGV) do
+    local value = redis.call("HGET", KEYS[1], field)
+    if value then
+        if not string.find(value, ":", 1, true) then
+            redis.call("DEL", "token:" .. value)
+        end
+        redis.call("HDEL", KEYS[1], field)
+        removed = removed + 1
+    end
+end
+return removed
+"""
 
+# KEYS[1] - user devices hash, KEYS[2] - its name without hash tag
+REVOKE_ALL_SCRIPT = MERGE_LEGACY_KEY + """
+local values = redis.call("HVALS", KEYS[1])
+for _, value in ipairs(values) do
+    if not string.find(value, ":", 1, true) then
+        redis.call("DEL", "token:" .. value)
+    end
+end
+redis.call("DEL", KEYS[1])
+return #values
+"""
 
-def does_refresh_token_exist(token_id: str) -> bool:
-    return client.exists(f"token:{token_id}")
+# KEYS[1] - user devices hash, ARGV: ttl_ms, device_id1, value1, device_id2, value2...
+# Поле удаляется только если девайс не получил новый токен после проверки,
+# а ttl хеша может только увеличиться.
+COMPACT_SCRIPT = """
+local removed = 0
+for i = 2, #ARGV, 2 do
+    if redis.call("HGET", KEYS[1], ARGV[i]) == ARGV[i + 1] then
+        redis.call("HDEL", KEYS[1], ARGV[i])
+        removed = removed + 1
+    end
+end
+local ttl = tonumber(ARGV[1])
+if ttl > 0 then
+    local current = redis.call("PTTL", KEYS[1])
+    if current == -1 or current < ttl then
+        redis.call("PEXPIRE", KEYS[1], ttl)
+    end
+end
+return removed
+"""
 
+# matches the hashes with and without hash tag
+DEVICE_TOKENS_PATTERN = "user:*:device_tokens"
 
-def replace_refresh_token(jti, user_id, device_id):
-    remove_refresh_token(user_id, device_id)
-    put_refresh_token(user_id, device_id, jti)
+rotate_script = None
+revoke_device_script = None
+revoke_all_script = None
+compact_script = None
 
 
-def put_refresh_token(user_id, device_id, jti):
-    client.hset(f"user:{user_id}:device_tokens", device_id, jti)
-    logger.debug(f"put token with expiration: {refresh_token_ttl=}")
-    client.set(f"token:{jti}", 1, ex=refresh_token_ttl)
-    logger.debug(
-        f'current_keys: {client.keys("*")}, devices: {client.hgetall(f"user:{user_id}:device_tokens")}'
+def connection_options(retry_class=Retry) -> dict:
+    """Timeouts and retries shared by the sync and the async clients."""
+    return dict(
+        socket_timeout=config.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=config.REDIS_CONNECT_TIMEOUT,
+        health_check_interval=config.REDIS_HEALTH_CHECK_INTERVAL,
+        retry=retry_class(
+            EqualJitterBackoff(
+                config.REDIS_RETRY_BACKOFF_CAP, config.REDIS_RETRY_BACKOFF_BASE
+            ),
+            config.REDIS_RETRIES,
+            supported_errors=RETRY_ERRORS,
+        ),
     )
 
 
-def remove_refresh_token(user_id, device_id):
-    jti = client.hget(f"user:{user_id}:device_tokens", device_id)
-    if jti:
-        del client[f"token:{jti}"]
-    client.hdel(f"user:{user_id}:device_tokens", device_id)
-    logger.debug(f"removed token: {jti=}, {user_id=}, {device_id=}")
-    logger.debug(
-        f'current_keys: {client.keys("*")}, devices: {client.hgetall(f"user:{user_id}:device_tokens")}'
+def new_breaker(name: str) -> CircuitBreaker:
+    return CircuitBreaker(
+        name,
+        config.REDIS_BREAKER_FAILURES,
+        config.REDIS_BREAKER_RESET_TIMEOUT,
+        BREAKER_ERRORS,
     )
 
 
-def remove_all_user_refresh_tokens(user_id):
-    token_ids = client.hvals(f"user:{user_id}:device_tokens")
-    for token_id in token_ids:
-        del client[f"token:{token_id}"]
-    del client[f"user:{user_id}:device_tokens"]
+def parse_nodes(sockets: str) -> list[tuple[str, int]]:
+    nodes = []
+    for socket in sockets.split(","):
+        host, port = socket.strip().rsplit(":", 1)
+        nodes.append((host, int(port)))
+    return nodes
+
+
+def is_cluster() -> bool:
+    return config.REDIS_MODE == "cluster"
+
 
-    logger.debug(
-        f'current_keys: {client.keys("*")}, devices: {client.hgetall(f"user:{user_id}:device_tokens")}'
+def connect(sockets: str) -> Union[redis.StrictRedis, RedisCluster]:
+    """Client of REDIS_MODE: a standalone redis, a sentinel master or a cluster."""
+    nodes = parse_nodes(sockets)
+    options = dict(
+        max_connections=config.REDIS_MAX_CONNECTIONS,
+        decode_responses=True,
+        **connection_options(),
     )
+    if config.REDIS_MODE == "cluster":
+        startup_nodes = [ClusterNode(host, port) for host, port in nodes]
+        return RedisCluster(startup_nodes=startup_nodes, **options)
+    if config.REDIS_MODE == "sentinel":
+        sentinel = Sentinel(nodes, **options)
+        return sentinel.master_for(config.REDIS_SENTINEL_MASTER)
+    (host, port), *_ = nodes
+    pool = redis.BlockingConnectionPool(
+        host=host, port=port, timeout=config.REDIS_POOL_TIMEOUT, **options
+    )
+    return redis.StrictRedis(connection_pool=pool)
+
+
+def init(sockets: str, rf_token_ttl: int):
+    global client, breaker, refresh_token_ttl
+    global rotate_script, revoke_device_script, revoke_all_script, compact_script
+    client = connect(sockets)
+    breaker = new_breaker("redis")
+    refresh_token_ttl = rf_token_ttl
+    rotate_script = client.register_script(ROTATE_SCRIPT)
+    revoke_device_script = client.register_script(REVOKE_DEVICE_SCRIPT)
+    revoke_all_script = client.register_script(REVOKE_ALL_SCRIPT)
+    compact_script = client.register_script(COMPACT_SCRIPT)
+
+
+@contextmanager
+def command(name: str, circuit: Optional[CircuitBreaker] = None):
+    """Run a refresh token command behind the breaker and time its round trip."""
+    with (circuit or breaker).guard(), metrics.REDIS_SECONDS.labels(name).time():
+        yield
+
+
+def pool_stats() -> dict:
+    pool = getattr(client, "connection_pool", None)
+    if not isinstance(pool, redis.BlockingConnectionPool):
+        # sentinel and cluster pools create connections on demand
+        return {"max_connections": config.REDIS_MAX_CONNECTIONS, **breaker.stats()}
+    # the queue holds idle connections and None for the ones not created yet
+    idle = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+    return {
+        "max_connections": pool.max_connections,
+        "created": len(pool._connections),
+        "in_use": len(pool._connections) - idle,
+        **breaker.stats(),
+    }
+
+
+def warm_up(connections: int):
+    """Open connections of the pool ahead of the first requests."""
+    pool = getattr(client, "connection_pool", None)
+    if pool is None:
+        # the cluster client connects to its nodes when it is created
+        return
+    opened = [
+        pool.get_connection("PING")
+        for _ in range(min(connections, pool.max_connections))
+    ]
+    for connection in opened:
+        pool.release(connection)
+
+
+def release_connections():
+    """Close connections before forking, workers must not share them."""
+    if isinstance(client, RedisCluster):
+        client.disconnect_connection_pools()
+    else:
+        client.connection_pool.disconnect()
+
+
+def devices_key(user_id) -> str:
+    return f"user:{{{user_id}}}:device_tokens"
+
+
+def legacy_devices_key(user_id) -> str:
+    """Name of the hash before hash tags."""
+    return f"user:{user_id}:device_tokens"
+
+
+def devices_keys(user_id) -> list[str]:
+    """The hash and, outside a cluster, its name from before hash tags."""
+    if is_cluster():
+        return [devices_key(user_id)]
+    return [devices_key(user_id), legacy_devices_key(user_id)]
+
+
+def run_scripts(script, calls: list[tuple[list, list]]) -> list:
+    """
+    Run (keys, args) calls of a script with one pipeline. Cluster pipelines
+    refuse EVALSHA, there every call is a round trip to the shard of its keys.
+    """
+    if is_cluster():
+        return [script(keys=keys, args=args) for keys, args in calls]
+    pipe = client.pipeline(transaction=False)
+    for keys, args in calls:
+        script(keys=keys, args=args, client=pipe)
+    return pipe.execute()
+
+
+def token_key(jti) -> str:
+    """Key of a token in the layout before device fingerprints."""
+    return f"token:{jti}"
+
+
+@lru_cache(maxsize=USER_AGENT_CACHE_SIZE)
+def user_agent_to_device_id(user_agent: str) -> str:
+    digest = hashlib.blake2b(user_agent.encode(), digest_size=DEVICE_ID_BYTES)
+    return base64.urlsafe_b64encode(digest.digest()).decode()
+
+
+def device_fields(device_id: str, legacy_field: Optional[str] = None) -> list[str]:
+    """Hash fields of a device: its id and the field of the layout before it."""
+    return [device_id] if legacy_field is None else [device_id, legacy_field]
+
+
+def token_device_fields(jwt_payload: dict) -> list[str]:
+    """device_fields of the device a token was issued to."""
+    if DEVICE_CLAIM in jwt_payload:
+        return device_fields(jwt_payload[DEVICE_CLAIM])
+    user_agent = jwt_payload[LEGACY_DEVICE_CLAIM]
+    return device_fields(user_agent_to_device_id(user_agent), user_agent)
+
+
+def token_value(jti: str, ttl: int) -> str:
+    return f"{jti}:{int(time.time()) + ttl}"
+
+
+def token_matches(values: list[Optional[str]], jti: str) -> Optional[bool]:
+    """Whether jti is the token of the device, None to check token:{jti}."""
+    current, legacy = values[0], values[1] if len(values) > 1 else None
+    if current is not None:
+        return current.partition(":")[0] == jti
+    if legacy == jti:
+        return None
+    return False
+
+
+def does_refresh_token_exist(user_id, fields: list[str], token_id: str) -> bool:
+    keys = devices_keys(user_id)
+    with command("exists"):
+        values = client.hmget(keys[0], fields)
+        if len(keys) > 1 and not any(values):
+            values = client.hmget(keys[1], fields)
+        matches = token_matches(values, token_id)
+        if matches is None:
+            matches = bool(client.exists(token_key(token_id)))
+    return matches
+
+
+def refresh_tokens_exist(tokens: list[tuple[str, list[str], str]]) -> list[bool]:
+    """Check (user_id, device fields, jti) tokens with one pipeline."""
+    pipeline = client.pipeline(transaction=False)
+    for user_id, fields, _ in tokens:
+        pipeline.hmget(devices_key(user_id), fields)
+    with command("exists_many"):
+        results = pipeline.execute()
+    missing = [i for i, values in enumerate(results) if not any(values)]
+    if missing and not is_cluster():
+        pipeline = client.pipeline(transaction=False)
+        for i in missing:
+            user_id, fields, _ = tokens[i]
+            pipeline.hmget(legacy_devices_key(user_id), fields)
+        with command("exists_many"):
+            for i, values in zip(missing, pipeline.execute()):
+                results[i] = values
+    matches = [
+        token_matches(values, jti) for values, (_, _, jti) in zip(results, tokens)
+    ]
+    legacy = [i for i, match in enumerate(matches) if match is None]
+    if legacy:
+        pipeline = client.pipeline(transaction=False)
+        for i in legacy:
+            pipeline.exists(token_key(tokens[i][2]))
+        with command("exists_many"):
+            for i, exists in zip(legacy, pipeline.execute()):
+                matches[i] = bool(exists)
+    return matches
+
+
+def rotate_args(jti, fields: list[str], expected_jti, ttl: int) -> list:
+    return [
+        fields[0],
+        token_value(jti, ttl),
+        ttl,
+        expected_jti or "",
+        fields[1] if len(fields) > 1 else "",
+    ]
+
+
+def replace_refresh_token(jti, user_id, fields: list[str], expected_jti=None) -> bool:
+    """
+    Make jti the only refresh token of the device.
+    With expected_jti the rotation happens only if it is the current token of
+    the device, otherwise the device is logged out and False is returned.
+    """
+    with command("rotate"):
+        rotated = rotate_script(
+            keys=devices_keys(user_id),
+            args=rotate_args(jti, fields, expected_jti, refresh_token_ttl),
+        )
+    logger.debug(f"replace token: {jti=}, {user_id=}, {fields=}, {rotated=}")
+    return bool(rotated)
+
+
+def remove_refresh_token(user_id, fields: list[str]):
+    with command("revoke_device"):
+        removed = revoke_device_script(keys=devices_keys(user_id), args=fields)
+    logger.debug(f"removed token: {user_id=}, {fields=}, {removed=}")
+
+
+def remove_all_user_refresh_tokens(user_id):
+    with command("revoke_all"):
+        count = revoke_all_script(keys=devices_keys(user_id))
+    logger.debug(f"removed {count} tokens of {user_id=}")
@@ -0,0 +1,103 @@
+"""
+Token minting.
+
+Claims match the ones flask_jwt_extended expects when it decodes tokens. jti is
+generated here, so the caller knows it without decoding the token back.
+A Signer per key keeps the parsed key and the encoded header between requests.
+"""
+
+import base64
+import json
+import secrets
+import time
+from typing import Any, NamedTuple
+
+from jwt.algorithms import get_default_algorithms
+
+import jwt_keys
+import metrics
+
+
+class TokenPair(NamedTuple):
+    access_token: str
+    refresh_token: str
+    access_jti: str
+    refresh_jti: str
+
+
+def _b64(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def _json(data: dict) -> bytes:
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+class Signer:
+    def __init__(self, key: jwt_keys.Key):
+        self.key = key
+        self.algorithm = get_default_algorithms()[key.algorithm]
+        self.header = _b64(_json({"alg": key.algorithm, "kid": key.kid, "typ": "JWT"}))
+        self.sign_seconds = metrics.JWT_SIGN_SECONDS.labels(key.algorithm)
+
+    def sign(self, payload: dict[str, Any]) -> str:
+        with self.sign_seconds.time():
+            signing_input = self.header + b"." + _b64(_json(payload))
+            signature = self.algorithm.sign(signing_input, self.key.private_key)
+            return (signing_input + b"." + _b64(signature)).decode()
+
+
+access_expires = 0
+refresh_expires = 0
+
+_signers: dict[str, Signer] = {}
+
+
+def init(access_ttl: int, refresh_ttl: int):
+    global access_expires, refresh_expires
+    access_expires = access_ttl
+    refresh_expires = refresh_ttl
+
+
+def signer() -> Signer:
+    key = jwt_keys.signing_key()
+    cached = _signers.get(key.kid)
+    if cached is None or cached.key is not key:
+        cached = _signers[key.kid] = Signer(key)
+    return cached
+
+
+def new_jti() -> str:
+    return secrets.token_urlsafe(16)
+
+
+def role_claims(roles, version: int) -> dict[str, Any]:
+    """Role names and the roles_version they were read at, omitted when empty."""
+    claims: dict[str, Any] = {}
+    if roles:
+        claims["roles"] = sorted(roles)
+    if version:
+        claims["rv"] = version
+    return claims
+
+
+def mint_pair(identity, claims: dict[str, Any]) -> TokenPair:
+    now = int(time.time())
+    common = {"fresh": False, "iat": now, "nbf": now, "sub": str(identity), **claims}
+    access_jti, refresh_jti = new_jti(), new_jti()
+    access = {
+        **common,
+        "jti": access_jti,
+        "type": "access",
+        "exp": now + access_expires,
+    }
+    refresh = {
+        **common,
+        "jti": refresh_jti,
+        "type": "refresh",
+        "exp": now + refresh_expires,
+    }
+    token_signer = signer()
+    return TokenPair(
+        token_signer.sign(access), token_signer.sign(refresh), access_jti, refresh_jti
+    )
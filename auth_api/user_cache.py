@@ -0,0 +1,200 @@
+"""
+Per-worker cache of user snapshots for user_lookup_loader: LRU bounded by size
+with a TTL per entry. Writes drop the local entry and publish the user id to
+redis, so other workers and pods drop it too. Users changed within the lag
+allowed to replicas are loaded from the primary.
+"""
+
+import datetime
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+import redis
+from sqlalchemy.orm import selectinload
+
+import jobs
+import metrics
+from config import config
+from storage import db
+from storage.db_models import User
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "user_cache:invalidate"
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    id: uuid.UUID
+    email: str
+    registered_at: datetime.datetime
+    active: bool
+    roles: tuple[str, ...]
+    should_change_password: bool
+    roles_version: int
+
+    @classmethod
+    def from_user(cls, user: User) -> "UserSnapshot":
+        return cls(
+            id=user.id,
+            email=user.email,
+            registered_at=user.registered_at,
+            active=user.active,
+            roles=tuple(role.name for role in user.roles),
+            should_change_password=bool(user.should_change_password),
+            roles_version=user.roles_version or 0,
+        )
+
+
+client: Optional[redis.StrictRedis] = None
+max_size = 0
+ttl = 0.0
+
+_entries: "OrderedDict[str, tuple[float, Optional[UserSnapshot]]]" = OrderedDict()
+# user id -> monotonic time of its last invalidation, kept only with replicas
+_changed_at: dict[str, float] = {}
+_lock = threading.Lock()
+# bumped on every invalidation, a load that raced with one is not cached
+_generation = 0
+
+
+def init(redis_client: redis.StrictRedis, size: int, ttl_seconds: float):
+    global client, max_size, ttl
+    client = redis_client
+    max_size = size
+    ttl = ttl_seconds
+    clear()
+    jobs.in_background(_subscribe)
+
+
+def _subscribe():
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(**{INVALIDATION_CHANNEL: _on_invalidation_message})
+    except redis.RedisError:
+        logger.warning("user cache invalidation is not subscribed, relying on TTL")
+        return
+    pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+
+def load_snapshots(user_ids: list[str]) -> dict[str, Optional[UserSnapshot]]:
+    query = (
+        db.session.query(User)
+        .options(selectinload(User.roles))
+        .filter(User.id.in_(user_ids))
+    )
+    if recently_changed(user_ids):
+        with db.primary_reads():
+            users = query.all()
+    else:
+        users = query.all()
+    snapshots = dict.fromkeys(user_ids)
+    for user in users:
+        snapshots[str(user.id)] = UserSnapshot.from_user(user)
+    return snapshots
+
+
+def get(user_id) -> Optional[UserSnapshot]:
+    return get_many([user_id])[str(user_id)]
+
+
+def get_many(user_ids) -> dict[str, Optional[UserSnapshot]]:
+    """Snapshots by user id, all misses are loaded with one query."""
+    found, missing, generation = lookup(user_ids)
+    if missing:
+        loaded = load_snapshots(missing)
+        store(loaded, generation)
+        found.update(loaded)
+    return found
+
+
+def lookup(user_ids) -> tuple[dict[str, Optional[UserSnapshot]], list[str], int]:
+    """Cached snapshots, ids to load and the generation to pass to store()."""
+    found = {}
+    missing = []
+    now = time.monotonic()
+    with _lock:
+        for key in dict.fromkeys(map(str, user_ids)):
+            entry = _entries.get(key)
+            if entry and entry[0] > now:
+                _entries.move_to_end(key)
+                found[key] = entry[1]
+            else:
+                missing.append(key)
+        generation = _generation
+        size = len(_entries)
+    metrics.USER_CACHE_LOOKUPS.labels("hit").inc(len(found))
+    metrics.USER_CACHE_LOOKUPS.labels("miss").inc(len(missing))
+    metrics.USER_CACHE_ENTRIES.set(size)
+    return found, missing, generation
+
+
+def store(snapshots: dict[str, Optional[UserSnapshot]], generation: int):
+    with _lock:
+        if generation != _generation or max_size <= 0:
+            return
+        expires = time.monotonic() + ttl
+        for key, snapshot in snapshots.items():
+            _entries[key] = (expires, snapshot)
+            _entries.move_to_end(key)
+        while len(_entries) > max_size:
+            _entries.popitem(last=False)
+
+
+def forget(user_id):
+    """Drop the entry of this worker only."""
+    _drop(str(user_id))
+
+
+def invalidate(user_id):
+    key = str(user_id)
+    _drop(key)
+    if client is None:
+        return
+    try:
+        client.publish(INVALIDATION_CHANNEL, key)
+    except redis.RedisError:
+        logger.exception(f"failed to publish user cache invalidation: {key}")
+
+
+def clear():
+    global _generation
+    with _lock:
+        _entries.clear()
+        _generation += 1
+
+
+def recently_changed(user_ids) -> bool:
+    """Whether a replica may not have replayed the last change of the users yet."""
+    if not _changed_at:
+        return False
+    since = time.monotonic() - config.POSTGRES_REPLICA_MAX_LAG
+    return any(_changed_at.get(user_id, 0) > since for user_id in user_ids)
+
+
+def _drop(key: str):
+    global _generation
+    now = time.monotonic()
+    with _lock:
+        _entries.pop(key, None)
+        _generation += 1
+        if not db.replicas:
+            return
+        _changed_at[key] = now
+        if len(_changed_at) > max_size:
+            since = now - config.POSTGRES_REPLICA_MAX_LAG
+            for user_id in [k for k, at in _changed_at.items() if at <= since]:
+                del _changed_at[user_id]
+
+
+def _on_invalidation_message(message):
+    key = message["data"]
+    if isinstance(key, bytes):
+        key = key.decode()
+    logger.debug(f"user cache invalidated: {key}")
+    _drop(key)
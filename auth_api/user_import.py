@@ -0,0 +1,232 @@
+"""
+Bulk import of users from CSV or JSONL with email and either password or
+hashed_password (argon2) per record.
+
+Records are read as a stream and processed in batches. Passwords of a batch are
+hashed by a process pool on every core while the previous batch is written to
+the db with one multi-row INSERT ... ON CONFLICT DO NOTHING. After every
+committed batch the number of processed records is saved to the state file, so
+an interrupted import continues from there with resume. Rejected records go to
+the rejects file without their passwords.
+"""
+
+import csv
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass
+from itertools import islice
+from typing import IO, Iterator, NamedTuple, Optional
+
+from passlib.hash import argon2
+from pydantic import BaseModel, EmailStr, ValidationError, root_validator
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+import hashing
+from storage.db import engine
+from storage.db_models import User
+
+logger = logging.getLogger(__name__)
+
+
+class ImportedUser(BaseModel):
+    email: EmailStr
+    password: Optional[str]
+    hashed_password: Optional[str]
+
+    @root_validator
+    def one_of(cls, values):
+        if bool(values.get("password")) == bool(values.get("hashed_password")):
+            raise ValueError("either password or hashed_password is required")
+        hashed = values.get("hashed_password")
+        if hashed and not argon2.identify(hashed):
+            raise ValueError("hashed_password is not an argon2 hash")
+        return values
+
+
+@dataclass
+class Progress:
+    processed: int = 0
+    imported: int = 0
+    rejected: int = 0
+    skipped: int = 0
+    started: float = 0.0
+
+    def rate(self) -> float:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return (self.processed - self.skipped) / elapsed
+
+    def __str__(self):
+        return (
+            f"processed {self.processed}, imported {self.imported}, "
+            f"rejected {self.rejected}, {self.rate():.0f} records/s"
+        )
+
+
+def read_records(file: IO[str], file_format: str) -> Iterator[dict]:
+    if file_format == "csv":
+        yield from csv.DictReader(file)
+        return
+    for line in file:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                yield {"error": f"invalid json: {e}"}
+
+
+def hash_password(password: str) -> str:
+    return hashing.hasher.hash(password)
+
+
+def load_state(path: str) -> int:
+    try:
+        with open(path) as file:
+            return json.load(file)["processed"]
+    except FileNotFoundError:
+        return 0
+
+
+def save_state(path: str, processed: int):
+    # replaced at once, an interrupted write keeps the previous state
+    with open(f"{path}.tmp", "w") as file:
+        json.dump({"processed": processed}, file)
+    os.replace(f"{path}.tmp", path)
+
+
+def insert_users(rows: list[dict]) -> set[str]:
+    """Insert rows skipping existing emails, return emails inserted."""
+    table = User.__table__
+    with engine.begin() as connection:
+        if engine.dialect.name == "postgresql":
+            statement = (
+                postgresql.insert(table)
+                .values(rows)
+                .on_conflict_do_nothing(index_elements=[table.c.email])
+                .returning(table.c.email)
+            )
+            return set(connection.execute(statement).scalars())
+        existing = set(
+            connection.execute(
+                select(table.c.email).where(
+                    table.c.email.in_([row["email"] for row in rows])
+                )
+            ).scalars()
+        )
+        new_rows = [row for row in rows if row["email"] not in existing]
+        if new_rows:
+            connection.execute(table.insert(), new_rows)
+        return {row["email"] for row in new_rows}
+
+
+class Batch(NamedTuple):
+    size: int
+    users: list[tuple[int, ImportedUser]]
+    rejected: list[tuple[int, Optional[str], str]]
+    hashes: Iterator[str]
+
+
+class Importer:
+    def __init__(self, rejects: IO[str], batch_size: int, workers: Optional[int]):
+        self.rejects = rejects
+        self.batch_size = batch_size
+        self.workers = workers or os.cpu_count() or 1
+        self.progress = Progress(started=time.monotonic())
+
+    def validate(self, records: list[tuple[int, dict]]):
+        valid, rejected = [], []
+        emails = set()
+        for number, record in records:
+            if "error" in record:
+                rejected.append((number, None, record["error"]))
+                continue
+            if None in record:
+                # csv.DictReader puts values of extra columns under None
+                rejected.append((number, record.get("email"), "too many columns"))
+                continue
+            try:
+                user = ImportedUser.parse_obj(record)
+            except ValidationError as e:
+                errors = "; ".join(error["msg"] for error in e.errors())
+                rejected.append((number, record.get("email"), errors))
+                continue
+            if user.email in emails:
+                rejected.append((number, user.email, "duplicate email in the input"))
+                continue
+            emails.add(user.email)
+            valid.append((number, user))
+        return valid, rejected
+
+    def submit(self, executor: Executor, records: list[tuple[int, dict]]) -> Batch:
+        users, rejected = self.validate(records)
+        passwords = [user.password for _, user in users if user.password]
+        chunksize = max(1, len(passwords) // (self.workers * 4))
+        hashes = executor.map(hash_password, passwords, chunksize=chunksize)
+        return Batch(len(records), users, rejected, iter(hashes))
+
+    def commit(self, batch: Batch, state_path: str):
+        now = datetime.datetime.utcnow()
+        rows = [
+            {
+                "id": uuid.uuid4(),
+                "email": user.email,
+                "password": user.hashed_password or next(batch.hashes),
+                "registered_at": now,
+                "active": True,
+                "should_change_password": False,
+                "roles_version": 0,
+            }
+            for _, user in batch.users
+        ]
+        inserted = insert_users(rows) if rows else set()
+        rejected = batch.rejected + [
+            (number, user.email, "user already exists")
+            for number, user in batch.users
+            if user.email not in inserted
+        ]
+        for number, email, reason in sorted(rejected):
+            line = json.dumps({"record": number, "email": email, "reason": reason})
+            self.rejects.write(line + "\n")
+        self.rejects.flush()
+
+        self.progress.processed += batch.size
+        self.progress.imported += len(inserted)
+        self.progress.rejected += len(rejected)
+        save_state(state_path, self.progress.processed)
+
+    def run(
+        self, records: Iterator[dict], state_path: str, skip: int = 0, report=print
+    ) -> Progress:
+        """Import records after the first skip ones, report after every batch."""
+        self.progress.processed = self.progress.skipped = skip
+        numbered = enumerate(records, 1)
+        for _ in range(skip):
+            next(numbered, None)
+
+        # passwords of the next batch are hashed while the previous one is written
+        pending: deque[Batch] = deque()
+        # spawned, not forked: the CLI app already runs pub/sub and job threads
+        # whose locks and sockets a forked child would inherit
+        with ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=hashing.configure,
+            initargs=hashing.cost(),
+        ) as executor:
+            while True:
+                records_batch = list(islice(numbered, self.batch_size))
+                if records_batch:
+                    pending.append(self.submit(executor, records_batch))
+                if pending and (len(pending) > 1 or not records_batch):
+                    self.commit(pending.popleft(), state_path)
+                    report(str(self.progress))
+                elif not records_batch:
+                    break
+        return self.progress
@@ -2,6 +2,13 @@ from gevent import monkey
 
 monkey.patch_all()
 
+from storage import green  # noqa: E402
+
+green.patch_psycopg()
+
+import jobs  # noqa: E402
 from app import create_app  # noqa: E402,F401
 
+# started by every worker, see post_worker_init in gunicorn.conf.py
+jobs.defer_background_work()
 app = create_app()
@@ -0,0 +1,154 @@
+"""
+Side-by-side load test of the gevent (wsgi_app) and ASGI (asgi_app) deployments.
+
+Both deployments have to run against the same Postgres and Redis, e.g. with
+docker-compose, which serves gevent on :5000 and ASGI on :5001:
+
+    docker-compose up -d
+    pip install httpx
+    python benchmarks/bench_asgi_vs_gevent.py --seconds 20 --concurrency 64
+
+Every virtual user registers its own account and logs in from its own device,
+then each scenario is run for --seconds against each target:
+    token    POST /api/v1/token, argon2 verification bound
+    refresh  POST /api/v1/refresh_token, a chain of rotations per device
+    user     GET /api/v1/user/<id>, token checks and the user cache
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+
+import httpx
+
+TARGETS = {"gevent": "http://127.0.0.1:5000", "asgi": "http://127.0.0.1:5001"}
+PASSWORD = "bench-password"
+
+
+class VirtualUser:
+    def __init__(self, client: httpx.AsyncClient, number: int):
+        self.client = client
+        self.email = f"bench-{uuid.uuid4().hex[:12]}-{number}@example.com"
+        self.headers = {"User-Agent": f"bench/{number}"}
+        self.user_id = None
+        self.access_token = None
+        self.refresh_token = None
+
+    async def register(self):
+        response = await self.client.post(
+            "/api/v1/user", json={"email": self.email, "password": PASSWORD}
+        )
+        response.raise_for_status()
+        self.user_id = response.headers["Location"].rsplit("/", 1)[1]
+        await self.token()
+
+    def _store(self, response: httpx.Response):
+        response.raise_for_status()
+        tokens = response.json()
+        self.access_token = tokens["access_token"]
+        self.refresh_token = tokens["refresh_token"]
+
+    async def token(self):
+        response = await self.client.post(
+            "/api/v1/token",
+            json={"email": self.email, "password": PASSWORD},
+            headers=self.headers,
+        )
+        self._store(response)
+
+    async def refresh(self):
+        response = await self.client.post(
+            "/api/v1/refresh_token",
+            headers={**self.headers, "Authorization": f"Bearer {self.refresh_token}"},
+        )
+        self._store(response)
+
+    async def user(self):
+        response = await self.client.get(
+            f"/api/v1/user/{self.user_id}",
+            headers={**self.headers, "Authorization": f"Bearer {self.access_token}"},
+        )
+        response.raise_for_status()
+
+
+async def run_scenario(users: list[VirtualUser], scenario: str, seconds: float):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + seconds
+
+    async def loop(user: VirtualUser):
+        nonlocal errors
+        request = getattr(user, scenario)
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                await request()
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(loop(user) for user in users))
+    elapsed = time.perf_counter() - started
+    return len(latencies) / elapsed, latencies, errors
+
+
+def percentile(latencies: list[float], q: int) -> float:
+    if len(latencies) < 2:
+        return latencies[0] if latencies else 0.0
+    return statistics.quantiles(latencies, n=100)[q - 1]
+
+
+async def bench(name: str, base_url: str, args) -> list[tuple]:
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=30
+    ) as client:
+        users = [VirtualUser(client, number) for number in range(args.concurrency)]
+        await asyncio.gather(*(user.register() for user in users))
+        rows = []
+        for scenario in args.scenarios:
+            rps, latencies, errors = await run_scenario(users, scenario, args.seconds)
+            rows.append(
+                (
+                    name,
+                    scenario,
+                    rps,
+                    percentile(latencies, 50) * 1000,
+                    percentile(latencies, 95) * 1000,
+                    percentile(latencies, 99) * 1000,
+                    errors,
+                )
+            )
+        return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gevent", default=TARGETS["gevent"])
+    parser.add_argument("--asgi", default=TARGETS["asgi"])
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--scenarios", nargs="+", default=["token", "refresh", "user"])
+    args = parser.parse_args()
+
+    rows = []
+    for name, base_url in (("gevent", args.gevent), ("asgi", args.asgi)):
+        rows.extend(asyncio.run(bench(name, base_url, args)))
+
+    print(
+        f"{'server':<8}{'scenario':<10}{'req/s':>9}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}"
+    )
+    for name, scenario, rps, p50, p95, p99, errors in rows:
+        print(
+            f"{name:<8}{scenario:<10}{rps:>9.0f}"
+            f"{p50:>9.1f}{p95:>9.1f}{p99:>9.1f}{errors:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Redis memory per refresh token session in the layout before device
+fingerprints and in the current one.
+
+"legacy": the raw User-Agent is the hash field and every token has its own
+token:{jti} key. "fingerprint": a 16 byte device id field with a "jti:exp"
+value and no token keys. Sessions are written for --users users with
+--devices devices each, measured with MEMORY USAGE and deleted afterwards.
+
+    PYTHONPATH=auth_api python benchmarks/bench_device_tokens_memory.py \
+        --redis localhost:6379 [--users 2000] [--devices 1 3 8]
+
+Needs a real Redis: MEMORY USAGE and the hash encodings are its own.
+"""
+
+import argparse
+import os
+import random
+import time
+
+import redis
+
+# config.Settings requires these, the benchmark talks to redis only
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ.setdefault("JWT_PRIVATE_KEY", "unused")
+os.environ.setdefault("JWT_PUBLIC_KEY", "unused")
+
+import token_store  # noqa: E402
+from tokens import new_jti  # noqa: E402
+
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/118.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 "
+    "(KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1",
+    "Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/119.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 "
+    "(KHTML, like Gecko) Version/16.6 Safari/605.1.15",
+    "Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/118.0.5993.111 Mobile Safari/537.36 EdgA/118.0.2088.66",
+    "okhttp/4.11.0 AuthApp/3.4.1 (Android 13; SM-S918B; build 3410)",
+]
+TTL = 30 * 24 * 3600
+PREFIX = "bench-memory"
+
+
+def device_agents(devices: int) -> list[str]:
+    # distinct User-Agents of realistic length, one per device
+    return [f"{random.choice(USER_AGENTS)} build/{i}" for i in range(devices)]
+
+
+def write(client, layout: str, users: int, devices: int) -> list[str]:
+    keys = []
+    pipe = client.pipeline(transaction=False)
+    exp = int(time.time()) + TTL
+    for user in range(users):
+        key = f"{PREFIX}:user:{user}:device_tokens"
+        fields = {}
+        for user_agent in device_agents(devices):
+            jti = new_jti()
+            if layout == "legacy":
+                token_key = f"{PREFIX}:token:{jti}"
+                fields[user_agent] = jti
+                pipe.set(token_key, 1, ex=TTL)
+                keys.append(token_key)
+            else:
+                fields[token_store.user_agent_to_device_id(user_agent)] = f"{jti}:{exp}"
+        pipe.hset(key, mapping=fields)
+        pipe.expire(key, TTL)
+        keys.append(key)
+    pipe.execute()
+    return keys
+
+
+def measure(client, keys: list[str]) -> tuple[int, str]:
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.memory_usage(key, samples=0)
+    size = sum(pipe.execute())
+    encoding = client.object("encoding", keys[-1])
+    return size, encoding
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--redis", default="localhost:6379")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--devices", type=int, nargs="+", default=[1, 3, 8])
+    args = parser.parse_args()
+
+    host, port = args.redis.split(":")
+    client = redis.StrictRedis(host=host, port=int(port), decode_responses=True)
+
+    print(
+        f"{'devices':>7}  {'legacy B/session':>16} {'encoding':>9}"
+        f"  {'fingerprint B/session':>21} {'encoding':>9}  {'saved':>6}"
+    )
+    for devices in args.devices:
+        sessions = args.users * devices
+        row = []
+        for layout in ("legacy", "fingerprint"):
+            keys = write(client, layout, args.users, devices)
+            try:
+                size, encoding = measure(client, keys)
+            finally:
+                for start in range(0, len(keys), 1000):
+                    client.delete(*keys[start : start + 1000])
+            row.append((size / sessions, encoding))
+        (legacy, legacy_encoding), (compact, compact_encoding) = row
+        print(
+            f"{devices:>7}  {legacy:>16.0f} {legacy_encoding:>9}"
+            f"  {compact:>21.0f} {compact_encoding:>9}  {1 - compact / legacy:>6.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
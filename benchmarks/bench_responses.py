@@ -0,0 +1,158 @@
+"""
+Bytes and microseconds per API response: validated models, dict() and pretty
+printed flask.jsonify before, construct() and orjson of api.responses now, and
+the br and gzip sizes of the compact bodies.
+
+    PYTHONPATH=auth_api python benchmarks/bench_responses.py [--number 2000]
+
+Runs in-process on synthetic data, no services needed.
+"""
+
+import argparse
+import base64
+import datetime
+import os
+import time
+import uuid
+
+from flask import Flask, jsonify
+
+from api import responses
+from api.models import (
+    IntrospectionResult,
+    IntrospectOut,
+    TokenGrantOut,
+    UserInfoOut,
+    UserLoginRecord,
+    UserLoginRecordsOut,
+)
+from default_config import DefaultConfig
+
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/118.0.0.0 Safari/537.36"
+)
+# random like a signed token, compresses as badly
+TOKEN = base64.urlsafe_b64encode(os.urandom(600)).decode()
+
+
+def user_info() -> dict:
+    return dict(
+        id=str(uuid.uuid4()),
+        email="user@example.com",
+        registered_at=datetime.datetime.utcnow(),
+        active=True,
+        roles=["admin", "subscriber"],
+    )
+
+
+def login_record(number: int) -> dict:
+    return dict(
+        user_agent=USER_AGENT,
+        platform="windows",
+        browser="chrome-118.0",
+        timestamp=datetime.datetime(2026, 1, 1) + datetime.timedelta(minutes=number),
+        ip=f"10.0.{number % 256}.{number // 256 % 256}",
+    )
+
+
+def introspection(number: int) -> dict:
+    if number % 4 == 3:
+        return {"active": False}
+    return {
+        "active": True,
+        "token_type": "access",
+        "sub": str(uuid.uuid4()),
+        "username": f"user{number}@example.com",
+        "jti": uuid.uuid4().hex,
+        "exp": 1_800_000_000,
+        "iat": 1_799_999_100,
+        "roles": ["subscriber"],
+    }
+
+
+def cases() -> dict:
+    """name -> (validated dict() as before, constructed model as now, exclude_none)"""
+    history = [login_record(number) for number in range(100)]
+    results = [introspection(number) for number in range(100)]
+    grant = dict(access_token=TOKEN, refresh_token=TOKEN, expires=900)
+    info = user_info()
+    return {
+        "user info": (
+            lambda: UserInfoOut(**info).dict(),
+            lambda: UserInfoOut.construct(**info),
+            False,
+        ),
+        "token pair": (
+            lambda: TokenGrantOut(**grant).dict(),
+            lambda: TokenGrantOut.construct(**grant),
+            False,
+        ),
+        "history x100": (
+            lambda: UserLoginRecordsOut(
+                logins=[UserLoginRecord(**record) for record in history],
+                next_cursor="cursor",
+            ).dict(),
+            lambda: UserLoginRecordsOut.construct(
+                logins=[UserLoginRecord.construct(**record) for record in history],
+                next_cursor="cursor",
+            ),
+            False,
+        ),
+        "introspect x100": (
+            lambda: IntrospectOut(results=results).dict(exclude_none=True),
+            lambda: IntrospectOut.construct(
+                results=[IntrospectionResult.construct(**result) for result in results]
+            ),
+            True,
+        ),
+    }
+
+
+def timed(fn, number: int) -> tuple[float, bytes]:
+    body = fn()
+    started = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return (time.perf_counter() - started) / number * 1e6, body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config.from_object(DefaultConfig)
+    levels = DefaultConfig.COMPRESSION_LEVELS
+
+    print(
+        f"{'response':<16}{'before B':>9}{'µs':>8}{'now B':>8}{'µs':>8}"
+        f"{'br B':>7}{'µs':>7}{'gzip B':>8}{'µs':>7}"
+    )
+    with app.app_context():
+        for name, (before, now, exclude_none) in cases().items():
+            app.config["JSONIFY_PRETTYPRINT_REGULAR"] = True
+            old_us, old_body = timed(lambda: jsonify(before()).get_data(), args.number)
+            new_us, new_body = timed(
+                lambda: responses.json_response(
+                    now(), exclude_none=exclude_none
+                ).get_data(),
+                args.number,
+            )
+            br_us, br_body = timed(
+                lambda: responses.compress(new_body, "br", levels["br"]), args.number
+            )
+            gzip_us, gzip_body = timed(
+                lambda: responses.compress(new_body, "gzip", levels["gzip"]),
+                args.number,
+            )
+            print(
+                f"{name:<16}{len(old_body):>9}{old_us:>8.1f}{len(new_body):>8}"
+                f"{new_us:>8.1f}{len(br_body):>7}{br_us:>7.1f}"
+                f"{len(gzip_body):>8}{gzip_us:>7.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Startup time of a gunicorn worker, measured in fresh interpreters.
+
+Every sample runs the way wsgi_app and gunicorn.conf.py do: gevent patching,
+import of the app, create_app() with background work held back, start_worker()
+as after the fork and the first request (JWKS, loads the keyring from the db).
+With a preloaded app the master pays the import and create_app() once, every
+worker pays the rest. Medians of --samples runs are printed together with the
+modules that only some CLI commands need but got imported anyway.
+
+    PYTHONPATH=auth_api python benchmarks/bench_startup.py --stand-ins \
+        [--samples 10] [--budget-ms 1500]
+
+With --stand-ins the schema is migrated first, that time is printed as the
+deploy step; without them Redis and Postgres come from the environment and
+flask initdb has to be run before. --budget-ms fails the run if a worker
+started from scratch (all the phases) takes longer.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import standins
+
+PHASES = ("import", "create_app", "start_worker", "first_request")
+# imported by the commands needing them, never by a worker
+LAZY_MODULES = (
+    "openapi_spec",
+    "apispec",
+    "alembic",
+    "sqlalchemy_utils",
+    "user_import",
+    "argon2_calibration",
+    "token_migration",
+)
+
+
+def child(args) -> dict:
+    from gevent import monkey
+
+    monkey.patch_all()
+    if args.stand_ins:
+        # imports the models before the clock starts
+        standins.install(args.sqlite)
+    else:
+        from storage import green
+
+        green.patch_psycopg()
+
+    if args.migrate:
+        from storage import db
+
+        started = time.perf_counter()
+        db.init_db()
+        return {"migrate": time.perf_counter() - started}
+
+    timings = {}
+    started = time.perf_counter()
+    import app as app_module
+    import jobs
+
+    timings["import"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    jobs.defer_background_work()
+    app = app_module.create_app()
+    timings["create_app"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    app_module.start_worker(app)
+    timings["start_worker"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    response = app.test_client().get("/.well-known/jwks.json")
+    timings["first_request"] = time.perf_counter() - started
+    if response.status_code != 200:
+        raise SystemExit(f"first request failed: {response.status_code}")
+
+    timings["eager"] = [module for module in LAZY_MODULES if module in sys.modules]
+    return timings
+
+
+def run_child(args, *extra: str) -> dict:
+    command = [sys.executable, __file__, "--child", *extra]
+    if args.stand_ins:
+        command += ["--stand-ins", "--sqlite", args.sqlite]
+    output = subprocess.run(
+        command, check=True, stdout=subprocess.PIPE, text=True
+    ).stdout
+    # the last line, logs of the app may come before it
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--stand-ins", action="store_true")
+    parser.add_argument("--sqlite", default=standins.SQLITE_PATH)
+    parser.add_argument("--samples", type=int, default=10)
+    parser.add_argument("--budget-ms", type=float, help="Fail above this total")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--migrate", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child(args)))
+        return
+
+    if args.stand_ins:
+        if os.path.exists(args.sqlite):
+            os.remove(args.sqlite)
+        migrate = run_child(args, "--migrate")["migrate"]
+        print(f"deploy step, migrations of an empty db: {migrate * 1000:.0f} ms")
+
+    samples = [run_child(args) for _ in range(args.samples)]
+    medians = {
+        phase: statistics.median(sample[phase] for sample in samples)
+        for phase in PHASES
+    }
+    total = statistics.median(
+        sum(sample[phase] for phase in PHASES) for sample in samples
+    )
+
+    print(f"{'phase':<16}{'median ms':>10}")
+    for phase in PHASES:
+        print(f"{phase:<16}{medians[phase] * 1000:>10.1f}")
+    print(f"{'total':<16}{total * 1000:>10.1f}")
+    after_fork = medians["start_worker"] + medians["first_request"]
+    print(f"a preloaded worker pays {after_fork * 1000:.1f} ms of it")
+
+    eager = sorted({module for sample in samples for module in sample["eager"]})
+    if eager:
+        print(f"imported by the worker but only needed by commands: {', '.join(eager)}")
+
+    if args.budget_ms is not None and total * 1000 > args.budget_ms:
+        raise SystemExit(
+            f"startup took {total * 1000:.0f} ms, the budget is {args.budget_ms:.0f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
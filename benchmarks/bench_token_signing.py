@@ -0,0 +1,97 @@
+"""
+Token minting throughput on one core, per algorithm.
+
+"pem" is the former pipeline: PyJWT parses the PEM key on every encode and the
+refresh token is decoded back to read its jti. "signer" is tokens.Signer with
+the parsed key and the encoded header kept between calls.
+
+    PYTHONPATH=auth_api python benchmarks/bench_token_signing.py [--seconds 2]
+"""
+
+import argparse
+import os
+import time
+
+from cryptography.hazmat.primitives import serialization
+
+# config.Settings requires these, the benchmark generates its own keys
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ.setdefault("JWT_PRIVATE_KEY", "unused")
+os.environ.setdefault("JWT_PUBLIC_KEY", "unused")
+
+import jwt  # noqa: E402
+
+import jwt_keys  # noqa: E402
+from tokens import Signer, new_jti  # noqa: E402
+
+
+def pem_pair(algorithm: str) -> tuple[str, str]:
+    private_key = jwt_keys.generate_private_key(algorithm)
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+    public_pem = (
+        private_key.public_key()
+        .public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        .decode()
+    )
+    return private_pem, public_pem
+
+
+def payload(token_type: str) -> dict:
+    now = int(time.time())
+    return {
+        "fresh": False,
+        "iat": now,
+        "nbf": now,
+        "jti": new_jti(),
+        "type": token_type,
+        "sub": "dbdbed6b-95d1-4a4f-b7b9-6a6f78b6726e",
+        "exp": now + 900,
+        "device_id": "0RHdlQ3qbHVrPkbl",
+    }
+
+
+def measure(mint, seconds: float) -> float:
+    pairs = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        mint()
+        pairs += 1
+    return pairs * 2 / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    print(f"{'algorithm':<10}{'pem tokens/s':>14}{'signer tokens/s':>17}{'speedup':>9}")
+    for algorithm in jwt_keys.SUPPORTED_ALGORITHMS:
+        private_pem, public_pem = pem_pair(algorithm)
+
+        def mint_pem():
+            jwt.encode(payload("access"), private_pem, algorithm=algorithm)
+            refresh = jwt.encode(payload("refresh"), private_pem, algorithm=algorithm)
+            jwt.decode(refresh, public_pem, algorithms=[algorithm])["jti"]
+
+        signer = Signer(jwt_keys.Key.from_pem(algorithm, public_pem, private_pem))
+
+        def mint_signer():
+            signer.sign(payload("access"))
+            signer.sign(payload("refresh"))
+
+        pem_rate = measure(mint_pem, args.seconds)
+        signer_rate = measure(mint_signer, args.seconds)
+        print(
+            f"{algorithm:<10}{pem_rate:>14.0f}{signer_rate:>17.0f}"
+            f"{signer_rate / pem_rate:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+"""
+Load test of the auth API with stored baselines, so regressions show up
+between commits.
+
+    # in-process stand-ins for Redis and Postgres (pip install "fakeredis[lua]")
+    PYTHONPATH=auth_api python benchmarks/loadtest.py --stand-ins
+    # Redis and Postgres from the environment, e.g. make dev_setup
+    bash -c 'set -a; source deploys/local.env; set +a; \
+        PYTHONPATH=auth_api python benchmarks/loadtest.py'
+
+The app is started from app.create_app under gevent (benchmarks/serve.py),
+unless --url points to a running deployment. Login history rows are seeded
+directly into POSTGRES_URI, so it has to be the database of the app.
+
+Scenarios:
+    register  POST /api/v1/user, a burst of --registrations new accounts
+    login     POST /api/v1/token, argon2 verification bound
+    refresh   POST /api/v1/refresh_token, a chain of rotations per device
+    user      GET /api/v1/user/<id>, token checks and the user cache
+    history   GET /api/v1/user/<id>/login_history, over --history-rows rows
+
+Results are written to benchmarks/results/<commit>.json. --save-baseline also
+writes them to benchmarks/results/baseline.json, later runs print the change
+against it and --fail-on-regression exits with 1 when a scenario is slower by
+more than --threshold percent.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import requests
+import standins
+
+BENCHMARKS = Path(__file__).resolve().parent
+RESULTS = BENCHMARKS / "results"
+BASELINE = RESULTS / "baseline.json"
+SCENARIOS = ("register", "login", "refresh", "user", "history")
+PASSWORD = "bench-password"
+SEED_CHUNK = 10_000
+OTHER_USERS = 1000
+
+
+class VirtualUser:
+    def __init__(self, url: str, number: int):
+        self.url = url
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = f"bench/{number}"
+        self.email = None
+        self.user_id = None
+        self.access_token = None
+        self.refresh_token = None
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.session.post(self.url + path, **kwargs)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.session.get(self.url + path, **kwargs)
+
+    def sign_up(self):
+        self.email = f"bench-{uuid.uuid4().hex}@example.com"
+        response = self.register(self.email)
+        response.raise_for_status()
+        self.user_id = response.headers["Location"].rsplit("/", 1)[1]
+        self.login().raise_for_status()
+
+    def register(self, email: str = None) -> requests.Response:
+        email = email or f"bench-{uuid.uuid4().hex}@example.com"
+        return self.post("/api/v1/user", json={"email": email, "password": PASSWORD})
+
+    def login(self) -> requests.Response:
+        response = self.post(
+            "/api/v1/token", json={"email": self.email, "password": PASSWORD}
+        )
+        self._store(response)
+        return response
+
+    def refresh(self) -> requests.Response:
+        response = self.post(
+            "/api/v1/refresh_token",
+            headers={"Authorization": f"Bearer {self.refresh_token}"},
+        )
+        self._store(response)
+        return response
+
+    def user(self) -> requests.Response:
+        return self.get(
+            f"/api/v1/user/{self.user_id}",
+            headers={"Authorization": f"Bearer {self.access_token}"},
+        )
+
+    def history(self) -> requests.Response:
+        return self.get(
+            f"/api/v1/user/{self.user_id}/login_history",
+            headers={"Authorization": f"Bearer {self.access_token}"},
+        )
+
+    def _store(self, response: requests.Response):
+        if response.status_code == 200:
+            tokens = response.json()
+            self.access_token = tokens["access_token"]
+            self.refresh_token = tokens["refresh_token"]
+
+
+def percentile(ordered: list[float], fraction: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_scenario(vus, name: str, seconds: float, registrations: int) -> dict:
+    """Every virtual user calls the scenario in a loop from its own thread."""
+    latencies = [[] for _ in vus]
+    errors = [0] * len(vus)
+    deadline = time.perf_counter() + seconds
+    remaining = iter(range(registrations))
+    lock = threading.Lock()
+
+    def more() -> bool:
+        if name != "register":
+            return time.perf_counter() < deadline
+        with lock:
+            return next(remaining, None) is not None
+
+    def loop(index: int):
+        call = getattr(vus[index], name)
+        while more():
+            started = time.perf_counter()
+            try:
+                ok = call().ok
+            except requests.RequestException:
+                ok = False
+            latencies[index].append(time.perf_counter() - started)
+            errors[index] += not ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(len(vus)) as executor:
+        list(executor.map(loop, range(len(vus))))
+    elapsed = time.perf_counter() - started
+
+    ordered = sorted(latency for vu_latencies in latencies for latency in vu_latencies)
+    return {
+        "requests": len(ordered),
+        "errors": sum(errors),
+        "rps": round(len(ordered) / elapsed, 1),
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 2),
+    }
+
+
+def seed_history(user_ids: list[str], rows: int):
+    """
+    Spread rows over the virtual users and OTHER_USERS more, so pages are read
+    from a table much larger than the history of one user.
+    """
+    from storage import db
+    from storage.db_models import LoginRecord, User
+
+    others = [uuid.uuid4() for _ in range(OTHER_USERS)]
+    owners = [uuid.UUID(user_id) for user_id in user_ids] + others
+    start = datetime.utcnow() - timedelta(days=90)
+    with db.engine.begin() as connection:
+        connection.execute(
+            User.__table__.insert(),
+            [
+                {
+                    "id": user_id,
+                    "email": f"bench-{user_id.hex}@example.com",
+                    "password": "-",
+                    "registered_at": start,
+                    "active": True,
+                    "roles_version": 0,
+                }
+                for user_id in others
+            ],
+        )
+        for offset in range(0, rows, SEED_CHUNK):
+            connection.execute(
+                LoginRecord.__table__.insert(),
+                [
+                    {
+                        "user_id": random.choice(owners),
+                        "user_agent": "bench",
+                        "platform": "linux",
+                        "browser": "bench",
+                        "timestamp": start
+                        + timedelta(seconds=random.random() * 7776000),
+                        "ip": "127.0.0.1",
+                    }
+                    for _ in range(min(SEED_CHUNK, rows - offset))
+                ],
+            )
+
+
+def start_server(port: int, stand_ins: bool, sqlite_path: str) -> subprocess.Popen:
+    command = [sys.executable, str(BENCHMARKS / "serve.py"), "--port", str(port)]
+    if stand_ins:
+        command += ["--stand-ins", "--sqlite", sqlite_path]
+    return subprocess.Popen(command)
+
+
+def wait_ready(url: str, server: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server and server.poll() is not None:
+            raise SystemExit(f"server exited with {server.returncode}")
+        try:
+            if requests.get(url + "/.well-known/jwks.json", timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"{url} is not ready after {timeout}s")
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}-dirty" if dirty else commit
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Print the change against the baseline, return regressed scenarios."""
+    if baseline.get("mode") != results["mode"]:
+        print(f"baseline was measured with {baseline.get('mode')}, not compared")
+        return []
+    regressed = []
+    print(f"\nagainst baseline {baseline['commit']}:")
+    for name, current in results["scenarios"].items():
+        before = baseline["scenarios"].get(name)
+        if not before or not before["rps"] or not before["p95_ms"]:
+            continue
+        rps = (current["rps"] / before["rps"] - 1) * 100
+        p95 = (current["p95_ms"] / before["p95_ms"] - 1) * 100
+        slower = rps < -threshold or p95 > threshold
+        if slower:
+            regressed.append(name)
+        print(
+            f"  {name:10} rps {rps:+6.1f}%  p95 {p95:+6.1f}%"
+            + ("  REGRESSION" if slower else "")
+        )
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", help="a running deployment instead of serve.py")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--stand-ins", action="store_true")
+    parser.add_argument("--sqlite", default=standins.SQLITE_PATH)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--registrations", type=int, default=500)
+    parser.add_argument("--history-rows", type=int, default=200_000)
+    parser.add_argument("--threshold", type=float, default=10, help="percent")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    if args.stand_ins:
+        if os.path.exists(args.sqlite):
+            os.remove(args.sqlite)
+        standins.install(args.sqlite)
+
+    server = None
+    url = args.url
+    if not url:
+        url = f"http://127.0.0.1:{args.port}"
+        server = start_server(args.port, args.stand_ins, args.sqlite)
+    try:
+        wait_ready(url, server)
+        vus = [VirtualUser(url, number) for number in range(args.concurrency)]
+        for vu in vus:
+            vu.sign_up()
+        if "history" in args.scenarios and args.history_rows:
+            print(f"seeding {args.history_rows} login history rows")
+            seed_history([vu.user_id for vu in vus], args.history_rows)
+
+        results = {
+            "commit": git_commit(),
+            "date": datetime.utcnow().isoformat(timespec="seconds"),
+            "mode": "stand-ins" if args.stand_ins else "services",
+            "concurrency": args.concurrency,
+            "seconds": args.seconds,
+            "history_rows": args.history_rows,
+            "scenarios": {},
+        }
+        print(
+            f"{'scenario':10} {'requests':>9} {'errors':>7} {'req/s':>8} "
+            f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+        )
+        for name in args.scenarios:
+            stats = run_scenario(vus, name, args.seconds, args.registrations)
+            results["scenarios"][name] = stats
+            print(
+                f"{name:10} {stats['requests']:9} {stats['errors']:7} "
+                f"{stats['rps']:8.1f} {stats['p50_ms']:8.2f} "
+                f"{stats['p95_ms']:8.2f} {stats['p99_ms']:8.2f}"
+            )
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    RESULTS.mkdir(exist_ok=True)
+    output = json.dumps(results, indent=2)
+    (RESULTS / f"{results['commit']}.json").write_text(output)
+    regressed = []
+    if BASELINE.exists() and not args.save_baseline:
+        baseline = json.loads(BASELINE.read_text())
+        regressed = compare(results, baseline, args.threshold)
+    if args.save_baseline:
+        BASELINE.write_text(output)
+        print(f"baseline saved: {BASELINE}")
+    if regressed and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+Serves app.create_app() under gevent for benchmarks/loadtest.py, the way
+wsgi_app does it in a gunicorn worker.
+
+    PYTHONPATH=auth_api python benchmarks/serve.py --port 5050 [--stand-ins]
+"""
+
+import argparse
+
+from gevent import monkey
+
+monkey.patch_all()
+
+import standins  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--stand-ins", action="store_true")
+    parser.add_argument("--sqlite", default=standins.SQLITE_PATH)
+    args = parser.parse_args()
+
+    if args.stand_ins:
+        standins.install(args.sqlite)
+    else:
+        from storage import green
+
+        green.patch_psycopg()
+
+    from gevent.pywsgi import WSGIServer
+
+    from app import create_app
+    from storage import db
+
+    app = create_app()
+    db.init_db()
+    WSGIServer(("127.0.0.1", args.port), app, log=None).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+In-process stand-ins for Redis and Postgres: fakeredis (pip install
+"fakeredis[lua]") and a sqlite file. They make the load test runnable without
+services; absolute numbers differ from a real deployment, so compare runs made
+in the same mode only.
+
+install() has to run before anything from auth_api is imported.
+"""
+
+import itertools
+import os
+import time
+
+SQLITE_PATH = "/tmp/auth_bench.db"
+
+
+def install(sqlite_path: str = SQLITE_PATH):
+    os.environ["POSTGRES_URI"] = f"sqlite:///{sqlite_path}"
+    # fakeredis keeps answering pubsub health checks, the subscriber never idles
+    os.environ["REDIS_HEALTH_CHECK_INTERVAL"] = "0"
+    _install_redis()
+    _install_sqlite()
+
+
+def _install_redis():
+    try:
+        import fakeredis
+    except ImportError:
+        raise SystemExit('stand-ins need fakeredis: pip install "fakeredis[lua]"')
+    import redis
+
+    server = fakeredis.FakeServer()
+
+    class FakeBlockingConnectionPool(redis.BlockingConnectionPool):
+        def __init__(self, **kwargs):
+            super().__init__(
+                connection_class=fakeredis.FakeConnection, server=server, **kwargs
+            )
+
+    redis.BlockingConnectionPool = FakeBlockingConnectionPool
+
+
+def _install_sqlite():
+    from sqlalchemy import ColumnDefault, text
+    from sqlalchemy.dialects.postgresql import UUID
+    from sqlalchemy.ext.compiler import compiles
+
+    @compiles(UUID, "sqlite")
+    def compile_uuid(_type, _compiler, **kw):
+        return "CHAR(36)"
+
+    from storage.db_models import LoginRecord, SigningKey
+
+    # sqlite cannot autoincrement a column of a composite primary key; ids only
+    # have to be unique together with the timestamp, across processes too
+    ids = itertools.count(time.time_ns() // 1000)
+    column = LoginRecord.__table__.c.id
+    column.autoincrement = False
+    column.default = ColumnDefault(lambda _context: next(ids))
+    column.default._set_parent_with_dispatch(column)
+
+    for index in SigningKey.__table__.indexes:
+        index.dialect_options["sqlite"]["where"] = text("active")